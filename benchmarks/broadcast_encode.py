@@ -0,0 +1,71 @@
+"""Measure encode cost per state broadcast as the number of clients grows.
+
+Run from the repository root: ``python -m benchmarks.broadcast_encode``.
+Each broadcast should encode the state frame once, whatever the client
+count, so the encode column stays flat while only fan-out grows.
+"""
+import asyncio
+import gc
+import time
+
+from livestream import codec
+from livestream.broadcaster import Broadcaster
+
+BROADCASTS = 200
+
+
+class NullSocket:
+    """Stands in for a WebSocketResponse; drops everything it is sent."""
+
+    async def send_str(self, data: str) -> None:
+        pass
+
+    async def close(self, **kwargs) -> None:
+        pass
+
+
+async def run(clients: int) -> tuple:
+    broadcaster = Broadcaster()
+    for _ in range(clients):
+        broadcaster.register(NullSocket())
+
+    encodes = 0
+    state = {'current_video': 'example.mp4', 'play_count': 0}
+
+    def build() -> dict:
+        nonlocal encodes
+        encodes += 1
+        return {'type': 'state_update', 'state': state}
+
+    frame = codec.EncodedFrame(build)
+    encode_time = publish_time = 0.0
+    gc.disable()  # keep collector pauses out of the per-call timings
+    for i in range(BROADCASTS):
+        state['play_count'] = i
+        start = time.perf_counter()
+        data = frame.get(i)
+        frame.get(i)  # a joiner in the same state reuses the frame
+        encode_time += time.perf_counter() - start
+        start = time.perf_counter()
+        broadcaster.publish(data)
+        publish_time += time.perf_counter() - start
+        await asyncio.sleep(0)
+
+    gc.enable()
+    writers = [client._task for client in broadcaster.clients.values()]
+    await broadcaster.close()
+    await asyncio.gather(*writers, return_exceptions=True)
+    return encodes / BROADCASTS, encode_time / BROADCASTS, publish_time / BROADCASTS
+
+
+async def main() -> None:
+    print(f"codec backend: {codec.BACKEND}")
+    print(f"{'clients':>8} {'encodes/bcast':>14} {'encode us':>10} {'publish us':>11}")
+    for clients in (1, 10, 100, 1000):
+        encodes, encode_time, publish_time = await run(clients)
+        print(f"{clients:>8} {encodes:>14.1f} {encode_time * 1e6:>10.2f} "
+              f"{publish_time * 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
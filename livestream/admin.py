@@ -1,64 +1,155 @@
 from aiohttp import web
-import aiohttp_jinja2
-from aiohttp_session import get_session
 import os
 
+from . import codec
+from .auth import admin_required
+from .pages import ADMIN_CACHE_CONTROL, compressed_response
+from .scheduler import TimeSlot
 
-@aiohttp_jinja2.template('admin-panel.html')
-async def admin_panel(request):
-    session = await get_session(request)
-    if 'user_id' not in session or not session.get('is_admin'):
-        raise web.HTTPForbidden(text='Unauthorized')
 
+@admin_required
+async def admin_panel(request):
+    """The panel, put together from fragments that are each rendered again
+    only when what they show changed: the library, analytics, or what is
+    playing and scheduled."""
     livestream_server = request.app['livestream_server']
-    return {
-        'video_list': livestream_server.video_list,
-        'analytics': livestream_server.analytics.get_analytics(),
-        'current_video': livestream_server.current_video
-    }
+    pages = request.app['pages']
+    analytics = livestream_server.analytics
+    current_video = livestream_server.current_video
+    schedule = livestream_server.scheduler.to_dict()
+    now_playing_key = (current_video and current_video['name'], codec.dumps(schedule))
 
+    def context():
+        return {
+            'now_playing': pages.fragment(
+                'admin/now-playing.html', now_playing_key,
+                lambda: {'current_video': current_video, 'schedule': schedule}),
+            'video_list': pages.fragment(
+                'admin/video-list.html', livestream_server.library_version,
+                lambda: {'video_list': livestream_server.video_list}),
+            'analytics': pages.fragment(
+                'admin/analytics.html', analytics.version,
+                lambda: {'analytics': analytics.get_analytics()}),
+        }
+
+    key = (now_playing_key, livestream_server.library_version, analytics.version)
+    page = pages.page('admin', 'admin-panel.html', key, context, best=False)
+    return compressed_response(request, page, ADMIN_CACHE_CONTROL)
 
-async def add_video(request):
-    session = await get_session(request)
-    if 'user_id' not in session or not session.get('is_admin'):
-        return web.Response(text='Unauthorized', status=401)
 
+@admin_required
+async def add_video(request):
     livestream_server = request.app['livestream_server']
     reader = await request.multipart()
     field = await reader.next()
     if field.name == 'video':
         filename = field.filename
+        path = os.path.join(livestream_server.video_dir, filename)
         size = 0
-        with open(os.path.join('mp4-files', filename), 'wb') as f:
+        with open(path, 'wb') as f:
             while True:
                 chunk = await field.read_chunk()
                 if not chunk:
                     break
                 size += len(chunk)
                 f.write(chunk)
+        await livestream_server.media_index.refresh(path)
         livestream_server.load_video_list()
         return web.Response(text=f"Uploaded {filename} ({size} bytes)")
     return web.Response(text="No video file received", status=400)
 
 
+@admin_required
 async def remove_video(request):
-    session = await get_session(request)
-    if 'user' not in session:
-        return web.Response(text='Unauthorized', status=401)
-
     livestream_server = request.app['livestream_server']
     data = await request.post()
     filename = data['filename']
+    path = os.path.join(livestream_server.video_dir, filename)
     try:
-        os.remove(os.path.join('mp4-files', filename))
+        os.remove(path)
+        await livestream_server.media_index.refresh(path)
         livestream_server.load_video_list()
         return web.Response(text=f"Removed {filename}")
     except FileNotFoundError:
         return web.Response(text=f"File {filename} not found", status=404)
 
 
+def _channel(request):
+    """The channel named by the ``channel`` query parameter, or the main one."""
+    livestream_server = request.app['livestream_server']
+    channel_id = request.query.get('channel')
+    if channel_id is None:
+        return livestream_server
+    if channel_id not in livestream_server.channels:
+        raise web.HTTPNotFound(text=f"Channel {channel_id} not found")
+    return livestream_server.channels[channel_id]
+
+
+@admin_required
+async def get_schedule(request):
+    livestream_server = _channel(request)
+    return web.json_response(livestream_server.scheduler.to_dict())
+
+
+@admin_required
+async def queue_video(request):
+    livestream_server = _channel(request)
+    data = await request.post()
+    try:
+        livestream_server.scheduler.enqueue(data['filename'], front=data.get('front') == '1')
+    except KeyError:
+        return web.Response(text=f"File {data.get('filename')} not found", status=404)
+    livestream_server.plan_next_video()
+    return web.json_response(livestream_server.scheduler.to_dict())
+
+
+@admin_required
+async def unqueue_video(request):
+    livestream_server = _channel(request)
+    data = await request.post()
+    try:
+        if data.get('index') is None:
+            livestream_server.scheduler.clear_queue()
+        else:
+            livestream_server.scheduler.dequeue(int(data['index']))
+    except (ValueError, IndexError):
+        return web.Response(text="Invalid queue index", status=400)
+    livestream_server.plan_next_video()
+    return web.json_response(livestream_server.scheduler.to_dict())
+
+
+@admin_required
+async def set_schedule_mode(request):
+    livestream_server = _channel(request)
+    data = await request.post()
+    try:
+        livestream_server.scheduler.set_mode(data.get('mode', ''))
+    except ValueError as e:
+        return web.Response(text=str(e), status=400)
+    livestream_server.plan_next_video()
+    return web.json_response(livestream_server.scheduler.to_dict())
+
+
+@admin_required
+async def set_schedule_slots(request):
+    """Replace the time slots with a JSON list of {start, end, videos, name}."""
+    livestream_server = _channel(request)
+    try:
+        slots = [TimeSlot.from_dict(slot) for slot in await request.json()]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return web.Response(text=f"Invalid slots: {str(e)}", status=400)
+    livestream_server.scheduler.set_slots(slots)
+    livestream_server.plan_next_video()
+    return web.json_response(livestream_server.scheduler.to_dict())
+
+
 def setup_admin_routes(app, livestream_server):
     app['livestream_server'] = livestream_server
     app.router.add_get("/admin", admin_panel)
     app.router.add_post("/admin/add_video", add_video)
     app.router.add_post("/admin/remove_video", remove_video)
+    app.router.add_get("/admin/schedule", get_schedule)
+    app.router.add_post("/admin/schedule/queue", queue_video)
+    app.router.add_post("/admin/schedule/unqueue", unqueue_video)
+    app.router.add_post("/admin/schedule/mode", set_schedule_mode)
+    app.router.add_post("/admin/schedule/slots", set_schedule_slots)
@@ -1,18 +1,41 @@
+import asyncio
 import time
 
+from . import codec
+from .segment_cache import CachedFile
+from .timeseries import TimeSeriesStore
+
 
 class ImprovedAnalytics:
-    def __init__(self):
+    def __init__(self, database=None):
         self.play_counts = {}
         self.view_durations = {}
         self.peak_viewers = 0
         self.current_viewers = 0
         self.session_start_times = {}
+        self.series = TimeSeriesStore(database)
+        # Kept up to date by the event methods so reads never rebuild it.
+        self.snapshot = {
+            'play_counts': self.play_counts,
+            'view_durations': {},
+            'peak_viewers': 0,
+            'current_viewers': 0,
+        }
+        self.version = 0
+        self._encoded = None
+        self._encoded_version = -1
+
+    def _changed(self):
+        self.snapshot['peak_viewers'] = self.peak_viewers
+        self.snapshot['current_viewers'] = self.current_viewers
+        self.version += 1
 
     def start_session(self, session_id):
         self.session_start_times[session_id] = time.time()
         self.current_viewers += 1
         self.peak_viewers = max(self.peak_viewers, self.current_viewers)
+        self.series.set_gauge('viewers', self.current_viewers)
+        self._changed()
 
     def end_session(self, session_id):
         if session_id in self.session_start_times:
@@ -22,15 +45,43 @@ class ImprovedAnalytics:
                 self, 'current_video') else 'Unknown'
             self.view_durations[current_video] = self.view_durations.get(
                 current_video, 0) + duration
+            self.snapshot['view_durations'][current_video] = round(
+                self.view_durations[current_video], 2)
             self.current_viewers -= 1
+            self.series.set_gauge('viewers', self.current_viewers)
+            self._changed()
 
     def increment_play_count(self, video_name):
         self.play_counts[video_name] = self.play_counts.get(video_name, 0) + 1
+        self._changed()
+
+    def record_segment(self, nbytes):
+        self.series.add('segment_requests')
+        if nbytes:
+            self.series.add('bytes_served', nbytes)
+
+    def record_chat(self):
+        self.series.add('chat_messages')
+
+    async def run(self, flush_interval=60):
+        """Sample gauges every second and flush finished buckets to SQLite."""
+        await self.series.open()
+        self.series.set_gauge('viewers', self.current_viewers)
+        last_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            self.series.tick()
+            if time.monotonic() - last_flush >= flush_interval:
+                last_flush = time.monotonic()
+                await self.series.flush()
 
     def get_analytics(self):
-        return {
-            'play_counts': self.play_counts,
-            'view_durations': {k: round(v, 2) for k, v in self.view_durations.items()},
-            'peak_viewers': self.peak_viewers,
-            'current_viewers': self.current_viewers,
-        }
+        return self.snapshot
+
+    def encoded(self):
+        """The snapshot as JSON, re-encoded only after it changed."""
+        if self._encoded_version != self.version:
+            data = codec.dumps(self.snapshot).encode()
+            self._encoded = CachedFile('analytics.json', data, time.time_ns())
+            self._encoded_version = self.version
+        return self._encoded
@@ -1,19 +1,43 @@
+import functools
 import logging
 import aiosqlite
-import bcrypt
 from aiohttp import web
 from aiohttp_session import get_session
 import json
 
+from .db import Database
+from .hashing import HasherBusy, PasswordHasher
+from .user_cache import UserCache
+
 DATABASE = 'users.db'
 
+# Kept as constants so each pooled connection reuses its prepared statement.
+SELECT_USER_BY_NAME = 'SELECT * FROM users WHERE username = ?'
+SELECT_PROFILE = 'SELECT id, username, email, is_admin FROM users WHERE id = ?'
+INSERT_USER = 'INSERT INTO users (username, password, email) VALUES (?, ?, ?)'
+UPDATE_EMAIL = 'UPDATE users SET email = ? WHERE id = ?'
+
 logger = logging.getLogger(__name__)
 
 
+BUSY_RESPONSE = {'success': False, 'message': 'Server busy, please try again shortly'}
+
+
+def busy_response():
+    return web.json_response(BUSY_RESPONSE, status=429, headers={'Retry-After': '1'})
+
+
 async def init_db(app):
+    if 'db' in app:
+        return
+    hasher = PasswordHasher()
+    app['password_hasher'] = hasher
+    app['user_cache'] = UserCache()
+    db = Database(DATABASE)
     try:
-        async with aiosqlite.connect('users.db') as db:
-            await db.execute('''
+        await db.open()
+        async with db.acquire() as conn:
+            await conn.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     username TEXT UNIQUE NOT NULL,
@@ -22,24 +46,81 @@ async def init_db(app):
                     is_admin BOOLEAN NOT NULL DEFAULT 0
                 )
             ''')
-            await db.commit()
+            await conn.commit()
 
             # Check if admin user exists, if not create it
-            async with db.execute('SELECT * FROM users WHERE username = ?', ('ben',)) as cursor:
+            async with conn.execute(SELECT_USER_BY_NAME, ('ben',)) as cursor:
                 if await cursor.fetchone() is None:
-                    hashed_password = bcrypt.hashpw(
-                        '1234'.encode(), bcrypt.gensalt())
-                    await db.execute(
+                    hashed_password = await hasher.hash('1234')
+                    await conn.execute(
                         'INSERT INTO users (username, password, email, is_admin) VALUES (?, ?, ?, ?)',
                         ('ben', hashed_password, 'admin@example.com', True)
                     )
-                    await db.commit()
+                    await conn.commit()
                     logger.info("Admin user 'ben' created successfully")
                 else:
                     logger.info("Admin user 'ben' already exists")
     except Exception as e:
         logger.error(f"Error initializing database: {str(e)}")
+        await db.close()
         raise
+    app['db'] = db
+
+
+async def close_db(app):
+    db = app.get('db')
+    if db is not None:
+        await db.close()
+    hasher = app.get('password_hasher')
+    if hasher is not None:
+        hasher.shutdown()
+
+
+def _profile(row):
+    return {'id': row[0], 'username': row[1], 'email': row[2], 'is_admin': bool(row[3])}
+
+
+async def current_user(request):
+    """Return the logged-in user's profile, or None.
+
+    The result is kept on the request, so the session cookie is decrypted
+    and the user looked up at most once per request; the lookup itself is
+    served from the app's UserCache when possible.
+    """
+    if 'user' in request:
+        return request['user']
+    user = None
+    session = await get_session(request)
+    user_id = session.get('user_id')
+    if user_id:
+        cache = request.app['user_cache']
+        user = cache.get(user_id)
+        if user is None:
+            row = await request.app['db'].fetchone(SELECT_PROFILE, (user_id,))
+            if row is not None:
+                user = _profile(row)
+                cache.put(user)
+    request['user'] = user
+    return user
+
+
+def login_required(handler):
+    @functools.wraps(handler)
+    async def wrapper(request):
+        if await current_user(request) is None:
+            return web.json_response({'success': False, 'message': 'Not logged in'}, status=401)
+        return await handler(request)
+    return wrapper
+
+
+def admin_required(handler):
+    @functools.wraps(handler)
+    async def wrapper(request):
+        user = await current_user(request)
+        if user is None or not user['is_admin']:
+            raise web.HTTPForbidden(text='Unauthorized')
+        return await handler(request)
+    return wrapper
 
 
 async def register(request):
@@ -51,15 +132,14 @@ async def register(request):
     if not username or not password or not email:
         return web.json_response({'success': False, 'message': 'Missing required fields'}, status=400)
 
-    hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+    try:
+        hashed_password = await request.app['password_hasher'].hash(password)
+    except HasherBusy:
+        return busy_response()
 
     try:
-        async with aiosqlite.connect(DATABASE) as db:
-            await db.execute(
-                'INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
-                (username, hashed_password, email)
-            )
-            await db.commit()
+        await request.app['db'].execute(
+            INSERT_USER, (username, hashed_password, email))
         return web.json_response({'success': True, 'message': 'User registered successfully'})
     except aiosqlite.IntegrityError:
         return web.json_response({'success': False, 'message': 'Username or email already exists'}, status=400)
@@ -74,15 +154,15 @@ async def login(request):
         if not username or not password:
             return web.json_response({'success': False, 'message': 'Missing username or password'}, status=400)
 
-        async with aiosqlite.connect('users.db') as db:
-            async with db.execute('SELECT * FROM users WHERE username = ?', (username,)) as cursor:
-                user = await cursor.fetchone()
+        user = await request.app['db'].fetchone(SELECT_USER_BY_NAME, (username,))
 
-        if user and bcrypt.checkpw(password.encode(), user[2]):
+        if user and await request.app['password_hasher'].check(password, user[2]):
             session = await get_session(request)
             session['user_id'] = user[0]
             session['username'] = user[1]
             session['is_admin'] = bool(user[4])
+            request.app['user_cache'].put(_profile(
+                (user[0], user[1], user[3], user[4])))
             return web.json_response({
                 'success': True,
                 'message': 'Logged in successfully',
@@ -90,6 +170,8 @@ async def login(request):
             })
         else:
             return web.json_response({'success': False, 'message': 'Invalid username or password'}, status=401)
+    except HasherBusy:
+        return busy_response()
     except Exception as e:
         logger.error(f"Error during login: {str(e)}")
         return web.json_response({'success': False, 'message': 'An error occurred during login'}, status=500)
@@ -102,34 +184,19 @@ async def logout(request):
 
 
 async def get_profile(request):
-    session = await get_session(request)
-    user_id = session.get('user_id')
-    if not user_id:
+    user = await current_user(request)
+    if user is None:
+        session = await get_session(request)
+        if session.get('user_id'):
+            # Logged in, but the account has since been deleted.
+            return web.json_response({'success': False, 'message': 'User not found'}, status=404)
         return web.json_response({'success': False, 'message': 'Not logged in'}, status=401)
-
-    async with aiosqlite.connect(DATABASE) as db:
-        async with db.execute('SELECT id, username, email, is_admin FROM users WHERE id = ?', (user_id,)) as cursor:
-            user = await cursor.fetchone()
-
-    if user:
-        return web.json_response({
-            'success': True,
-            'profile': {
-                'id': user[0],
-                'username': user[1],
-                'email': user[2],
-                'is_admin': bool(user[3])
-            }
-        })
-    else:
-        return web.json_response({'success': False, 'message': 'User not found'}, status=404)
+    return web.json_response({'success': True, 'profile': user})
 
 
+@login_required
 async def update_profile(request):
-    session = await get_session(request)
-    user_id = session.get('user_id')
-    if not user_id:
-        return web.json_response({'success': False, 'message': 'Not logged in'}, status=401)
+    user_id = request['user']['id']
 
     data = await request.json()
     email = data.get('email')
@@ -137,17 +204,20 @@ async def update_profile(request):
     if not email:
         return web.json_response({'success': False, 'message': 'Missing email'}, status=400)
 
-    async with aiosqlite.connect(DATABASE) as db:
-        try:
-            await db.execute('UPDATE users SET email = ? WHERE id = ?', (email, user_id))
-            await db.commit()
-            return web.json_response({'success': True, 'message': 'Profile updated successfully'})
-        except aiosqlite.IntegrityError:
-            return web.json_response({'success': False, 'message': 'Email already in use'}, status=400)
+    try:
+        await request.app['db'].execute(UPDATE_EMAIL, (email, user_id))
+        request.app['user_cache'].invalidate(user_id)
+        if 'bus' in request.app:
+            # Other processes cache the profile too.
+            request.app['bus'].send({'op': 'user', 'id': user_id})
+        return web.json_response({'success': True, 'message': 'Profile updated successfully'})
+    except aiosqlite.IntegrityError:
+        return web.json_response({'success': False, 'message': 'Email already in use'}, status=400)
 
 
 def setup_auth(app):
     app.on_startup.append(init_db)
+    app.on_cleanup.append(close_db)
     app.router.add_post('/register', register)
     app.router.add_post('/login', login)
     app.router.add_post('/logout', logout)
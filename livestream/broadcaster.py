@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+
+BATCH_PREFIX = '{"type": "batch", "messages": ['
+BATCH_SUFFIX = ']}'
+
+
+def batch_frame(frames: List[str]) -> str:
+    """One frame carrying several encoded messages."""
+    return BATCH_PREFIX + ', '.join(frames) + BATCH_SUFFIX
+
+
+class ClientChannel:
+    """Bounded outbound queue and writer task for one WebSocket."""
+
+    def __init__(self, ws: web.WebSocketResponse, broadcaster: 'Broadcaster'):
+        self.ws = ws
+        self.broadcaster = broadcaster
+        self.queue: Deque[str] = deque()
+        self.dropped = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, frame: str) -> bool:
+        """Queue a frame without blocking. Returns False if the client was cut off."""
+        if len(self.queue) >= self.broadcaster.max_queue:
+            if self.broadcaster.policy == DISCONNECT:
+                logger.warning("Disconnecting slow WebSocket client")
+                self.stop()
+                # The loop only holds tasks weakly; keep it until it is done.
+                closing = asyncio.create_task(self._close_slow())
+                self.broadcaster.closing.add(closing)
+                closing.add_done_callback(self.broadcaster.closing.discard)
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(frame)
+        self._wakeup.set()
+        return True
+
+    def stop(self) -> None:
+        # The flag also ends the writer if wait_for() swallows the cancel.
+        self.closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.broadcaster.forget(self.ws)
+
+    async def _close_slow(self) -> None:
+        try:
+            await self.ws.close(code=1013, message=b'Too slow to keep up')
+        except Exception as e:
+            logger.error(f"Error closing slow WebSocket client: {str(e)}")
+
+    async def _writer(self) -> None:
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue and not self.closed:
+                    frame = self._coalesce()
+                    await asyncio.wait_for(self.ws.send_str(frame),
+                                           self.broadcaster.send_timeout)
+        except Exception as e:
+            logger.error(f"Error sending to WebSocket client: {str(e)}")
+            self.broadcaster.forget(self.ws)
+            await self.ws.close()
+
+    def _coalesce(self) -> str:
+        """Take everything queued as one frame, batching bursts together.
+
+        A queued batch (such as the chat replay) has its messages spliced
+        in rather than being nested inside the new batch.
+        """
+        if len(self.queue) == 1:
+            return self.queue.popleft()
+        frames = []
+        while self.queue and len(frames) < self.broadcaster.max_batch:
+            frame = self.queue.popleft()
+            if frame.startswith(BATCH_PREFIX):
+                frame = frame[len(BATCH_PREFIX):-len(BATCH_SUFFIX)]
+                if not frame:
+                    continue
+            frames.append(frame)
+        return batch_frame(frames)
+
+
+class Broadcaster:
+    """Fan out already-encoded frames to every connected WebSocket.
+
+    ``publish`` only appends to per-client queues, so it never waits on a
+    socket. Each client has its own writer task that sends whatever has
+    piled up as a single ``batch`` frame. A client whose queue is full
+    either loses its oldest frames or is disconnected, depending on
+    ``policy``. Frames published to a topic only go to clients that
+    subscribed to it.
+    """
+
+    def __init__(self, max_queue: int = 256, policy: str = DROP_OLDEST,
+                 send_timeout: float = 5.0, max_batch: int = 64):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.max_batch = max_batch
+        self.clients: Dict[web.WebSocketResponse, ClientChannel] = {}
+        self.topics: Dict[str, Set[web.WebSocketResponse]] = {}
+        # Close tasks for clients cut off under the DISCONNECT policy.
+        self.closing: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def register(self, ws: web.WebSocketResponse) -> ClientChannel:
+        client = ClientChannel(ws, self)
+        self.clients[ws] = client
+        client.start()
+        return client
+
+    def unregister(self, ws: web.WebSocketResponse) -> None:
+        client = self.clients.get(ws)
+        if client is not None:
+            client.stop()
+
+    def forget(self, ws: web.WebSocketResponse) -> None:
+        self.clients.pop(ws, None)
+        for subscribers in self.topics.values():
+            subscribers.discard(ws)
+
+    def subscribe(self, ws: web.WebSocketResponse, topic: str) -> None:
+        if ws in self.clients:
+            self.topics.setdefault(topic, set()).add(ws)
+
+    def unsubscribe(self, ws: web.WebSocketResponse, topic: str) -> None:
+        self.topics.get(topic, set()).discard(ws)
+
+    def subscribers(self, topic: str) -> int:
+        return len(self.topics.get(topic, ()))
+
+    def publish(self, frame: str, topic: Optional[str] = None) -> None:
+        if topic is None:
+            clients = list(self.clients.values())
+        else:
+            clients = [self.clients[ws] for ws in list(self.topics.get(topic, ()))
+                       if ws in self.clients]
+        for client in clients:
+            client.enqueue(frame)
+
+    def send_to(self, ws: web.WebSocketResponse, frame: str) -> None:
+        client = self.clients.get(ws)
+        if client is not None:
+            client.enqueue(frame)
+
+    async def close(self) -> None:
+        for client in list(self.clients.values()):
+            client.stop()
+            await client.ws.close(code=1001, message=b'Server shutdown')
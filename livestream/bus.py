@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+# A peer whose socket buffer grows past this is too slow and is dropped;
+# it reconnects and is brought up to date again.
+MAX_BUFFERED = 8 * 1024 * 1024
+# Longest message; the analytics snapshot grows with the library.
+MAX_LINE = 4 * 1024 * 1024
+
+Handler = Callable[..., Optional[Awaitable[None]]]
+
+
+def _encode(message: Dict) -> bytes:
+    return codec.dumps(message).encode() + b'\n'
+
+
+async def _dispatch(handlers: Dict[str, Handler], message: Dict, *args) -> None:
+    handler = handlers.get(message.get('op'))
+    if handler is None:
+        logger.warning(f"Unknown bus message: {message.get('op')}")
+        return
+    result = handler(message, *args)
+    if result is not None:
+        await result
+
+
+class BusPeer:
+    """One worker process connected to the bus."""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        # Viewer sessions started through this worker, ended if it goes away.
+        self.sessions: List[str] = []
+
+    def send(self, data: bytes) -> None:
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+            logger.warning("Dropping bus peer that stopped reading")
+            self.writer.close()
+            return
+        self.writer.write(data)
+
+
+class BusServer:
+    """The owner's end of the message bus: a Unix socket workers connect to.
+
+    Messages are JSON objects, one per line, with an ``op`` naming the
+    handler registered with ``on``. ``send`` goes to every worker, so an
+    event is encoded once however many workers there are.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.peers: Set[BusPeer] = set()
+        self.handlers: Dict[str, Handler] = {}
+        self.on_disconnect: Optional[Callable[[BusPeer], None]] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._handlers: Set[asyncio.Task] = set()
+
+    def on(self, op: str, handler: Handler) -> None:
+        """Call ``handler(message, peer)`` for messages with this op."""
+        self.handlers[op] = handler
+
+    async def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._server = await asyncio.start_unix_server(self._serve, self.path,
+                                                       limit=MAX_LINE)
+        logger.info(f"Bus listening on {self.path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for peer in list(self.peers):
+                peer.writer.close()
+            # Let the connection handlers see EOF rather than be cancelled.
+            if self._handlers:
+                await asyncio.wait(self._handlers, timeout=1.0)
+            await self._server.wait_closed()
+            self._server = None
+
+    def send(self, message: Dict) -> None:
+        if self.peers:
+            data = _encode(message)
+            for peer in list(self.peers):
+                peer.send(data)
+
+    def send_to(self, peer: BusPeer, message: Dict) -> None:
+        peer.send(_encode(message))
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = BusPeer(writer)
+        self.peers.add(peer)
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            async for line in reader:
+                try:
+                    await _dispatch(self.handlers, codec.loads(line), peer)
+                except codec.JSONDecodeError:
+                    logger.error("Invalid JSON on the bus")
+                except Exception as e:
+                    logger.exception(f"Error handling bus message: {str(e)}")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            self.peers.discard(peer)
+            writer.close()
+            if self.on_disconnect:
+                self.on_disconnect(peer)
+
+
+class BusClient:
+    """A worker's end of the bus. ``run`` keeps it connected to the owner."""
+
+    def __init__(self, path: str, retry_interval: float = 0.5):
+        self.path = path
+        self.retry_interval = retry_interval
+        self.handlers: Dict[str, Handler] = {}
+        # Called after every (re)connect, e.g. to say hello.
+        self.on_connect: Optional[Callable[[], None]] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    def on(self, op: str, handler: Handler) -> None:
+        """Call ``handler(message)`` for messages with this op."""
+        self.handlers[op] = handler
+
+    def send(self, message: Dict) -> bool:
+        """Send to the owner. Returns False (and drops it) while disconnected."""
+        if not self.connected:
+            return False
+        self._writer.write(_encode(message))
+        return True
+
+    async def run(self) -> None:
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(
+                    self.path, limit=MAX_LINE)
+            except (FileNotFoundError, ConnectionError):
+                await asyncio.sleep(self.retry_interval)
+                continue
+            logger.info(f"Connected to the bus at {self.path}")
+            try:
+                if self.on_connect:
+                    self.on_connect()
+                async for line in reader:
+                    try:
+                        await _dispatch(self.handlers, codec.loads(line))
+                    except codec.JSONDecodeError:
+                        logger.error("Invalid JSON on the bus")
+                    except Exception as e:
+                        logger.exception(f"Error handling bus message: {str(e)}")
+            except ConnectionError:
+                pass
+            finally:
+                self._writer.close()
+                self._writer = None
+            logger.warning("Lost the bus connection; reconnecting")
+            await asyncio.sleep(self.retry_interval)
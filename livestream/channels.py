@@ -0,0 +1,50 @@
+from aiohttp import web
+
+from .pages import channel_page_response
+
+# (path under /channels/{channel}, LivestreamServer handler)
+CHANNEL_ROUTES = (
+    ('/video-state', 'video_state'),
+    ('/chat/history', 'get_chat_history'),
+    ('/hls/master.m3u8', 'hls_master_playlist'),
+    ('/hls/playlist.m3u8', 'hls_playlist'),
+    ('/hls/{segment}', 'hls_segment'),
+    ('/hls/{variant}/playlist.m3u8', 'hls_variant_playlist'),
+    ('/hls/{variant}/{segment}', 'hls_variant_segment'),
+    ('/ws', 'handle_websocket'),
+)
+
+
+def get_channel(request):
+    livestream_server = request.app['livestream_server']
+    channel = livestream_server.channels.get(request.match_info['channel'])
+    if channel is None:
+        raise web.HTTPNotFound(text="Channel not found")
+    return channel
+
+
+def _dispatch(name):
+    async def handler(request):
+        return await getattr(get_channel(request), name)(request)
+    return handler
+
+
+async def list_channels(request):
+    livestream_server = request.app['livestream_server']
+    return web.json_response([
+        {'id': channel.channel_id, 'hls': f'{channel.hls_base}/master.m3u8',
+         'viewers': len(channel.broadcaster), **channel.get_current_state()}
+        for channel in livestream_server.channels.values()
+    ])
+
+
+async def channel_page(request):
+    return channel_page_response(request, get_channel(request))
+
+
+def setup_channel_routes(app, livestream_server):
+    app['livestream_server'] = livestream_server
+    app.router.add_get("/channels", list_channels)
+    app.router.add_get("/channels/{channel}/", channel_page)
+    for path, name in CHANNEL_ROUTES:
+        app.router.add_get(f"/channels/{{channel}}{path}", _dispatch(name))
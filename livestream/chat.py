@@ -0,0 +1,78 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from . import codec
+from .broadcaster import batch_frame
+
+
+class ChatHistory:
+    """Fixed-size ring of recent chat messages, stored already encoded.
+
+    ``append`` is O(1): the oldest message falls off the deque. The replay
+    frame sent to new WebSocket clients uses the same ``batch`` shape as
+    the broadcaster and is only rebuilt when someone asks for it after the
+    history changed.
+    """
+
+    def __init__(self, capacity: int = 100):
+        self.capacity = capacity
+        self.messages: Deque[Tuple[float, str]] = deque(maxlen=capacity)
+        self.version = 0
+        self._replay: Optional[str] = None
+        self._replay_version = -1
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, message: Dict) -> str:
+        """Store a chat message and return its encoded frame."""
+        frame = codec.dumps(message)
+        self.messages.append((message['timestamp'], frame))
+        self.version += 1
+        return frame
+
+    def replay_frame(self) -> Optional[str]:
+        """One frame holding the whole history, or None when it is empty."""
+        if not self.messages:
+            return None
+        if self._replay_version != self.version:
+            self._replay = batch_frame([frame for _, frame in self.messages])
+            self._replay_version = self.version
+        return self._replay
+
+    def page(self, before: Optional[float] = None, limit: int = 50,
+             skip: int = 0) -> Tuple[List[str], Optional[Tuple[float, int]]]:
+        """Return up to ``limit`` encoded messages stamped at or before ``before``.
+
+        ``skip`` leaves out that many of the newest messages stamped exactly
+        ``before``, the ones an earlier page already returned, so messages
+        sharing a timestamp across a page boundary are neither lost nor
+        repeated. Messages come back oldest first. The second value is the
+        ``(before, skip)`` cursor for the next (older) page, or None when
+        there is nothing older.
+        """
+        frames: List[str] = []
+        # The oldest timestamp returned so far and how many messages with
+        # it the client will have, counting those skipped.
+        oldest, at_oldest = before, 0
+        for timestamp, frame in reversed(self.messages):
+            if before is not None and timestamp > before:
+                continue
+            if timestamp == before and at_oldest < skip:
+                at_oldest += 1
+                continue
+            if len(frames) == limit:
+                return frames[::-1], (oldest, at_oldest)
+            frames.append(frame)
+            if timestamp != oldest:
+                oldest, at_oldest = timestamp, 0
+            at_oldest += 1
+        return frames[::-1], None
+
+    def page_body(self, before: Optional[float] = None, limit: int = 50,
+                  skip: int = 0) -> str:
+        frames, cursor = self.page(before, limit, skip)
+        next_before, next_skip = cursor if cursor is not None else (None, 0)
+        return ('{"messages": [' + ', '.join(frames) + '], "next_before": '
+                + codec.dumps(next_before) + ', "next_skip": '
+                + codec.dumps(next_skip) + '}')
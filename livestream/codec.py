@@ -0,0 +1,48 @@
+"""JSON codec for the /ws protocol.
+
+Uses orjson when it is installed and the standard library otherwise. Both
+backends produce compact JSON and raise json.JSONDecodeError (orjson's
+error is a subclass) on bad input.
+"""
+import json
+from typing import Any, Callable, Hashable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSONDecodeError = json.JSONDecodeError
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class EncodedFrame:
+    """A message that is encoded once and reused until its key changes."""
+
+    _UNSET = object()
+
+    def __init__(self, build: Callable[[], Any]):
+        self._build = build
+        self._key: Hashable = self._UNSET
+        self._frame: Optional[str] = None
+
+    def get(self, key: Hashable) -> str:
+        if key != self._key:
+            self._frame = dumps(self._build())
+            self._key = key
+        return self._frame
+
+    def invalidate(self) -> None:
+        self._key = self._UNSET
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA foreign_keys=ON',
+)
+
+
+class Database:
+    """A fixed pool of aiosqlite connections shared for the app's lifetime.
+
+    Each aiosqlite connection owns a worker thread, so opening one per
+    request costs a thread start plus SQLite setup. The pool opens them
+    once. WAL mode lets readers run while a write is in progress, and
+    sqlite3's per-connection statement cache keeps queries prepared as long
+    as callers pass the same SQL text.
+    """
+
+    def __init__(self, path: str, size: int = 4, busy_timeout: float = 5.0,
+                 cached_statements: int = 128):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._connections: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._idle is not None
+
+    async def open(self) -> None:
+        if self.is_open:
+            return
+        idle: asyncio.Queue = asyncio.Queue()
+        try:
+            for _ in range(self.size):
+                conn = await aiosqlite.connect(
+                    self.path, timeout=self.busy_timeout,
+                    cached_statements=self.cached_statements)
+                self._connections.append(conn)
+                for pragma in PRAGMAS:
+                    await conn.execute(pragma)
+                idle.put_nowait(conn)
+        except Exception:
+            await self.close()
+            raise
+        self._idle = idle
+        logger.info(f"Opened {self.size} SQLite connections to {self.path}")
+
+    async def close(self) -> None:
+        connections, self._connections = self._connections, []
+        self._idle = None
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"Error closing SQLite connection: {str(e)}")
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a connection; uncommitted work is rolled back on return."""
+        if self._idle is None:
+            raise RuntimeError('Database is not open')
+        idle = self._idle
+        conn = await idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                await conn.rollback()
+            idle.put_nowait(conn)
+
+    async def fetchone(self, sql: str, params: Iterable = ()) -> Optional[tuple]:
+        async with self.acquire() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def execute(self, sql: str, params: Iterable = ()) -> int:
+        """Run one write statement and commit it. Returns the row count."""
+        async with self.acquire() as conn:
+            async with conn.execute(sql, params) as cursor:
+                rowcount = cursor.rowcount
+            await conn.commit()
+            return rowcount
@@ -0,0 +1,160 @@
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+_KEY_VALUE = re.compile(r'^([a-z0-9_]+)=(.*)$')
+
+# Arguments that make ffmpeg write machine-readable progress to stderr.
+PROGRESS_ARGS = ['-progress', 'pipe:2', '-nostats']
+
+# x264 presets from the default towards the cheapest.
+PRESETS: List[str] = ['veryfast', 'superfast', 'ultrafast']
+
+EXITED = 'exited'
+SLOW = 'slow'
+STALLED = 'stalled'
+
+
+def _float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value.rstrip('x'))
+    except ValueError:
+        return None
+
+
+class FfmpegProgress:
+    """Follows an ffmpeg stderr stream that carries ``-progress`` blocks.
+
+    Progress is reported as ``key=value`` lines ending with a
+    ``progress=continue|end`` line. Anything else is a log line and is kept
+    in a bounded tail for error reports, so a long encode cannot grow
+    memory the way ``communicate()`` does.
+    """
+
+    def __init__(self, tail_lines: int = 50):
+        self.values: Dict[str, str] = {}
+        self.tail: Deque[str] = deque(maxlen=tail_lines)
+        self.blocks = 0
+        self.updated: Optional[float] = None
+        self._block: Dict[str, str] = {}
+        # (monotonic time, out_time) of recent blocks, for current_speed.
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=20)
+
+    @property
+    def speed(self) -> Optional[float]:
+        return _float(self.values.get('speed'))
+
+    @property
+    def fps(self) -> Optional[float]:
+        return _float(self.values.get('fps'))
+
+    @property
+    def out_time(self) -> Optional[float]:
+        """Seconds of output written so far."""
+        out_time_us = _float(self.values.get('out_time_us'))
+        return out_time_us / 1e6 if out_time_us is not None else None
+
+    @property
+    def current_speed(self) -> Optional[float]:
+        """Speed over the last few seconds.
+
+        ffmpeg's own ``speed`` is averaged since the process started, so it
+        is slow to show a machine that has only just fallen behind.
+        """
+        if len(self._samples) < 2:
+            return None
+        (start, start_out), (end, end_out) = self._samples[0], self._samples[-1]
+        if end <= start:
+            return None
+        return (end_out - start_out) / (end - start)
+
+    @property
+    def frame(self) -> Optional[int]:
+        frame = _float(self.values.get('frame'))
+        return int(frame) if frame is not None else None
+
+    def feed_line(self, line: str) -> bool:
+        """Consume one stderr line. Returns True when it completed a block."""
+        match = _KEY_VALUE.match(line)
+        if match is None:
+            if line:
+                self.tail.append(line)
+            return False
+        key, value = match.groups()
+        self._block[key] = value.strip()
+        if key != 'progress':
+            return False
+        self.values = self._block
+        self._block = {}
+        self.blocks += 1
+        self.updated = time.monotonic()
+        if self.out_time is not None:
+            self._samples.append((self.updated, self.out_time))
+        return True
+
+    async def read(self, stream, on_block: Optional[Callable[['FfmpegProgress'], None]] = None) -> None:
+        async for raw in stream:
+            if self.feed_line(raw.decode(errors='replace').rstrip()) and on_block:
+                on_block(self)
+
+    def errors(self) -> str:
+        return '\n'.join(self.tail)
+
+
+class FfmpegSupervisor:
+    """Watches a running ffmpeg through its progress output.
+
+    ``watch`` returns EXITED once the process ends on its own, STALLED if
+    no progress arrives for ``stall_seconds``, or SLOW if the recent encode
+    speed stays below ``min_speed`` for ``slow_seconds``. The caller decides
+    how to restart. The first ``grace_seconds`` are ignored while the
+    encoder warms up.
+    """
+
+    def __init__(self, min_speed: float = 0.98, slow_seconds: float = 10.0,
+                 stall_seconds: float = 15.0, grace_seconds: float = 5.0,
+                 check_interval: float = 1.0):
+        self.min_speed = min_speed
+        self.slow_seconds = slow_seconds
+        self.stall_seconds = stall_seconds
+        self.grace_seconds = grace_seconds
+        self.check_interval = check_interval
+
+    async def watch(self, process: asyncio.subprocess.Process, progress: FfmpegProgress,
+                    on_block: Optional[Callable[[FfmpegProgress], None]] = None) -> str:
+        reader = asyncio.create_task(progress.read(process.stderr, on_block))
+        started = time.monotonic()
+        slow_since = None
+        try:
+            while True:
+                done, _ = await asyncio.wait({reader}, timeout=self.check_interval)
+                if done:
+                    break
+                now = time.monotonic()
+                if now - (progress.updated or started) > self.stall_seconds:
+                    return STALLED
+                speed = progress.current_speed
+                if now - started < self.grace_seconds or speed is None \
+                        or speed >= self.min_speed:
+                    slow_since = None
+                elif slow_since is None:
+                    slow_since = now
+                elif now - slow_since >= self.slow_seconds:
+                    return SLOW
+            await reader
+            await process.wait()
+            return EXITED
+        finally:
+            reader.cancel()
+
+    @staticmethod
+    def faster_preset(preset: str) -> Optional[str]:
+        """The next cheaper x264 preset, or None if already at the cheapest."""
+        if preset not in PRESETS:
+            return PRESETS[0]
+        index = PRESETS.index(preset)
+        return PRESETS[index + 1] if index + 1 < len(PRESETS) else None
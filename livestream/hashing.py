@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusy(Exception):
+    """Raised instead of queueing when too many hash jobs are pending."""
+
+
+class PasswordHasher:
+    """Run bcrypt off the event loop with a cap on queued work.
+
+    bcrypt releases the GIL while it works, so a small thread pool keeps
+    hashing from blocking segment serving and chat. At most ``max_pending``
+    jobs may be running or waiting; beyond that callers get HasherBusy
+    straight away rather than joining a queue that only grows during a
+    login storm.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 16):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherBusy()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> bytes:
+        return await self._run(self._hash, password.encode())
+
+    async def check(self, password: str, hashed: bytes) -> bool:
+        return await self._run(bcrypt.checkpw, password.encode(), hashed)
+
+    @staticmethod
+    def _hash(password: bytes) -> bytes:
+        return bcrypt.hashpw(password, bcrypt.gensalt())
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,131 @@
+import os
+import zlib
+from typing import Dict, List
+
+from .segment_cache import CachedFile, SegmentCache
+from .segment_watcher import SegmentWatcher
+
+# Rungs are listed best first. A rung at the pipeline's own height is
+# stream-copied; the others are scaled from a shared split filter and
+# encoded live with x264 for as long as the channel runs.
+SOURCE_RUNG: Dict = {'name': '720p', 'height': 720, 'video_bitrate': '2800k'}
+AUDIO_RUNG: Dict = {'name': 'audio', 'audio_only': True}
+SCALED_RUNGS: List[Dict] = [
+    {'name': '480p', 'height': 480, 'video_bitrate': '1400k'},
+    {'name': '360p', 'height': 360, 'video_bitrate': '800k'},
+]
+
+# Copy-only, so the muxer encodes nothing. That leaves no lower video
+# rung: a player that cannot keep up with 720p can only drop to audio, so
+# adaptive bitrate is effectively off. FULL_LADDER turns it on, at the
+# cost of encoding the scaled rungs live for every channel.
+DEFAULT_LADDER: List[Dict] = [SOURCE_RUNG, AUDIO_RUNG]
+FULL_LADDER: List[Dict] = [SOURCE_RUNG, *SCALED_RUNGS, AUDIO_RUNG]
+
+AUDIO_BITRATE = '128k'
+AUDIO_CODECS = 'mp4a.40.2'
+# H.264 High profile at level 3.1, which covers 720p30 and every rung below it.
+VIDEO_CODECS = f'avc1.64001f,{AUDIO_CODECS}'
+
+# What a stream-copied source must be for those codec strings to hold, as
+# ffprobe names them: H.264 profiles a High decoder plays, at most level
+# 3.1, and AAC-LC (mp4a.40.2) audio.
+H264_PROFILES = ('Constrained Baseline', 'Main', 'High')
+H264_MAX_LEVEL = 31
+AAC_PROFILE = 'LC'
+
+
+def _bits(rate: str) -> int:
+    """Convert an ffmpeg bitrate such as '2800k' to bits per second."""
+    multipliers = {'k': 1000, 'm': 1000 * 1000}
+    suffix = rate[-1].lower()
+    if suffix in multipliers:
+        return int(float(rate[:-1]) * multipliers[suffix])
+    return int(rate)
+
+
+def ladder_args(ladder: List[Dict], source_height: int) -> List[str]:
+    """Return the ffmpeg mapping, filter and codec arguments for a ladder.
+
+    Everything is produced by one ffmpeg from a single decode: scaled rungs
+    share a ``split`` filter and keep their keyframes on the source's, so
+    every variant cuts segments at the same points.
+    """
+    scaled = [r for r in ladder
+              if not r.get('audio_only') and r['height'] != source_height]
+    args: List[str] = []
+    if scaled:
+        outputs = ''.join(f'[s{i}]' for i in range(len(scaled)))
+        chains = [f'[0:v]split={len(scaled)}{outputs}'] if len(scaled) > 1 else []
+        for i, rung in enumerate(scaled):
+            source = f'[s{i}]' if len(scaled) > 1 else '[0:v]'
+            chains.append(f'{source}scale=-2:{rung["height"]}[v{i}]')
+        args += ['-filter_complex', ';'.join(chains)]
+
+    stream_map = []
+    video_index = 0
+    audio_index = 0
+    for rung in ladder:
+        if rung.get('audio_only'):
+            args += ['-map', '0:a']
+            stream_map.append(f'a:{audio_index},name:{rung["name"]}')
+        else:
+            if rung['height'] == source_height:
+                args += ['-map', '0:v', f'-c:v:{video_index}', 'copy']
+            else:
+                label = f'[v{scaled.index(rung)}]'
+                args += [
+                    '-map', label,
+                    f'-c:v:{video_index}', 'libx264',
+                    f'-b:v:{video_index}', rung['video_bitrate'],
+                    f'-maxrate:v:{video_index}', rung['video_bitrate'],
+                    f'-bufsize:v:{video_index}', rung['video_bitrate'],
+                ]
+            args += ['-map', '0:a']
+            stream_map.append(
+                f'v:{video_index},a:{audio_index},name:{rung["name"]}')
+            video_index += 1
+        audio_index += 1
+
+    args += [
+        '-preset', 'veryfast',
+        '-tune', 'zerolatency',
+        '-force_key_frames', 'source',
+        '-c:a', 'copy',
+        '-var_stream_map', ' '.join(stream_map),
+    ]
+    return args
+
+
+def master_playlist(ladder: List[Dict], width: int, height: int) -> str:
+    """Build the HLS master playlist for a ladder, best rung first."""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    audio_bits = _bits(AUDIO_BITRATE)
+    for rung in ladder:
+        if rung.get('audio_only'):
+            lines.append(
+                f'#EXT-X-STREAM-INF:BANDWIDTH={audio_bits},CODECS="{AUDIO_CODECS}"')
+        else:
+            rung_width = round(width * rung['height'] / height / 2) * 2
+            bandwidth = _bits(rung['video_bitrate']) + audio_bits
+            lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},'
+                         f'RESOLUTION={rung_width}x{rung["height"]},'
+                         f'CODECS="{VIDEO_CODECS}"')
+        lines.append(f'{rung["name"]}/playlist.m3u8')
+    return '\n'.join(lines) + '\n'
+
+
+def master_playlist_file(text: str) -> CachedFile:
+    data = text.encode()
+    return CachedFile('master.m3u8', data, zlib.crc32(data))
+
+
+class HlsVariant:
+    """Segment cache and watcher for one rung's output directory."""
+
+    def __init__(self, name: str, output_dir: str, max_segments: int = 20):
+        self.name = name
+        self.directory = os.path.join(output_dir, name)
+        self.segment_cache = SegmentCache(self.directory, max_segments=max_segments)
+        self.segment_watcher = SegmentWatcher(self.directory)
+        self.segment_watcher.attach_cache(self.segment_cache)
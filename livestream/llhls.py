@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import math
+import os
+import re
+import struct
+import time
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Tuple
+
+from .segment_cache import CachedFile, SegmentCache
+from .segment_watcher import SegmentWatcher, PLAYLIST_UPDATED
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_IS_NON_SYNC = 0x00010000
+
+
+def _boxes(data: bytes, start: int = 0,
+           end: Optional[int] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """Yield (type, payload start, box end) for the ISO-BMFF boxes in a range."""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield kind, start + header, start + size
+        start += size
+
+
+def _first_sample_flags(data: bytes, start: int, end: int) -> Optional[int]:
+    """Return the sample flags of the first sample in a ``traf`` box."""
+    default_flags = None
+    for kind, box, _ in _boxes(data, start, end):
+        flags = struct.unpack_from('>I', data, box)[0] & 0xffffff
+        if kind == b'tfhd':
+            offset = box + 8
+            for bit, size in ((0x01, 8), (0x02, 4), (0x08, 4), (0x10, 4)):
+                if flags & bit:
+                    offset += size
+            if flags & 0x20:
+                default_flags = struct.unpack_from('>I', data, offset)[0]
+        elif kind == b'trun':
+            offset = box + 8
+            if flags & 0x01:
+                offset += 4
+            if flags & 0x04:
+                return struct.unpack_from('>I', data, offset)[0]
+            if flags & 0x400:
+                if flags & 0x100:
+                    offset += 4
+                if flags & 0x200:
+                    offset += 4
+                return struct.unpack_from('>I', data, offset)[0]
+    return default_flags
+
+
+def fragment_is_independent(data: bytes) -> bool:
+    """True if every track in an fMP4 fragment starts on a sync sample."""
+    for kind, start, end in _boxes(data):
+        if kind != b'moof':
+            continue
+        for kind, traf_start, traf_end in _boxes(data, start, end):
+            if kind == b'traf':
+                flags = _first_sample_flags(data, traf_start, traf_end)
+                if flags is not None and flags & SAMPLE_IS_NON_SYNC:
+                    return False
+        return True
+    return False
+
+
+def parse_playlist_entries(text: str) -> List[Tuple[str, float, bool]]:
+    """Return (uri, duration, discontinuity) for each entry of a media playlist."""
+    entries = []
+    duration = 0.0
+    discontinuity = False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line == '#EXT-X-DISCONTINUITY':
+            discontinuity = True
+        elif line and not line.startswith('#'):
+            entries.append((line, duration, discontinuity))
+            duration = 0.0
+            discontinuity = False
+    return entries
+
+
+class Part:
+    """One partial segment as written by ffmpeg."""
+
+    __slots__ = ('name', 'duration', 'independent', 'file')
+
+    def __init__(self, name: str, duration: float, independent: bool, file: CachedFile):
+        self.name = name
+        self.duration = duration
+        self.independent = independent
+        self.file = file
+
+
+class LowLatencySegment:
+    """A full media segment made of consecutive parts."""
+
+    __slots__ = ('msn', 'parts', 'discontinuity', 'file')
+
+    def __init__(self, msn: int, discontinuity: bool):
+        self.msn = msn
+        self.parts: List[Part] = []
+        self.discontinuity = discontinuity
+        self.file: Optional[CachedFile] = None
+
+    @property
+    def name(self) -> str:
+        return f'segment{self.msn}.m4s'
+
+    @property
+    def duration(self) -> float:
+        return sum(p.duration for p in self.parts)
+
+    def close(self) -> None:
+        data = b''.join(p.file.data for p in self.parts)
+        self.file = CachedFile(self.name, data, int(self.parts[-1].file.mtime * 1e9))
+
+
+class LowLatencyPlaylist:
+    """Builds an LL-HLS playlist from the short fMP4 segments ffmpeg writes.
+
+    ffmpeg cannot emit ``#EXT-X-PART`` itself, so it is run with a segment
+    length of one part. Each of its segments becomes a partial segment here,
+    and consecutive parts are grouped into full media segments that start on
+    a keyframe wherever the source allows it. Blocking playlist reloads wait
+    on ``changed`` instead of polling.
+    """
+
+    def __init__(self, cache: SegmentCache, segment_target: float,
+                 part_target: float, window: int = 20, init_name: str = 'init.mp4'):
+        self.cache = cache
+        self.segment_target = segment_target
+        self.part_target = part_target
+        self.window = window
+        self.init_name = init_name
+        self.segments: Deque[LowLatencySegment] = deque()
+        self.open: Optional[LowLatencySegment] = None
+        self.next_msn = 0
+        self.discontinuity_sequence = 0
+        self.playlist: Optional[CachedFile] = None
+        self.changed = asyncio.Condition()
+        self._last_part: Optional[str] = None
+
+    def attach(self, watcher: SegmentWatcher) -> None:
+        """Rebuild whenever ffmpeg's playlist changes.
+
+        Must be attached after the cache, so the parts are already loaded.
+        """
+        def on_event(event: str, name: str) -> None:
+            if event == PLAYLIST_UPDATED and self.cache.playlist is not None:
+                if self.ingest(self.cache.playlist.data.decode(errors='replace')):
+                    asyncio.get_running_loop().create_task(self._notify())
+        watcher.subscribe(on_event)
+
+    async def _notify(self) -> None:
+        async with self.changed:
+            self.changed.notify_all()
+
+    def ingest(self, text: str) -> bool:
+        """Add the parts ffmpeg listed since the last call. Returns True on change."""
+        entries = parse_playlist_entries(text)
+        names = [name for name, _, _ in entries]
+        if self._last_part in names:
+            entries = entries[names.index(self._last_part) + 1:]
+        else:
+            known = {p.name for s in list(self.segments) + [self.open] if s
+                     for p in s.parts}
+            entries = [e for e in entries if e[0] not in known]
+        if not entries:
+            return False
+
+        for name, duration, discontinuity in entries:
+            file = self.cache.get_segment(name) or self.cache.add_segment(name)
+            if file is None:
+                continue
+            self._add_part(Part(name, duration, fragment_is_independent(file.data), file),
+                           discontinuity)
+            self._last_part = name
+        self.render()
+        return True
+
+    def _add_part(self, part: Part, discontinuity: bool) -> None:
+        self.part_target = max(self.part_target, part.duration)
+        current = self.open
+        if current is not None and current.parts:
+            due = current.duration + part.duration / 2 >= self.segment_target
+            overdue = current.duration >= 2 * self.segment_target
+            if discontinuity or (due and part.independent) or overdue:
+                self._close_open()
+        if self.open is None:
+            self.open = LowLatencySegment(self.next_msn, discontinuity)
+            self.next_msn += 1
+        self.open.parts.append(part)
+
+    def _close_open(self) -> None:
+        self.open.close()
+        self.segments.append(self.open)
+        self.open = None
+        while len(self.segments) > self.window:
+            if self.segments.popleft().discontinuity:
+                self.discontinuity_sequence += 1
+
+    def has(self, msn: int, part: Optional[int] = None) -> bool:
+        """True once part ``part`` of segment ``msn`` (or the whole segment) exists."""
+        if self.open is None or msn < self.open.msn:
+            return msn < self.next_msn
+        if msn > self.open.msn or part is None:
+            return False
+        return part < len(self.open.parts)
+
+    async def wait_for(self, msn: int, part: Optional[int], timeout: float) -> bool:
+        async def ready() -> None:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.has(msn, part))
+        try:
+            await asyncio.wait_for(ready(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @property
+    def next_part_name(self) -> Optional[str]:
+        """Name ffmpeg will give the next part, for the preload hint."""
+        if self._last_part is None:
+            return None
+        stem, ext = os.path.splitext(self._last_part)
+        match = re.search(r'\d+$', stem)
+        if match is None:
+            return None
+        number = str(int(match.group()) + 1).zfill(len(match.group()))
+        return stem[:match.start()] + number + ext
+
+    def get_segment(self, name: str) -> Optional[CachedFile]:
+        for segment in self.segments:
+            if segment.name == name:
+                return segment.file
+        return None
+
+    def render(self) -> None:
+        segments = list(self.segments)
+        durations = [s.duration for s in segments] + [self.segment_target]
+        first_msn = segments[0].msn if segments else (
+            self.open.msn if self.open else 0)
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:9',
+            f'#EXT-X-TARGETDURATION:{math.ceil(max(durations))}',
+            '#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,'
+            f'PART-HOLD-BACK={3 * self.part_target:.3f}',
+            f'#EXT-X-PART-INF:PART-TARGET={self.part_target:.3f}',
+            f'#EXT-X-MEDIA-SEQUENCE:{first_msn}',
+        ]
+        if self.discontinuity_sequence:
+            lines.append(f'#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_sequence}')
+        lines.append(f'#EXT-X-MAP:URI="{self.init_name}"')
+
+        # Parts are only advertised for the last few segments.
+        with_parts = {s.msn for s in segments[-2:]}
+        for segment in segments:
+            if segment.discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            if segment.msn in with_parts:
+                lines.extend(self._part_lines(segment))
+            lines.append(f'#EXTINF:{segment.duration:.3f},')
+            lines.append(segment.name)
+        if self.open is not None:
+            if self.open.discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.extend(self._part_lines(self.open))
+        if self.next_part_name is not None:
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{self.next_part_name}"')
+
+        data = ('\n'.join(lines) + '\n').encode()
+        self.playlist = CachedFile('playlist.m3u8', data, time.time_ns())
+
+    @staticmethod
+    def _part_lines(segment: LowLatencySegment) -> List[str]:
+        return [
+            f'#EXT-X-PART:DURATION={p.duration:.3f},URI="{p.name}"'
+            + (',INDEPENDENT=YES' if p.independent else '')
+            for p in segment.parts
+        ]
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+from . import codec
+from .db import Database
+from .prefetch import mp4_duration
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('path', 'mtime', 'size', 'duration', 'bitrate', 'video_codec', 'pix_fmt',
+           'width', 'height', 'frame_rate', 'keyframe_interval', 'audio_codec',
+           'sample_rate', 'channels', 'probed_at', 'video_profile', 'video_level',
+           'audio_profile')
+
+CREATE_MEDIA = '''
+    CREATE TABLE IF NOT EXISTS media (
+        path TEXT PRIMARY KEY,
+        mtime REAL NOT NULL,
+        size INTEGER NOT NULL,
+        duration REAL,
+        bitrate INTEGER,
+        video_codec TEXT,
+        pix_fmt TEXT,
+        width INTEGER,
+        height INTEGER,
+        frame_rate REAL,
+        keyframe_interval REAL,
+        audio_codec TEXT,
+        sample_rate INTEGER,
+        channels INTEGER,
+        probed_at REAL,
+        video_profile TEXT,
+        video_level INTEGER,
+        audio_profile TEXT
+    )
+'''
+SELECT_MEDIA = f'SELECT {", ".join(COLUMNS)} FROM media'
+UPSERT_MEDIA = (f'INSERT OR REPLACE INTO media ({", ".join(COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(COLUMNS))})')
+DELETE_MEDIA = 'DELETE FROM media WHERE path = ?'
+
+FFPROBE_ARGS = ['-v', 'error', '-print_format', 'json', '-show_format', '-show_streams']
+# Video packet timestamps and flags; demuxing only, nothing is decoded.
+KEYFRAME_ARGS = ['-v', 'error', '-select_streams', 'v:0',
+                 '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0']
+
+
+def _number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _rate(value: Optional[str]) -> Optional[float]:
+    """ffprobe frame rates are fractions such as ``30000/1001``."""
+    if not value:
+        return None
+    num, _, den = value.partition('/')
+    num, den = _number(num), _number(den or 1)
+    return num / den if num is not None and den else None
+
+
+def parse_keyframes(output: bytes) -> Optional[float]:
+    """Longest gap in seconds between keyframes in ffprobe packet CSV output."""
+    keyframes = []
+    for line in output.decode(errors='replace').splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            pts = _number(pts_time)
+            if pts is not None:
+                keyframes.append(pts)
+    if not keyframes:
+        return None
+    keyframes.sort()
+    if len(keyframes) == 1:
+        return float('inf')
+    return max(b - a for a, b in zip(keyframes, keyframes[1:]))
+
+
+def parse_ffprobe(output: bytes) -> Dict:
+    """Pick the fields the server uses out of ffprobe's JSON output."""
+    data = codec.loads(output)
+    fmt = data.get('format', {})
+    info = {
+        'duration': _number(fmt.get('duration')),
+        'bitrate': _number(fmt.get('bit_rate'), int),
+    }
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is not None:
+        info.update(video_codec=video.get('codec_name'), pix_fmt=video.get('pix_fmt'),
+                    video_profile=video.get('profile'),
+                    video_level=_number(video.get('level'), int),
+                    width=video.get('width'), height=video.get('height'),
+                    frame_rate=_rate(video.get('avg_frame_rate') or video.get('r_frame_rate')))
+    if audio is not None:
+        info.update(audio_codec=audio.get('codec_name'),
+                    audio_profile=audio.get('profile'),
+                    sample_rate=_number(audio.get('sample_rate'), int),
+                    channels=audio.get('channels'))
+    return info
+
+
+class MediaIndex:
+    """Library of videos with their probed metadata, kept in SQLite.
+
+    Rows are keyed by path and remember the file's mtime and size, so a
+    scan only has to stat the directory: unchanged files keep their
+    metadata and new or modified ones are queued for ffprobe on a small
+    pool of workers. Startup is one SELECT plus a ``scandir``, regardless
+    of how many files there are or whether they have been probed yet.
+    """
+
+    def __init__(self, database: Database, video_dir: str, workers: int = 2,
+                 scan_interval: float = 10.0):
+        self.database = database
+        self.video_dir = video_dir
+        self.workers = workers
+        self.scan_interval = scan_interval
+        self.entries: Dict[str, Dict] = {}
+        # Called with no arguments after a rescan changed the library, and
+        # with the path after a file's metadata was probed.
+        self.on_change = None
+        self.on_probed = None
+        self._pending: asyncio.Queue = asyncio.Queue()
+        self._queued: Set[str] = set()
+        self._dir_mtime: Optional[float] = None
+        self._ffprobe_missing = False
+
+    async def open(self) -> None:
+        await self.database.open()
+        async with self.database.acquire() as conn:
+            await conn.execute(CREATE_MEDIA)
+            async with conn.execute('PRAGMA table_info(media)') as cursor:
+                existing = {row[1] for row in await cursor.fetchall()}
+            missing = [column for column in COLUMNS if column not in existing]
+            for column in missing:
+                await conn.execute(f'ALTER TABLE media ADD COLUMN {column}')
+            if missing:
+                # Rows probed before the column existed are probed again.
+                await conn.execute('UPDATE media SET probed_at = NULL')
+            await conn.commit()
+            async with conn.execute(SELECT_MEDIA) as cursor:
+                rows = await cursor.fetchall()
+        self.entries = {row[0]: dict(zip(COLUMNS, row)) for row in rows}
+        await self.scan()
+
+    async def close(self) -> None:
+        await self.database.close()
+
+    def videos(self) -> List[Dict[str, str]]:
+        """The library as the ``{'name', 'path'}`` dicts the server plays."""
+        return [{'name': os.path.basename(path), 'path': path}
+                for path in sorted(self.entries)]
+
+    def get(self, path: str) -> Optional[Dict]:
+        return self.entries.get(path)
+
+    def duration(self, path: str) -> Optional[float]:
+        entry = self.entries.get(path)
+        return entry['duration'] if entry else None
+
+    async def scan(self) -> bool:
+        """Bring the index in line with the directory. Returns True on change."""
+        try:
+            self._dir_mtime = os.stat(self.video_dir).st_mtime
+            found = {}
+            with os.scandir(self.video_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.mp4') and entry.is_file():
+                        st = entry.stat()
+                        found[os.path.join(self.video_dir, entry.name)] = (st.st_mtime, st.st_size)
+        except OSError as e:
+            logger.error(f"Error scanning {self.video_dir}: {str(e)}")
+            return False
+        removed = [path for path in self.entries if path not in found]
+        for path in removed:
+            del self.entries[path]
+        added = [entry for entry in (self._track(path, mtime, size)
+                                     for path, (mtime, size) in found.items()) if entry]
+        if not (removed or added):
+            return False
+        # One transaction for the whole scan; a first scan of a large
+        # library would otherwise pay a commit per file.
+        async with self.database.acquire() as conn:
+            await conn.executemany(DELETE_MEDIA, [(path,) for path in removed])
+            await conn.executemany(UPSERT_MEDIA, [self._row(entry) for entry in added])
+            await conn.commit()
+        logger.info(f"Media index holds {len(self.entries)} videos "
+                    f"({len(added)} new or changed, {len(removed)} removed)")
+        return True
+
+    async def refresh(self, path: str) -> bool:
+        """Update a single file after it was added, replaced or removed."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if self.entries.pop(path, None) is None:
+                return False
+            await self.database.execute(DELETE_MEDIA, (path,))
+            return True
+        entry = self._track(path, st.st_mtime, st.st_size)
+        if entry is None:
+            return False
+        await self._save(entry)
+        return True
+
+    def _track(self, path: str, mtime: float, size: int) -> Optional[Dict]:
+        """Queue a file for probing; returns its new entry if it is new or changed."""
+        entry = self.entries.get(path)
+        if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+            if entry['probed_at'] is None:
+                self._queue_probe(path)
+            return None
+        entry = dict.fromkeys(COLUMNS)
+        entry.update(path=path, mtime=mtime, size=size)
+        self.entries[path] = entry
+        self._queue_probe(path)
+        return entry
+
+    def _queue_probe(self, path: str) -> None:
+        if path not in self._queued:
+            self._queued.add(path)
+            self._pending.put_nowait(path)
+
+    @staticmethod
+    def _row(entry: Dict) -> tuple:
+        return tuple(entry[column] for column in COLUMNS)
+
+    async def _save(self, entry: Dict) -> None:
+        await self.database.execute(UPSERT_MEDIA, self._row(entry))
+
+    async def run(self) -> None:
+        """Probe queued files and rescan whenever the directory changes."""
+        workers = [asyncio.create_task(self._probe_worker()) for _ in range(self.workers)]
+        try:
+            while True:
+                await asyncio.sleep(self.scan_interval)
+                try:
+                    if os.stat(self.video_dir).st_mtime != self._dir_mtime \
+                            and await self.scan() and self.on_change:
+                        self.on_change()
+                except OSError as e:
+                    logger.error(f"Error checking {self.video_dir}: {str(e)}")
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _probe_worker(self) -> None:
+        while True:
+            path = await self._pending.get()
+            self._queued.discard(path)
+            entry = self.entries.get(path)
+            if entry is None or entry['probed_at'] is not None:
+                continue
+            try:
+                info = await self.probe(path)
+            except Exception as e:
+                logger.error(f"Error probing {path}: {str(e)}")
+                info = {}
+            # The file may have changed or gone while it was probed.
+            if self.entries.get(path) is not entry:
+                continue
+            entry.update(info, probed_at=time.time())
+            try:
+                await self._save(entry)
+            except Exception as e:
+                logger.error(f"Error saving metadata for {path}: {str(e)}")
+                continue
+            logger.debug(f"Probed {path}: {info}")
+            if self.on_probed:
+                self.on_probed(path)
+
+    async def probe(self, path: str, timeout: float = 30.0) -> Dict:
+        if not self._ffprobe_missing:
+            try:
+                info = parse_ffprobe(await self._ffprobe(FFPROBE_ARGS, path, timeout))
+                if info.get('video_codec'):
+                    info['keyframe_interval'] = parse_keyframes(
+                        await self._ffprobe(KEYFRAME_ARGS, path, timeout * 4))
+                return info
+            except FileNotFoundError:
+                logger.warning("ffprobe not found; only durations will be indexed")
+                self._ffprobe_missing = True
+        loop = asyncio.get_running_loop()
+        return {'duration': await loop.run_in_executor(None, mp4_duration, path)}
+
+    @staticmethod
+    async def _ffprobe(args: List[str], path: str, timeout: float) -> bytes:
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', *args, path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RuntimeError('ffprobe timed out')
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='replace').strip())
+        return stdout
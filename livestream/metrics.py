@@ -0,0 +1,222 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Container, Dict, Hashable, List, Optional, Tuple
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _key(labels) -> Labels:
+    """A label tuple back from its JSON form, a list of pairs."""
+    return tuple((k, v) for k, v in labels)
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two increments."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: Labels) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(labels, ("le", _number(bound)))} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(self.sum)}')
+        lines.append(f'{name}_count{_labels(labels)} {self.count}')
+        return lines
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in Prometheus text format.
+
+    Everything is plain dicts keyed by a label tuple, updated in place on
+    the event loop; there is no locking because nothing runs off-loop.
+    Gauges can also be callables, read only when /metrics is scraped.
+
+    Other processes (see livestream.workers) report with ``snapshot``:
+    their counters and histograms are added in with ``add``, and their
+    latest gauge readings, kept in ``remote_gauges``, are summed with
+    this process's own when rendering.
+    """
+
+    def __init__(self):
+        self.help: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.gauge_callbacks: Dict[str, Dict[Labels, Callable[[], float]]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.remote_gauges: Dict[Hashable, List] = {}
+
+    def describe(self, name: str, kind: str, text: str) -> None:
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def gauge_callback(self, name: str, callback: Callable[[], float], **labels: str) -> None:
+        self.gauge_callbacks.setdefault(name, {})[tuple(sorted(labels.items()))] = callback
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def get(self, name: str, **labels: str) -> float:
+        key = tuple(sorted(labels.items()))
+        return self.counters.get(name, {}).get(key, 0)
+
+    def snapshot(self) -> Dict[str, List]:
+        """Everything recorded, as JSON-friendly lists; gauge callbacks are read now."""
+        gauges = [[name, labels, value] for name, series in self.gauges.items()
+                  for labels, value in series.items()]
+        gauges += [[name, labels, callback()] for name, callbacks in self.gauge_callbacks.items()
+                   for labels, callback in callbacks.items()]
+        return {
+            'counters': [[name, labels, value] for name, series in self.counters.items()
+                         for labels, value in series.items()],
+            'histograms': [[name, labels, h.counts, h.sum, h.count]
+                           for name, series in self.histograms.items()
+                           for labels, h in series.items()],
+            'gauges': gauges,
+        }
+
+    def reset(self) -> None:
+        """Forget counters and histograms, e.g. once they were reported."""
+        self.counters.clear()
+        self.histograms.clear()
+
+    def add(self, snapshot: Dict[str, List]) -> None:
+        """Add the counters and histograms of another process's snapshot to these."""
+        for name, labels, value in snapshot['counters']:
+            self.inc(name, value, **dict(labels))
+        for name, labels, counts, total, count in snapshot['histograms']:
+            series = self.histograms.setdefault(name, {})
+            key = _key(labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+
+    def _gauge_values(self) -> Dict[str, Dict[Labels, float]]:
+        values = {name: dict(series) for name, series in self.gauges.items()}
+        for name, callbacks in self.gauge_callbacks.items():
+            values.setdefault(name, {}).update(
+                (labels, callback()) for labels, callback in callbacks.items())
+        for readings in self.remote_gauges.values():
+            for name, labels, value in readings:
+                series = values.setdefault(name, {})
+                key = _key(labels)
+                series[key] = series.get(key, 0) + value
+        return values
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def header(name: str, default_kind: str) -> None:
+            kind, text = self.help.get(name, (default_kind, ''))
+            if text:
+                lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for name, series in self.counters.items():
+            header(name, 'counter')
+            for labels, value in series.items():
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        for name, series in self._gauge_values().items():
+            header(name, 'gauge')
+            for labels, value in series.items():
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        for name, series in self.histograms.items():
+            header(name, 'histogram')
+            for labels, histogram in series.items():
+                lines.extend(histogram.render(name, labels))
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_middleware(metrics: Metrics, exclude: Container[str] = ()):
+    """Time every request and count responses and bytes by route.
+
+    Routes in ``exclude`` (by their canonical path) are not recorded.
+    """
+    metrics.describe('livestream_http_request_duration_seconds', 'histogram',
+                     'Time spent in the request handler.')
+    metrics.describe('livestream_http_requests_total', 'counter',
+                     'Requests by route, method and status.')
+    metrics.describe('livestream_http_response_bytes_total', 'counter',
+                     'Body bytes of responses with a known length.')
+
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        start = time.perf_counter()
+        status = 500
+        response = None
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        except asyncio.CancelledError:
+            status = 499  # client went away
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else 'unmatched'
+            if route not in exclude:
+                metrics.observe('livestream_http_request_duration_seconds',
+                                time.perf_counter() - start, route=route)
+                metrics.inc('livestream_http_requests_total', route=route,
+                            method=request.method, status=str(status))
+                length = getattr(response, 'content_length', None)
+                if length:
+                    metrics.inc('livestream_http_response_bytes_total', length, route=route)
+    return middleware
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    metrics: Metrics = request.app['metrics']
+    return web.Response(body=metrics.render().encode(), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -0,0 +1,201 @@
+"""HTML pages and static assets, rendered and compressed ahead of time.
+
+A page is rendered once per version key and compressed once per render:
+gzip always, brotli too when the ``brotli`` package is installed. A request
+then only picks the encoding the client accepts. The player pages never
+change and are rendered at startup; the admin panel is put together from
+fragments that are each re-rendered only when what they show changes, so
+a viewer joining does not re-render the whole video library.
+"""
+import gzip
+import logging
+import os
+import zlib
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import aiohttp_jinja2
+import jinja2
+from aiohttp import hdrs, web
+from markupsafe import Markup
+
+from .segment_cache import CachedFile, not_modified
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Served from /static/ when vendored there (scripts/fetch_hls_js.py puts
+# it there); the same pinned build from the CDN otherwise.
+HLS_JS = 'hls.min.js'
+HLS_JS_VERSION = '1.5.20'
+HLS_JS_CDN = f'https://cdn.jsdelivr.net/npm/hls.js@{HLS_JS_VERSION}/dist/{HLS_JS}'
+# Subresource Integrity hash of that build as published for the release
+# (jsDelivr lists it per file). Browsers check whichever copy they load
+# against it, and the fetch script will not vendor a file that differs.
+# Left empty, nothing is checked; set it whenever HLS_JS_VERSION changes.
+HLS_JS_INTEGRITY = ''
+
+ASSET_CACHE_CONTROL = 'public, max-age=86400'
+PAGE_CACHE_CONTROL = 'no-cache'
+ADMIN_CACHE_CONTROL = 'private, no-cache'
+
+Context = Callable[[], Dict]
+
+
+class CompressedFile(CachedFile):
+    """A cached file with its compressed encodings made up front.
+
+    ``best`` spends more CPU for smaller output; it suits files compressed
+    once per process, not pages re-rendered as data changes. Encodings
+    that come out no smaller than the file are not kept.
+    """
+
+    __slots__ = ('encoded',)
+
+    def __init__(self, name: str, data: bytes, mtime_ns: int, best: bool = True):
+        super().__init__(name, data, mtime_ns)
+        self.encoded: Dict[str, bytes] = {}
+        candidates = {'gzip': gzip.compress(data, 9 if best else 6, mtime=0)}
+        if brotli is not None:
+            candidates['br'] = brotli.compress(data, mode=brotli.MODE_TEXT,
+                                               quality=11 if best else 5)
+        for encoding, body in candidates.items():
+            if len(body) < self.size:
+                self.encoded[encoding] = body
+
+    @classmethod
+    def render(cls, name: str, text: str, best: bool = True) -> 'CompressedFile':
+        data = text.encode()
+        return cls(name, data, zlib.crc32(data), best)
+
+
+def _accepted(header: str) -> Dict[str, float]:
+    """Content codings in an Accept-Encoding header with their q-values."""
+    codings = {}
+    for item in header.split(','):
+        coding, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding.strip().lower()] = quality
+    return codings
+
+
+def _encoding(request: web.Request, entry: CompressedFile) -> Optional[str]:
+    accepted = _accepted(request.headers.get(hdrs.ACCEPT_ENCODING, ''))
+    for encoding in ('br', 'gzip'):
+        if encoding in entry.encoded and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compressed_response(request: web.Request, entry: CompressedFile,
+                        cache_control: str) -> web.Response:
+    """Serve the best encoding the client accepts, answering conditional
+    requests with 304. Each encoding has its own ETag."""
+    encoding = _encoding(request, entry)
+    etag = entry.etag if encoding is None else f'{entry.etag[:-1]}-{encoding}"'
+    headers = {hdrs.ETAG: etag, hdrs.CACHE_CONTROL: cache_control,
+               hdrs.VARY: hdrs.ACCEPT_ENCODING}
+    if not_modified(request, etag):
+        return web.Response(status=304, headers=headers)
+    if encoding is not None:
+        headers[hdrs.CONTENT_ENCODING] = encoding
+    content_type = entry.content_type
+    return web.Response(body=entry.encoded[encoding] if encoding else entry.data,
+                        content_type=content_type,
+                        charset='utf-8' if content_type.startswith('text/') else None,
+                        headers=headers)
+
+
+def load_assets(directory: str) -> Dict[str, CompressedFile]:
+    """Read and compress every file in ``directory``, keyed by name."""
+    assets = {}
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return assets
+    for name in names:
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            assets[name] = CompressedFile(name, f.read(), st.st_mtime_ns)
+    logger.info(f"Loaded {len(assets)} static assets from {directory}")
+    return assets
+
+
+class PageCache:
+    """Rendered pages and fragments, each kept until its key changes."""
+
+    def __init__(self, env: jinja2.Environment, static_dir: str):
+        self.env = env
+        self.assets = load_assets(static_dir)
+        self._pages: Dict[Hashable, Tuple[Hashable, CompressedFile]] = {}
+        self._fragments: Dict[str, Tuple[Hashable, Markup]] = {}
+
+    @property
+    def hls_js(self) -> str:
+        return f'/static/{HLS_JS}' if HLS_JS in self.assets else HLS_JS_CDN
+
+    def fragment(self, template: str, key: Hashable, context: Context) -> Markup:
+        """``template`` rendered with ``context()``, re-rendered only when ``key`` changes."""
+        cached = self._fragments.get(template)
+        if cached is None or cached[0] != key:
+            cached = (key, Markup(self.env.get_template(template).render(context())))
+            self._fragments[template] = cached
+        return cached[1]
+
+    def page(self, name: Hashable, template: str, key: Hashable, context: Context,
+             best: bool = True) -> CompressedFile:
+        """Like ``fragment``, compressed and ready to send; ``name`` tells
+        apart pages rendered from the same template."""
+        cached = self._pages.get(name)
+        if cached is None or cached[0] != key:
+            html = self.env.get_template(template).render(context())
+            cached = (key, CompressedFile.render(os.path.basename(template), html, best))
+            self._pages[name] = cached
+        return cached[1]
+
+
+def player_page(pages: PageCache, channel) -> CompressedFile:
+    return pages.page(('player', channel.channel_id), 'index.html', None,
+                      lambda: {'hls_base': channel.hls_base, 'hls_js': pages.hls_js,
+                               'hls_js_integrity': HLS_JS_INTEGRITY})
+
+
+def channel_page_response(request: web.Request, channel) -> web.Response:
+    return compressed_response(request, player_page(request.app['pages'], channel),
+                               PAGE_CACHE_CONTROL)
+
+
+async def static_asset(request: web.Request) -> web.Response:
+    asset = request.app['pages'].assets.get(request.match_info['name'])
+    if asset is None:
+        raise web.HTTPNotFound()
+    return compressed_response(request, asset, ASSET_CACHE_CONTROL)
+
+
+def setup_pages(app: web.Application, static_dir: str) -> None:
+    """Serve ``static_dir`` under /static/ and render the player pages at startup.
+
+    Call after ``aiohttp_jinja2.setup``.
+    """
+    pages = PageCache(aiohttp_jinja2.get_env(app), static_dir)
+    app['pages'] = pages
+    app.router.add_get('/static/{name}', static_asset)
+
+    async def render_player_pages(app):
+        for channel in app['livestream_server'].channels.values():
+            player_page(pages, channel)
+
+    app.on_startup.append(render_player_pages)
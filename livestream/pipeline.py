@@ -0,0 +1,351 @@
+import asyncio
+import fcntl
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional
+
+from .ffmpeg_progress import PRESETS, PROGRESS_ARGS
+from .ladder import AAC_PROFILE, H264_MAX_LEVEL, H264_PROFILES, ladder_args
+
+logger = logging.getLogger(__name__)
+
+# Big enough for a warm feeder to buffer a few seconds of output.
+FEEDER_PIPE_SIZE = 1 << 20
+
+
+def can_stream_copy(info: Optional[Dict], max_keyframe_interval: float,
+                    width: Optional[int] = None, height: Optional[int] = None,
+                    fps: Optional[float] = None, sample_rate: Optional[int] = None,
+                    channels: Optional[int] = None) -> bool:
+    """Whether probed media can go to HLS with ``-c copy`` instead of a transcode.
+
+    ``info`` is a MediaIndex entry. The source must be H.264 4:2:0 with AAC
+    audio, within the profiles and level the playlists advertise (see
+    ladder.VIDEO_CODECS), and its keyframes at most ``max_keyframe_interval``
+    apart, since a copied stream can only be cut at its own keyframes. Any
+    of the other arguments that are given must match too.
+    """
+    if not info or info.get('video_codec') != 'h264' or info.get('audio_codec') != 'aac':
+        return False
+    if info.get('pix_fmt') not in ('yuv420p', 'yuvj420p'):
+        return False
+    if info.get('video_profile') not in H264_PROFILES \
+            or not 0 < (info.get('video_level') or 0) <= H264_MAX_LEVEL \
+            or info.get('audio_profile') != AAC_PROFILE:
+        return False
+    keyframe_interval = info.get('keyframe_interval')
+    if keyframe_interval is None or keyframe_interval > max_keyframe_interval + 0.001:
+        return False
+    if width is not None and (info.get('width'), info.get('height')) != (width, height):
+        return False
+    if fps is not None and abs((info.get('frame_rate') or 0) - fps) > 0.01:
+        return False
+    if sample_rate is not None and info.get('sample_rate') != sample_rate:
+        return False
+    return channels is None or info.get('channels') == channels
+
+
+def _grow_pipe(fd: int) -> None:
+    try:
+        fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), FEEDER_PIPE_SIZE)
+    except OSError:
+        pass
+
+
+def _copy_until_eof(src: int, dst: int) -> None:
+    """Move everything from ``src`` to ``dst``, in the kernel where possible.
+
+    Closes ``src`` when done, since the caller may have stopped waiting.
+    """
+    splice = getattr(os, 'splice', None)
+    try:
+        while True:
+            if splice is not None:
+                if splice(src, dst, FEEDER_PIPE_SIZE) == 0:
+                    return
+                continue
+            data = os.read(src, 64 * 1024)
+            if not data:
+                return
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst, view):]
+    except OSError as e:
+        logger.error(f"Feeder relay stopped: {str(e)}")
+    finally:
+        os.close(src)
+
+
+class ContinuousPipeline:
+    """One long-lived HLS muxer fed back to back by per-video encoders.
+
+    Each video is encoded by a short-lived *feeder* ffmpeg into a normalised
+    MPEG-TS stream that is written straight into the muxer's stdin through an
+    OS pipe, so Python never touches the media bytes. The muxer only
+    stream-copies and re-bases timestamps across the joins, which keeps a
+    single uninterrupted HLS timeline: switching videos restarts neither the
+    output nor the playlist.
+
+    Every feeder writes to a pipe of its own, and a relay thread splices
+    those pipes into the muxer one after another. That lets the next feeder
+    start, and fill its pipe, while the current one is still playing; the
+    relay switches over the moment the current one reaches EOF. ffmpeg marks ``#EXT-X-DISCONTINUITY`` only when
+    the muxer itself has to be restarted (``append_list``).
+
+    With a ``ladder`` the muxer also produces the lower-bitrate variants,
+    each in its own ``<output_dir>/<rung name>/`` directory. With a
+    ``part_duration`` it instead writes fMP4 segments one LL-HLS part long,
+    which LowLatencyPlaylist groups into full segments.
+    """
+
+    def __init__(self, output_dir: str, hls_time: int = 4, hls_list_size: int = 20,
+                 width: int = 1280, height: int = 720, fps: int = 30,
+                 ladder: Optional[List[Dict]] = None,
+                 part_duration: Optional[float] = None):
+        self.output_dir = output_dir
+        self.ladder = ladder
+        self.part_duration = part_duration
+        self.hls_time = hls_time
+        self.hls_list_size = hls_list_size
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.muxer: Optional[asyncio.subprocess.Process] = None
+        self.feeders: List[asyncio.subprocess.Process] = []
+        self._write_fd: Optional[int] = None
+        self._stderr_task: Optional[asyncio.Task] = None
+        # Read ends of feeder pipes waiting for the relay, in play order.
+        self._sources: Deque[int] = deque()
+        # Feeder writing into each of those pipes.
+        self._waiting: Dict[int, asyncio.subprocess.Process] = {}
+        self._source_added = asyncio.Event()
+        self._relay_task: Optional[asyncio.Task] = None
+        self._relay_executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def running(self) -> bool:
+        return self.muxer is not None and self.muxer.returncode is None
+
+    def get_muxer_command(self) -> List[str]:
+        """Generate the FFmpeg command for the long-lived HLS muxer."""
+        if self.part_duration:
+            parts_per_segment = max(1, round(self.hls_time / self.part_duration))
+            return [
+                'ffmpeg',
+                '-hide_banner',
+                '-loglevel', 'error',
+                '-f', 'mpegts',
+                '-i', 'pipe:0',
+                '-c', 'copy',
+                '-bsf:a', 'aac_adtstoasc',
+                '-f', 'hls',
+                '-hls_time', str(self.part_duration),
+                '-hls_list_size', str(self.hls_list_size * parts_per_segment),
+                '-hls_segment_type', 'fmp4',
+                '-hls_fmp4_init_filename', 'init.mp4',
+                '-hls_flags', 'split_by_time+delete_segments+append_list+omit_endlist',
+                '-hls_segment_filename', f'{self.output_dir}/part%05d.m4s',
+                '-hls_playlist_type', 'event',
+                f'{self.output_dir}/playlist.m3u8'
+            ]
+
+        if self.ladder:
+            stream_args = ladder_args(self.ladder, self.height)
+            output_dir = f'{self.output_dir}/%v'
+        else:
+            stream_args = ['-c', 'copy']
+            output_dir = self.output_dir
+        return [
+            'ffmpeg',
+            '-hide_banner',
+            '-loglevel', 'error',
+            '-f', 'mpegts',
+            '-i', 'pipe:0',
+            *stream_args,
+            '-f', 'hls',
+            '-hls_time', str(self.hls_time),
+            '-hls_list_size', str(self.hls_list_size),
+            '-hls_flags', 'delete_segments+append_list+omit_endlist',
+            '-hls_segment_filename', f'{output_dir}/segment%03d.ts',
+            '-hls_playlist_type', 'event',
+            f'{output_dir}/playlist.m3u8'
+        ]
+
+    @property
+    def profile(self) -> str:
+        """Short name of the output profile every feeder produces."""
+        return f'{self.width}x{self.height}p{self.fps}k{self.hls_time}'
+
+    def can_copy(self, info: Optional[Dict]) -> bool:
+        """Whether a probed video already has the shape every feeder produces."""
+        return can_stream_copy(info, self.hls_time, self.width, self.height,
+                               self.fps, 44100, 2)
+
+    def get_feeder_command(self, path: str, rendition: Optional[str] = None,
+                           output: str = 'pipe:1', realtime: bool = True,
+                           preset: str = PRESETS[0], start: float = 0.0,
+                           copy: bool = False, burst: float = 0.0,
+                           progress: bool = True) -> List[str]:
+        """Generate the FFmpeg command that encodes one video into the muxer.
+
+        Every feeder produces the same resolution, frame rate and audio
+        layout, with keyframes on segment boundaries, so the muxer can join
+        them without re-encoding. A pre-transcoded ``rendition`` already has
+        that shape and is only remuxed, and so is the source itself with
+        ``copy`` (see ``can_copy``). ``start`` resumes a restarted feeder
+        part way through the video, and ``burst`` reads that many seconds
+        as fast as possible before settling to real time. Without
+        ``progress`` stderr only carries errors.
+        """
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+                   *(PROGRESS_ARGS if progress else ['-nostats'])]
+        if realtime:
+            command.append('-re')
+            if burst:
+                command += ['-readrate_initial_burst', f'{burst:g}']
+        if start:
+            command += ['-ss', f'{start:.3f}']
+        if rendition is not None or copy:
+            return command + ['-i', rendition or path, '-c', 'copy', '-f', 'mpegts', output]
+
+        w, h = self.width, self.height
+        return command + [
+            '-i', path,
+            '-vf', (f'scale={w}:{h}:force_original_aspect_ratio=decrease,'
+                    f'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={self.fps}'),
+            '-c:v', 'libx264',
+            '-preset', preset,
+            '-tune', 'zerolatency',
+            '-force_key_frames', f'expr:gte(t,n_forced*{self.hls_time})',
+            '-c:a', 'aac',
+            '-ar', '44100',
+            '-b:a', '128k',
+            '-ac', '2',
+            '-f', 'mpegts',
+            output
+        ]
+
+    async def start(self) -> None:
+        """Start the muxer if it is not already running."""
+        if self.running:
+            return
+        await self.stop()
+        read_fd, self._write_fd = os.pipe()
+        try:
+            self.muxer = await asyncio.create_subprocess_exec(
+                *self.get_muxer_command(),
+                stdin=read_fd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+        finally:
+            os.close(read_fd)
+        self._stderr_task = asyncio.create_task(self._log_stderr(self.muxer))
+        self._relay_executor = ThreadPoolExecutor(1, thread_name_prefix='hls-relay')
+        self._relay_task = asyncio.create_task(self._relay())
+        logger.info(f"HLS muxer started with PID: {self.muxer.pid}")
+
+    async def feed(self, path: str, rendition: Optional[str] = None,
+                   preset: str = PRESETS[0], start: float = 0.0,
+                   front: bool = False, copy: bool = False,
+                   burst: float = 0.0) -> asyncio.subprocess.Process:
+        """Start encoding ``path`` (or remuxing it or its rendition) into the running muxer.
+
+        The output is queued behind any feeder already playing, so this can
+        be called ahead of time. ``front`` puts it ahead of feeders that are
+        still waiting, for a feeder that replaces the one playing now.
+        """
+        if not self.running:
+            raise RuntimeError("HLS muxer is not running")
+        read_fd, write_fd = os.pipe()
+        _grow_pipe(write_fd)
+        try:
+            feeder = await asyncio.create_subprocess_exec(
+                *self.get_feeder_command(path, rendition, preset=preset, start=start,
+                                         copy=copy, burst=burst),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=write_fd,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        if front:
+            self._sources.appendleft(read_fd)
+        else:
+            self._sources.append(read_fd)
+        self._waiting[read_fd] = feeder
+        self._source_added.set()
+        self.feeders = [f for f in self.feeders if f.returncode is None] + [feeder]
+        return feeder
+
+    async def _relay(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._sources:
+                self._source_added.clear()
+                await self._source_added.wait()
+            read_fd = self._sources.popleft()
+            del self._waiting[read_fd]
+            await loop.run_in_executor(self._relay_executor, _copy_until_eof,
+                                       read_fd, self._write_fd)
+
+    async def discard(self, feeder: asyncio.subprocess.Process) -> None:
+        """Stop a feeder whose video is no longer wanted.
+
+        Output still waiting for the relay is dropped; a feeder already
+        being relayed just ends early.
+        """
+        for read_fd, waiting in list(self._waiting.items()):
+            if waiting is feeder:
+                del self._waiting[read_fd]
+                self._sources.remove(read_fd)
+                os.close(read_fd)
+        if feeder.returncode is None:
+            feeder.terminate()
+            await feeder.wait()
+
+    async def stop(self) -> None:
+        """Stop the feeders and let the muxer finish its last segment."""
+        for feeder in self.feeders:
+            if feeder.returncode is None:
+                feeder.terminate()
+                await feeder.wait()
+        self.feeders = []
+
+        if self._relay_task is not None:
+            self._relay_task.cancel()
+            self._relay_task = None
+        if self._relay_executor is not None:
+            # Every feeder is gone, so the copy in progress ends at EOF.
+            executor, self._relay_executor = self._relay_executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+        while self._sources:
+            os.close(self._sources.popleft())
+        self._waiting.clear()
+
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+        if self.muxer is not None:
+            try:
+                await asyncio.wait_for(self.muxer.wait(), 10)
+            except asyncio.TimeoutError:
+                self.muxer.kill()
+                await self.muxer.wait()
+            logger.info(f"HLS muxer exited with code {self.muxer.returncode}")
+            self.muxer = None
+
+        if self._stderr_task is not None:
+            await self._stderr_task
+            self._stderr_task = None
+
+    @staticmethod
+    async def _log_stderr(process: asyncio.subprocess.Process) -> None:
+        async for line in process.stderr:
+            logger.error(f"HLS muxer: {line.decode(errors='replace').rstrip()}")
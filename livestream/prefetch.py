@@ -0,0 +1,83 @@
+import logging
+import os
+import struct
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# The head holds the first GOPs; the tail holds the moov box of files
+# that were not written with +faststart.
+HEAD_BYTES = 64 * 1024 * 1024
+TAIL_BYTES = 4 * 1024 * 1024
+
+
+def prefetch(path: str) -> None:
+    """Ask the kernel to start reading a file into the page cache.
+
+    Only the start and end of the file are requested, which is what the
+    next encoder needs first, without evicting the rest of the cache for a
+    multi-gigabyte video. Returns straight away; readahead runs in the
+    background.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        logger.error(f"Cannot prefetch {path}: {str(e)}")
+        return
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, min(size, HEAD_BYTES), os.POSIX_FADV_WILLNEED)
+            if size > HEAD_BYTES:
+                os.posix_fadvise(fd, max(HEAD_BYTES, size - TAIL_BYTES), 0,
+                                 os.POSIX_FADV_WILLNEED)
+        else:
+            os.pread(fd, 1, 0)
+    finally:
+        os.close(fd)
+
+
+def mp4_duration(path: str) -> Optional[float]:
+    """Read a video's duration from its ``mvhd`` box, or None if not found.
+
+    Only box headers are read while looking for ``moov``, so this is cheap
+    even when the box is at the end of a large file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            moov = _find_box(f, b'moov', 0, size)
+            if moov is None:
+                return None
+            mvhd = _find_box(f, b'mvhd', *moov)
+            if mvhd is None:
+                return None
+            f.seek(mvhd[0])
+            version = f.read(4)[0]
+            if version == 1:
+                timescale, duration = struct.unpack('>16xIQ', f.read(28))
+            else:
+                timescale, duration = struct.unpack('>8xII', f.read(16))
+            return duration / timescale if timescale else None
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+def _find_box(f, kind: bytes, start: int, end: int) -> Optional[tuple]:
+    """(payload start, box end) of the first ``kind`` box in a byte range."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return None
+        if box == kind:
+            return offset + header, offset + size
+        offset += size
+    return None
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+from .pipeline import ContinuousPipeline
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class RenditionCache:
+    """Pre-transcoded, stream-copy-ready copies of library videos.
+
+    Each video is encoded once, offline, into the pipeline's output profile
+    and stored as MPEG-TS under its content hash. The live loop then only
+    remuxes the cached file. Hashes are remembered per (path, size, mtime)
+    in ``index.json`` so the live path never has to read a video to find
+    its rendition.
+    """
+
+    def __init__(self, cache_dir: str, pipeline: ContinuousPipeline):
+        self.cache_dir = cache_dir
+        self.pipeline = pipeline
+        self.index: Dict[str, Dict] = {}
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._load_index()
+
+    def _load_index(self) -> None:
+        try:
+            with open(self._index_path) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading rendition index: {str(e)}")
+            self.index = {}
+
+    def _save_index(self) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def rendition_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir,
+                            f'{content_hash}-{self.pipeline.profile}.ts')
+
+    def _known_hash(self, path: str) -> Optional[str]:
+        """Return the remembered hash of ``path`` if the file is unchanged."""
+        entry = self.index.get(path)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+            return None
+        return entry['sha256']
+
+    def lookup(self, path: str) -> Optional[str]:
+        """Return the cached rendition for ``path``, or None if it must be encoded live."""
+        content_hash = self._known_hash(path)
+        if content_hash is None:
+            return None
+        rendition = self.rendition_path(content_hash)
+        return rendition if os.path.exists(rendition) else None
+
+    async def content_hash(self, path: str) -> str:
+        content_hash = self._known_hash(path)
+        if content_hash is None:
+            st = os.stat(path)
+            content_hash = await asyncio.to_thread(hash_file, path)
+            self.index[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                'sha256': content_hash}
+            self._save_index()
+        return content_hash
+
+    async def ensure(self, path: str) -> str:
+        """Transcode ``path`` into the cache unless an up-to-date rendition exists."""
+        rendition = self.rendition_path(await self.content_hash(path))
+        if os.path.exists(rendition):
+            return rendition
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        partial = rendition + '.part'
+        # Left over from a transcode that was killed; ffmpeg would refuse to
+        # overwrite it and still exit 0.
+        _remove(partial)
+        command = self.pipeline.get_feeder_command(
+            path, output=partial, realtime=False, progress=False)
+        logger.info(f"Transcoding {path} into the rendition cache")
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        # Set from here rather than in the child: preexec_fn is not safe
+        # while other threads are running.
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, 10)
+        except (AttributeError, OSError):
+            pass
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            _remove(partial)
+            raise
+        if process.returncode != 0 or not _size(partial):
+            _remove(partial)
+            raise RuntimeError(
+                f"Transcoding {path} failed (exit code {process.returncode}): "
+                f"{stderr.decode(errors='replace').strip() or 'no output written'}")
+        os.replace(partial, rendition)
+        logger.info(f"Cached rendition for {path}")
+        return rendition
+
+    def prune(self, keep_paths) -> None:
+        """Drop index entries and renditions for videos no longer in the library.
+
+        Partial files are removed too; transcodes run one at a time from
+        the same task, so any that are left were interrupted.
+        """
+        keep_paths = set(keep_paths)
+        for path in [p for p in self.index if p not in keep_paths]:
+            del self.index[path]
+        self._save_index()
+
+        wanted = {os.path.basename(self.rendition_path(e['sha256']))
+                  for e in self.index.values()}
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.ts') and entry.name not in wanted:
+                    os.remove(entry.path)
+                    logger.info(f"Removed stale rendition {entry.name}")
+                elif entry.name.endswith('.ts.part'):
+                    os.remove(entry.path)
+                    logger.info(f"Removed interrupted rendition {entry.name}")
@@ -0,0 +1,193 @@
+import logging
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SHUFFLE = 'shuffle'
+WEIGHTED = 'weighted'
+MODES = (SHUFFLE, WEIGHTED)
+
+
+def _minutes(value: str) -> int:
+    """Minutes since midnight for an ``HH:MM`` string."""
+    hours, minutes = value.split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time of day: {value}")
+    return hours * 60 + minutes
+
+
+class TimeSlot:
+    """A daily window (local time) that restricts play to a set of videos.
+
+    A slot whose end is not after its start runs past midnight.
+    """
+
+    def __init__(self, start: str, end: str, videos: List[str], name: str = ''):
+        self.start = start
+        self.end = end
+        self.videos = list(videos)
+        self.name = name or f'{start}-{end}'
+        self._start = _minutes(start)
+        self._end = _minutes(end)
+
+    def active(self, timestamp: float) -> bool:
+        local = time.localtime(timestamp)
+        minute = local.tm_hour * 60 + local.tm_min
+        if self._start < self._end:
+            return self._start <= minute < self._end
+        return minute >= self._start or minute < self._end
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'start': self.start, 'end': self.end,
+                'videos': self.videos}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'TimeSlot':
+        return cls(data['start'], data['end'], data.get('videos', []), data.get('name', ''))
+
+
+class Scheduler:
+    """Decides which video plays next.
+
+    In order of precedence: pinned queue items, then the videos of the
+    active time slot, then the whole library. Outside the queue, videos are
+    dealt like a shuffled deck so none repeats until every candidate has
+    played; in weighted mode the draw from the deck favours videos with
+    fewer plays in ``play_counts``.
+
+    ``peek`` plans the next video without consuming it, so the caller can
+    prefetch and warm-start it early; ``take`` commits it. Anything that
+    changes the queue or the slots calls ``replan``.
+    """
+
+    def __init__(self, play_counts: Dict[str, int], mode: str = WEIGHTED,
+                 history_size: int = 20):
+        self.play_counts = play_counts
+        self.mode = mode
+        self.library: Dict[str, Dict[str, str]] = {}
+        self.queue: Deque[str] = deque()
+        self.slots: List[TimeSlot] = []
+        self.history: Deque[str] = deque(maxlen=history_size)
+        # Videos already dealt in the current pass through the deck.
+        self._dealt: Set[str] = set()
+        # (planned video, slot it was planned for)
+        self._plan: Optional[Tuple[Dict[str, str], Optional[TimeSlot]]] = None
+
+    def set_library(self, videos: List[Dict[str, str]]) -> None:
+        self.library = {video['name']: video for video in videos}
+        self._dealt &= self.library.keys()
+        if self._plan is not None and self._plan[0]['name'] not in self.library:
+            self._plan = None
+
+    def set_mode(self, mode: str) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        self.mode = mode
+        self.replan()
+
+    def enqueue(self, name: str, front: bool = False) -> None:
+        if name not in self.library:
+            raise KeyError(name)
+        if front:
+            self.queue.appendleft(name)
+        else:
+            self.queue.append(name)
+        self.replan()
+
+    def dequeue(self, index: int) -> str:
+        name = self.queue[index]
+        del self.queue[index]
+        self.replan()
+        return name
+
+    def clear_queue(self) -> None:
+        self.queue.clear()
+        self.replan()
+
+    def set_slots(self, slots: List[TimeSlot]) -> None:
+        self.slots = list(slots)
+        self.replan()
+
+    def active_slot(self, timestamp: float) -> Optional[TimeSlot]:
+        for slot in self.slots:
+            if slot.active(timestamp):
+                return slot
+        return None
+
+    def replan(self) -> None:
+        self._plan = None
+
+    def peek(self, at: Optional[float] = None) -> Optional[Dict[str, str]]:
+        """The video that would start at ``at`` (default now), or None.
+
+        The plan is kept until it is taken or invalidated, so repeated
+        calls agree; it is only redrawn if ``at`` falls in a different
+        time slot than it was planned for.
+        """
+        at = time.time() if at is None else at
+        slot = self.active_slot(at)
+        if self._plan is not None and (self._plan[1] is slot or self._from_queue()):
+            return self._plan[0]
+        video = self._choose(slot)
+        self._plan = (video, slot) if video is not None else None
+        return video
+
+    def take(self, video: Optional[Dict[str, str]] = None,
+             at: Optional[float] = None) -> Optional[Dict[str, str]]:
+        """Commit the next video, or ``video`` if one was started regardless."""
+        if video is None:
+            video = self.peek(at)
+            if video is None:
+                return None
+        name = video['name']
+        if self.queue and self.queue[0] == name:
+            self.queue.popleft()
+        self._dealt.add(name)
+        self.history.append(name)
+        self._plan = None
+        return video
+
+    def _from_queue(self) -> bool:
+        return bool(self.queue) and self._plan is not None \
+            and self.queue[0] == self._plan[0]['name']
+
+    def _choose(self, slot: Optional[TimeSlot]) -> Optional[Dict[str, str]]:
+        while self.queue:
+            video = self.library.get(self.queue[0])
+            if video is not None:
+                return video
+            logger.warning(f"Dropping queued video that is no longer available: {self.queue[0]}")
+            self.queue.popleft()
+
+        pool = self.library.keys()
+        if slot is not None:
+            pool = pool & set(slot.videos) or pool
+        candidates = [name for name in pool if name not in self._dealt]
+        if not candidates:
+            # Start a new pass, without replaying the video that just ended.
+            self._dealt -= set(pool)
+            last = self.history[-1] if self.history else None
+            candidates = [name for name in pool if name != last] or list(pool)
+        if not candidates:
+            return None
+        if self.mode == WEIGHTED:
+            weights = [1.0 / (1 + self.play_counts.get(name, 0)) for name in candidates]
+            name = random.choices(candidates, weights)[0]
+        else:
+            name = random.choice(candidates)
+        return self.library[name]
+
+    def to_dict(self) -> Dict:
+        active = self.active_slot(time.time())
+        return {
+            'mode': self.mode,
+            'queue': list(self.queue),
+            'slots': [slot.to_dict() for slot in self.slots],
+            'active_slot': active.name if active else None,
+            'next': self._plan[0]['name'] if self._plan else None,
+            'history': list(self.history),
+        }
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import mmap
+import os
+from collections import OrderedDict
+from typing import BinaryIO, Dict, List, Optional
+
+from aiohttp import hdrs, web
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.json': 'application/json',
+    '.html': 'text/html',
+    '.js': 'text/javascript',
+    '.css': 'text/css',
+}
+
+
+class CachedFile:
+    """A finished HLS file held in memory."""
+
+    __slots__ = ('name', 'data', 'size', 'etag', 'mtime')
+
+    def __init__(self, name: str, data: bytes, mtime_ns: int):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.mtime = mtime_ns / 1e9
+        self.etag = f'"{mtime_ns:x}-{self.size:x}"'
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES.get(os.path.splitext(self.name)[1], 'application/octet-stream')
+
+
+class MappedFile(CachedFile):
+    """A finished segment kept open rather than copied into memory.
+
+    Responses ``sendfile`` it straight from the page cache. ``data`` maps
+    the file on first use, for readers that need the bytes (LL-HLS part
+    parsing, transports without sendfile); the mapping shares the page
+    cache too, so no process holds its own copy. The open file stays
+    readable after ffmpeg deletes it, until the last user lets go.
+    """
+
+    __slots__ = ('file', '_view')
+
+    def __init__(self, name: str, file: BinaryIO):
+        st = os.fstat(file.fileno())
+        self.name = name
+        self.file = file
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns / 1e9
+        self.etag = f'"{st.st_mtime_ns:x}-{self.size:x}"'
+        self._view: Optional[memoryview] = None
+
+    def __del__(self):
+        self.file.close()
+
+    @property
+    def data(self) -> memoryview:
+        if self._view is None:
+            if self.size:
+                self._view = memoryview(mmap.mmap(self.file.fileno(), self.size,
+                                                  access=mmap.ACCESS_READ))
+            else:
+                self._view = memoryview(b'')
+        return self._view
+
+    def truncated(self) -> bool:
+        """True if the file shrank since it was opened; touching the missing
+        part of a mapping would kill the process with SIGBUS."""
+        return os.fstat(self.file.fileno()).st_size < self.size
+
+
+def parse_playlist_segments(text: str) -> List[str]:
+    """Return the segment URIs listed in an HLS media playlist."""
+    return [line.strip() for line in text.splitlines()
+            if line.strip() and not line.startswith('#')]
+
+
+class SegmentCache:
+    """In-memory copy of the live HLS window.
+
+    ffmpeg only lists a segment in the playlist once it has finished writing
+    it, so the playlist is the source of truth: segments are loaded when they
+    are finished (or, at the latest, when they first appear in it) and
+    evicted once ``delete_segments`` drops them from the window.
+    """
+
+    def __init__(self, output_dir: str, playlist_name: str = 'playlist.m3u8',
+                 max_segments: int = 20):
+        self.output_dir = output_dir
+        self.playlist_name = playlist_name
+        self.max_segments = max_segments
+        self.playlist: Optional[CachedFile] = None
+        self.segments: 'OrderedDict[str, CachedFile]' = OrderedDict()
+        self._playlist_stat: Optional[tuple] = None
+        self._listed: set = set()
+
+    @property
+    def playlist_path(self) -> str:
+        return os.path.join(self.output_dir, self.playlist_name)
+
+    def _read(self, name: str) -> Optional[CachedFile]:
+        path = os.path.join(self.output_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return CachedFile(name, data, st.st_mtime_ns)
+
+    def open_segment(self, name: str) -> Optional[MappedFile]:
+        """Open a segment from disk without caching it."""
+        try:
+            return MappedFile(name, open(os.path.join(self.output_dir, name), 'rb'))
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def refresh(self) -> bool:
+        """Re-sync with the playlist on disk if it changed. Returns True on change."""
+        try:
+            st = os.stat(self.playlist_path)
+        except FileNotFoundError:
+            return False
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if key == self._playlist_stat:
+            return False
+
+        playlist = self._read(self.playlist_name)
+        if playlist is None:
+            return False
+        self._playlist_stat = key
+        self.sync(playlist)
+        return True
+
+    def sync(self, playlist: CachedFile) -> None:
+        """Install a new playlist and bring the segment window in line with it."""
+        listed = parse_playlist_segments(playlist.data.decode(errors='replace'))
+        listed = listed[-self.max_segments:]
+        wanted = set(listed)
+
+        # Only evict what fell out of the window; segments that finished but
+        # are not listed yet stay put.
+        for name in self._listed - wanted:
+            self.segments.pop(name, None)
+        self._listed = wanted
+
+        for name in listed:
+            if name not in self.segments:
+                self.add_segment(name)
+
+        self.playlist = playlist
+
+    def add_segment(self, name: str) -> Optional[CachedFile]:
+        """Load a finished segment into the cache, evicting the oldest if full."""
+        entry = self.open_segment(name)
+        if entry is None:
+            logger.debug(f"Segment vanished before it could be cached: {name}")
+            return None
+        self.segments[name] = entry
+        self.segments.move_to_end(name)
+        while len(self.segments) > self.max_segments:
+            self.segments.popitem(last=False)
+        return entry
+
+    def get_segment(self, name: str) -> Optional[CachedFile]:
+        return self.segments.get(name)
+
+    def clear(self) -> None:
+        self.playlist = None
+        self.segments.clear()
+        self._playlist_stat = None
+        self._listed = set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'segments': len(self.segments),
+            'bytes': sum(s.size for s in self.segments.values()),
+        }
+
+
+def not_modified(request: web.Request, etag: str) -> bool:
+    """True if the request's If-None-Match matches ``etag``."""
+    if_none_match = request.headers.get('If-None-Match')
+    return bool(if_none_match) and (if_none_match.strip() == '*' or
+                                    etag in [t.strip() for t in if_none_match.split(',')])
+
+
+def cached_response(request: web.Request, entry: CachedFile,
+                    cache_control: str) -> web.Response:
+    """Serve a cached file, answering conditional requests with 304."""
+    headers = {'ETag': entry.etag, 'Cache-Control': cache_control}
+    if not_modified(request, entry.etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=entry.data, content_type=entry.content_type,
+                        headers=headers)
+
+
+def _byte_range(request: web.Request, entry: CachedFile) -> Optional[slice]:
+    """The single byte range requested, clamped to the file, or None for all of it.
+
+    Raises HTTPRequestRangeNotSatisfiable for a range outside the file.
+    Malformed or multi-part ranges, and ranges whose If-Range no longer
+    matches, are ignored and the whole file is sent, as RFC 9110 allows.
+    """
+    if hdrs.RANGE not in request.headers:
+        return None
+    if_range = request.headers.get(hdrs.IF_RANGE)
+    if if_range is not None and if_range.strip() != entry.etag:
+        return None
+    try:
+        requested = request.http_range
+    except ValueError:
+        return None
+    start, stop = requested.start, requested.stop
+    if start is None and stop is None:
+        return None
+    if start is not None and start < 0:  # suffix range: the last -start bytes
+        start, stop = max(entry.size + start, 0), None
+    start = start or 0
+    stop = entry.size if stop is None else min(stop, entry.size)
+    if start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(
+            headers={hdrs.CONTENT_RANGE: f'bytes */{entry.size}'})
+    return slice(start, stop)
+
+
+async def _send(request: web.Request, response: web.StreamResponse,
+                entry: CachedFile, offset: int, count: int) -> None:
+    if isinstance(entry, MappedFile):
+        transport = request.transport
+        if transport is None:
+            raise ConnectionResetError("Connection lost")
+        try:
+            sent = await asyncio.get_running_loop().sendfile(
+                transport, entry.file, offset, count, fallback=False)
+        except (NotImplementedError, asyncio.SendfileNotAvailableError):
+            if entry.truncated():
+                response.force_close()
+                return
+        else:
+            if sent < count:
+                # The file shrank underneath us; the client must not wait for the rest.
+                response.force_close()
+            return
+    await response.write(entry.data[offset:offset + count])
+
+
+async def segment_response(request: web.Request, entry: CachedFile,
+                           cache_control: str) -> web.StreamResponse:
+    """Serve a segment, answering conditional requests with 304 and Range
+    requests with 206. Mapped files go out with ``sendfile``, everything
+    else is written from memory without copying."""
+    headers = {'ETag': entry.etag, 'Cache-Control': cache_control,
+               hdrs.ACCEPT_RANGES: 'bytes'}
+    if not_modified(request, entry.etag):
+        return web.Response(status=304, headers=headers)
+    byte_range = _byte_range(request, entry) or slice(0, entry.size)
+    response = web.StreamResponse(headers=headers)
+    if byte_range.stop - byte_range.start < entry.size:
+        response.set_status(206)
+        response.headers[hdrs.CONTENT_RANGE] = (
+            f'bytes {byte_range.start}-{byte_range.stop - 1}/{entry.size}')
+    response.content_type = entry.content_type
+    response.content_length = byte_range.stop - byte_range.start
+    await response.prepare(request)
+    if request.method != hdrs.METH_HEAD and response.content_length:
+        await _send(request, response, entry, byte_range.start, response.content_length)
+    await response.write_eof()
+    return response
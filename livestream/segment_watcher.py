@@ -0,0 +1,225 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from .segment_cache import SegmentCache, parse_playlist_segments
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_COMPLETE = 'segment_complete'
+PLAYLIST_UPDATED = 'playlist_updated'
+SEGMENT_REMOVED = 'segment_removed'
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    """Return libc if it exposes inotify, otherwise None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class SegmentWatcher:
+    """Emit HLS output events as ffmpeg writes them.
+
+    Uses inotify on Linux and falls back to stat-polling the playlist
+    elsewhere. Subscribers are called as ``callback(event, name)`` with one
+    of SEGMENT_COMPLETE, PLAYLIST_UPDATED or SEGMENT_REMOVED.
+    """
+
+    def __init__(self, directory: str, playlist_name: str = 'playlist.m3u8',
+                 segment_suffixes: tuple = ('.ts', '.m4s'),
+                 poll_interval: float = 0.25):
+        self.directory = directory
+        self.playlist_name = playlist_name
+        self.segment_suffixes = segment_suffixes
+        self.poll_interval = poll_interval
+        # Segments known to be on disk, mapped to the time they completed.
+        self.segments: Dict[str, float] = {}
+        self.backend: Optional[str] = None
+        self._subscribers: List[Callable[[str, str], None]] = []
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._fd: Optional[int] = None
+        self._poll_task: Optional[asyncio.Task] = None
+        self._playlist_stat: Optional[tuple] = None
+        self._listed: set = set()
+
+    @property
+    def running(self) -> bool:
+        return self.backend is not None
+
+    def subscribe(self, callback: Callable[[str, str], None]) -> None:
+        self._subscribers.append(callback)
+
+    def attach_cache(self, cache: SegmentCache) -> None:
+        """Keep ``cache`` in step with the files ffmpeg writes."""
+        def on_event(event: str, name: str) -> None:
+            if event == SEGMENT_COMPLETE:
+                cache.add_segment(name)
+            elif event == PLAYLIST_UPDATED:
+                cache.refresh()
+            elif event == SEGMENT_REMOVED:
+                cache.segments.pop(name, None)
+        self.subscribe(on_event)
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._seed()
+        libc = _load_libc()
+        if libc is not None and self._start_inotify(libc):
+            self.backend = 'inotify'
+        else:
+            self.backend = 'poll'
+            self._poll_task = asyncio.create_task(self._poll())
+        logger.info(f"Watching {self.directory} for HLS output ({self.backend})")
+
+    async def stop(self) -> None:
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+        self.backend = None
+
+    async def wait_for(self, event: str, timeout: float) -> bool:
+        """Wait for the next occurrence of ``event``. Returns False on timeout."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(event, []).append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(event, [])
+            if future in waiters:
+                waiters.remove(future)
+
+    def forget(self, name: str) -> None:
+        self.segments.pop(name, None)
+
+    def _is_segment(self, name: str) -> bool:
+        return name.endswith(self.segment_suffixes)
+
+    def _seed(self) -> None:
+        """Record segments left over from a previous run so cleanup can find them."""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if self._is_segment(entry.name):
+                    self.segments[entry.name] = entry.stat().st_mtime
+
+    def _emit(self, event: str, name: str) -> None:
+        if event == SEGMENT_COMPLETE:
+            self.segments[name] = time.time()
+        elif event == SEGMENT_REMOVED:
+            self.segments.pop(name, None)
+
+        for callback in self._subscribers:
+            try:
+                callback(event, name)
+            except Exception as e:
+                logger.exception(f"Segment watcher subscriber failed: {str(e)}")
+        for future in self._waiters.pop(event, []):
+            if not future.done():
+                future.set_result(name)
+
+    # inotify backend
+
+    def _start_inotify(self, libc: ctypes.CDLL) -> bool:
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return False
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+            logger.warning(
+                f"inotify_add_watch failed: {os.strerror(ctypes.get_errno())}")
+            os.close(fd)
+            return False
+        self._fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._read_inotify)
+        return True
+
+    def _read_inotify(self) -> None:
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            if not buf:
+                return
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                self._handle_inotify(mask, name)
+
+    def _handle_inotify(self, mask: int, name: str) -> None:
+        if name == self.playlist_name:
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._emit(PLAYLIST_UPDATED, name)
+        elif self._is_segment(name):
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._emit(SEGMENT_COMPLETE, name)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._emit(SEGMENT_REMOVED, name)
+
+    # polling backend
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                self._check_playlist()
+            except Exception as e:
+                logger.error(f"Error polling HLS output: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    def _check_playlist(self) -> None:
+        path = os.path.join(self.directory, self.playlist_name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if key == self._playlist_stat:
+            return
+        self._playlist_stat = key
+        with open(path, 'r', errors='replace') as f:
+            listed = parse_playlist_segments(f.read())
+
+        # A segment is complete once ffmpeg lists it in the playlist.
+        for name in listed:
+            if name not in self._listed:
+                self._emit(SEGMENT_COMPLETE, name)
+        self._listed = set(listed)
+        self._emit(PLAYLIST_UPDATED, self.playlist_name)
@@ -1,17 +1,31 @@
 import asyncio
-import json
-import asyncio
-import json
+import math
 import os
 import time
-import random
 from aiohttp import web, WSMsgType
 import aiohttp_jinja2
 from aiohttp_session import get_session
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import subprocess
+from . import codec
 from .analytics import ImprovedAnalytics
+from .broadcaster import Broadcaster
+from .chat import ChatHistory
+from .db import Database
+from .ffmpeg_progress import (PRESETS, PROGRESS_ARGS, EXITED, SLOW, FfmpegProgress,
+                              FfmpegSupervisor)
+from .llhls import LowLatencyPlaylist
+from .media_index import MediaIndex
+from .metrics import Metrics
+from .ladder import (DEFAULT_LADDER, VIDEO_CODECS, HlsVariant,
+                     master_playlist, master_playlist_file)
+from .pipeline import ContinuousPipeline, can_stream_copy
+from .prefetch import mp4_duration, prefetch
+from .renditions import RenditionCache
+from .scheduler import Scheduler
+from .segment_cache import SegmentCache, cached_response, segment_response
+from .segment_watcher import SegmentWatcher, PLAYLIST_UPDATED, SEGMENT_COMPLETE
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG,
@@ -20,33 +34,209 @@ logger = logging.getLogger(__name__)
 
 
 class LivestreamServer:
-    def __init__(self):
+    """One channel: its schedule, encoder, HLS output and WebSocket room.
+
+    The first server created is the primary channel and owns what is
+    shared site-wide: the media library, analytics, metrics, renditions
+    and the encoder slots. Further channels are created with
+    ``add_channel`` and borrow those from it.
+
+    The output settings are fixed for the channel's lifetime, since the
+    pipeline, variants and playlists are built from them:
+    ``continuous_output`` keeps one muxer running across videos instead
+    of one ffmpeg per video; ``abr_ladder`` lists the adaptive bitrate
+    rungs (None for a single rendition; the default only copies, see
+    ladder.FULL_LADDER for encoded rungs); ``low_latency`` writes LL-HLS
+    parts ``ll_part_duration`` long instead, with a single rendition.
+    The ladder and LL-HLS are only used with continuous output.
+    """
+
+    def __init__(self, channel_id: str = 'main', output_dir: str = 'hls_output',
+                 shared: Optional['LivestreamServer'] = None, *, hls_time: int = 4,
+                 continuous_output: bool = True,
+                 abr_ladder: Optional[List[Dict]] = DEFAULT_LADDER,
+                 low_latency: bool = False, ll_part_duration: float = 1.0):
+        self.channel_id = channel_id
         self.video_list: List[Dict[str, str]] = []
+        # Bumped whenever video_list is replaced, for caches keyed on it.
+        self.library_version = 0
         self.current_video: Optional[Dict[str, str]] = None
         self.start_time: Optional[float] = None
         self.ffmpeg_process: Optional[asyncio.subprocess.Process] = None
-        self.websockets: set = set()
-        self.chat_history: List[Dict] = []
-        self.output_dir: str = 'hls_output'
+        self.broadcaster = Broadcaster()
+        self._state_frame = codec.EncodedFrame(
+            lambda: {'type': 'state_update', 'state': self.get_current_state()})
+        self._state_json = codec.EncodedFrame(self.get_current_state)
+        self.chat_history = ChatHistory(capacity=100)
+        self.output_dir: str = output_dir
         self.video_dir: str = 'mp4-files'
-        self.analytics = ImprovedAnalytics()
-        self.load_video_list()
+        self.hls_time = hls_time
+        self.hls_list_size: int = 20
+        self.continuous_output = continuous_output
+        self.abr_ladder = abr_ladder
+        self.low_latency = low_latency
+        self.ll_part_duration = ll_part_duration
+        low_latency = self.low_latency and self.continuous_output
+        ladder = self.abr_ladder if self.continuous_output and not low_latency else None
+        self.pipeline = ContinuousPipeline(
+            self.output_dir, self.hls_time, self.hls_list_size, ladder=ladder,
+            part_duration=self.ll_part_duration if low_latency else None)
+        self.variants: Dict[str, HlsVariant] = {
+            rung['name']: HlsVariant(rung['name'], self.output_dir, self.hls_list_size)
+            for rung in (ladder or [])
+        }
+        if self.variants:
+            self.master_playlist = master_playlist_file(master_playlist(
+                ladder, self.pipeline.width, self.pipeline.height))
+        else:
+            self.master_playlist = master_playlist_file(
+                '#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=2928000,'
+                f'CODECS="{VIDEO_CODECS}"\nplaylist.m3u8\n')
+        # Start the next video's feeder this many seconds before the current
+        # one ends, so the muxer never waits on encoder start-up.
+        self.handoff_lead: float = 3.0
+        self.next_video: Optional[Dict[str, str]] = None
+        # (video, its feeder, when the feeder started) once warm-started;
+        # the video's clock starts with its feeder, not when it becomes current.
+        self._warm: Optional[Tuple[Dict[str, str], asyncio.subprocess.Process, float]] = None
+        # Stop encoding after this many seconds without a WebSocket client
+        # or playlist request (None streams around the clock). The next
+        # request wakes the channel where it left off.
+        self.idle_timeout: Optional[float] = 60.0
+        self.last_demand = time.monotonic()
+        self.sleeping = False
+        self._demand = asyncio.Event()
+        # Set once fresh output exists; playlist requests wait on it.
+        self.ready = asyncio.Event()
+        self._ready_waiters = 0
+        self._resume: Optional[Tuple[Dict[str, str], float]] = None
+        self._woke_at: Optional[float] = None
+        # Worker processes serving this channel too (see livestream.workers);
+        # state, readiness and chat are published to them over it.
+        self.bus = None
+        self.library_changed = asyncio.Event()
+        parts_per_segment = round(self.hls_time / self.ll_part_duration) if low_latency else 1
+        self.segment_cache = SegmentCache(
+            self.output_dir, max_segments=self.hls_list_size * parts_per_segment)
+        self.segment_watcher = SegmentWatcher(self.output_dir)
+        self.segment_watcher.attach_cache(self.segment_cache)
+        self.ll_playlist: Optional[LowLatencyPlaylist] = None
+        if low_latency:
+            self.ll_playlist = LowLatencyPlaylist(
+                self.segment_cache, self.hls_time, self.ll_part_duration,
+                window=self.hls_list_size)
+            self.ll_playlist.attach(self.segment_watcher)
+        self.supervisor = FfmpegSupervisor()
+        if shared is not None:
+            self.channels = shared.channels
+            self.analytics = shared.analytics
+            self.media_index = shared.media_index
+            self.renditions = shared.renditions
+            self.metrics = shared.metrics
+            self.encoder_slots = shared.encoder_slots
+            self.video_list = list(shared.video_list)
+        else:
+            self.channels: Dict[str, LivestreamServer] = {}
+            self.init_services()
+        self.scheduler = Scheduler(self.analytics.play_counts)
+        self.scheduler.set_library(self.video_list)
+        self.channels[channel_id] = self
+        self.register_metrics()
+
+    def init_services(self) -> None:
+        """Create what the primary channel shares with the others."""
+        # At most this many channels encode at once.
+        self.max_encoders: int = os.cpu_count() or 1
+        self.encoder_slots = asyncio.Semaphore(self.max_encoders)
+        self.renditions = RenditionCache('rendition_cache', self.pipeline)
+        self.analytics = ImprovedAnalytics(Database('analytics.db', size=1))
+        self.media_index = MediaIndex(Database('media.db', size=1), self.video_dir)
+        self.media_index.on_change = self.load_video_list
+        self.media_index.on_probed = lambda path: self.library_changed.set()
+        self.metrics = Metrics()
+        self.metrics.describe('livestream_segment_cache_requests_total', 'counter',
+                              'Segment requests by whether memory had the segment.')
+        self.metrics.describe('livestream_feeders_total', 'counter',
+                              'Feeders started, by whether they copy, remux a rendition or transcode.')
+        self.metrics.describe('livestream_ffmpeg_speed', 'gauge',
+                              'Encode speed of the current ffmpeg; below 1 it is falling behind.')
+        self.metrics.gauge_callback('livestream_viewers',
+                                    lambda: self.analytics.current_viewers)
+        self.metrics.describe('livestream_wake_seconds', 'histogram',
+                              'Time from a request waking an idle channel to its first new playlist.')
+
+    def register_metrics(self) -> None:
+        """Add this channel's gauges to the shared metrics."""
+        self.metrics.gauge_callback('livestream_websocket_clients',
+                                    lambda: len(self.broadcaster), channel=self.channel_id)
+        self.metrics.gauge_callback('livestream_channel_sleeping',
+                                    lambda: int(self.sleeping), channel=self.channel_id)
+
+    def add_channel(self, channel_id: str, **options) -> 'LivestreamServer':
+        """Create another channel sharing this one's library and services.
+
+        It has this channel's output settings unless ``options`` (the
+        constructor's keyword arguments) say otherwise.
+        """
+        if channel_id in self.channels:
+            raise ValueError(f"Channel {channel_id} already exists")
+        settings = {'hls_time': self.hls_time, 'continuous_output': self.continuous_output,
+                    'abr_ladder': self.abr_ladder, 'low_latency': self.low_latency,
+                    'll_part_duration': self.ll_part_duration}
+        settings.update(options)
+        return type(self)(channel_id, os.path.join('channels', channel_id), shared=self,
+                          **settings)
+
+    @property
+    def hls_base(self) -> str:
+        """URL prefix of this channel's HLS output."""
+        if self.channel_id == next(iter(self.channels)):
+            return '/hls'
+        return f'/channels/{self.channel_id}/hls'
 
     def load_video_list(self) -> None:
-        """Load the list of available videos."""
-        self.video_list = []
-        try:
-            for file in os.listdir(self.video_dir):
-                if file.endswith('.mp4'):
-                    full_path = os.path.join(self.video_dir, file)
-                    self.video_list.append({'name': file, 'path': full_path})
-            logger.info(f"Loaded {len(self.video_list)} videos")
-        except Exception as e:
-            logger.error(f"Error loading video list: {str(e)}")
+        """Load the list of available videos from the media index, for every channel."""
+        videos = self.media_index.videos()
+        logger.info(f"Loaded {len(videos)} videos")
+        for channel in self.channels.values():
+            channel.video_list = list(videos)
+            channel.library_version += 1
+            channel.scheduler.set_library(channel.video_list)
+            channel.plan_next_video()
+            channel.library_changed.set()
 
     async def start_streaming(self) -> None:
-        """Start the streaming process."""
+        """Stream while there is demand, giving up the encoder slot when idle."""
         os.makedirs(self.output_dir, exist_ok=True)
+        for watcher in self.output_watchers:
+            await watcher.start()
+
+        while True:
+            await self.wait_for_demand()
+            if self.encoder_slots.locked():
+                logger.info(f"Channel {self.channel_id} is waiting for an encoder slot")
+            async with self.encoder_slots:
+                stream = asyncio.create_task(self.stream())
+                idle = asyncio.create_task(self.wait_until_idle())
+                try:
+                    await asyncio.wait({stream, idle}, return_when=asyncio.FIRST_COMPLETED)
+                    if self.current_video and self.start_time:
+                        self._resume = (self.current_video, time.time() - self.start_time)
+                finally:
+                    idle.cancel()
+                    stream.cancel()
+                    try:
+                        await stream
+                    except asyncio.CancelledError:
+                        pass
+            logger.info(f"Channel {self.channel_id} has no viewers; encoder stopped at "
+                        f"{self._resume[1] if self._resume else 0:.1f}s")
+
+    async def stream(self) -> None:
+        """Encode until cancelled, resuming where a previous run stopped."""
+        if self.continuous_output:
+            await self.stream_continuous()
+            return
 
         while True:
             try:
@@ -55,13 +245,16 @@ class LivestreamServer:
                     await asyncio.sleep(5)
                     continue
 
-                self.current_video = random.choice(self.video_list)
-                self.start_time = time.time()
-                self.analytics.increment_play_count(self.current_video['name'])
+                video, offset = self._resume_point()
+                if video is None:
+                    video = self.scheduler.take()
+                    self.analytics.increment_play_count(video['name'])
+                self.current_video = video
+                self.start_time = time.time() - offset
                 logger.info(
                     f"Starting stream for video: {self.current_video['name']}")
 
-                command = self.get_ffmpeg_command()
+                command = self.get_ffmpeg_command(start=offset, burst=self.wake_burst)
 
                 self.ffmpeg_process = await asyncio.create_subprocess_exec(
                     *command,
@@ -76,7 +269,7 @@ class LivestreamServer:
                 await self.wait_for_hls_files()
 
                 # Monitor FFmpeg process
-                await self.monitor_ffmpeg_process()
+                await self.monitor_ffmpeg_process(offset)
 
                 # Broadcast the new state to all connected clients
                 await self.broadcast_state()
@@ -88,71 +281,390 @@ class LivestreamServer:
                     f"An error occurred during streaming: {str(e)}")
                 await asyncio.sleep(5)
 
-    def get_ffmpeg_command(self) -> List[str]:
+    @property
+    def wake_burst(self) -> float:
+        """Seconds a feeder reads ahead at full speed, so a woken channel
+        has its first segment without waiting a segment's worth of real time."""
+        return float(self.hls_time) if self._woke_at is not None else 0.0
+
+    def touch(self) -> None:
+        """Record demand for the channel, waking it if it is asleep."""
+        self.last_demand = time.monotonic()
+        self._demand.set()
+
+    async def wait_for_demand(self) -> None:
+        if self.idle_timeout is None or not self._is_idle():
+            return
+        self.sleeping = True
+        self.ready.clear()
+        self._demand.clear()
+        self.publish(self.ready_message())
+        try:
+            await self._demand.wait()
+        finally:
+            self.sleeping = False
+        self._woke_at = time.monotonic()
+        logger.info(f"Channel {self.channel_id} woken by a viewer")
+
+    async def wait_until_idle(self) -> None:
+        if self.idle_timeout is None:
+            await asyncio.Event().wait()
+        while not self._is_idle():
+            await asyncio.sleep(min(5.0, self.idle_timeout))
+
+    def _is_idle(self) -> bool:
+        return not len(self.broadcaster) and not self._ready_waiters and \
+            time.monotonic() - self.last_demand >= self.idle_timeout
+
+    async def wait_ready(self, timeout: float = 10.0) -> None:
+        """Wake the channel and wait (briefly) for it to have fresh output."""
+        self.touch()
+        if not self.ready.is_set():
+            self._ready_waiters += 1
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._ready_waiters -= 1
+                self.last_demand = time.monotonic()
+
+    def _resume_point(self) -> Tuple[Optional[Dict[str, str]], float]:
+        resume, self._resume = self._resume, None
+        if resume is None or resume[0] not in self.video_list:
+            return None, 0.0
+        return resume
+
+    async def stream_continuous(self) -> None:
+        """Encode the video list back to back into one HLS timeline."""
+        try:
+            while True:
+                try:
+                    if not self.video_list:
+                        logger.error("No videos found in the video list.")
+                        await asyncio.sleep(5)
+                        continue
+
+                    restarted = not self.pipeline.running
+                    await self.pipeline.start()
+                    hls_ready = None
+                    if restarted:
+                        self._warm = None  # its feeder went with the old muxer
+                        # Listen before feeding so a quick first segment is not missed.
+                        hls_ready = asyncio.create_task(self.wait_for_hls_files())
+
+                    video, offset = self._resume_point()
+                    process = started = None
+                    if video is None:
+                        video, process, started = self._warm or (None, None, None)
+                        self._warm = None
+                        if process is not None and (video not in self.video_list
+                                                    or process.returncode not in (None, 0)):
+                            # Removed from the library, or its feeder failed:
+                            # drop whatever it queued.
+                            await self.pipeline.discard(process)
+                            if video not in self.video_list:
+                                video = None
+                            process = started = None
+                        video = self.scheduler.take(video)
+                        self.analytics.increment_play_count(video['name'])
+                    self.current_video = video
+                    logger.info(
+                        f"Starting stream for video: {self.current_video['name']}")
+
+                    # A warm feeder that already finished has all of its
+                    # output queued; feeding it again would play it twice.
+                    if process is None:
+                        started = time.time()
+                        process = await self.feed_video(
+                            self.current_video, start=offset, burst=self.wake_burst)
+                    self.start_time = started - offset
+                    self.ffmpeg_process = process
+                    await self.broadcast_state()
+
+                    self.plan_next_video()
+                    warm_task = asyncio.create_task(self.warm_start_next(self.current_video))
+
+                    try:
+                        if hls_ready is not None:
+                            await hls_ready
+                        await self.monitor_ffmpeg_process(offset)
+                    finally:
+                        warm_task.cancel()
+                        if hls_ready is not None:
+                            hls_ready.cancel()
+                except Exception as e:
+                    logger.exception(
+                        f"An error occurred during streaming: {str(e)}")
+                    await asyncio.sleep(5)
+        finally:
+            await self.pipeline.stop()
+
+    def plan_next_video(self, at: Optional[float] = None) -> None:
+        """Ask the scheduler for the next video and start prefetching it.
+
+        Called when a video starts and again whenever the schedule changes,
+        until the next video's encoder has been warm-started.
+        """
+        if self._warm is not None:
+            return
+        upcoming = self.scheduler.peek(at)
+        if upcoming is not None and upcoming is not self.next_video:
+            asyncio.get_running_loop().run_in_executor(None, prefetch, upcoming['path'])
+        self.next_video = upcoming
+
+    async def warm_start_next(self, current: Dict[str, str]) -> None:
+        """Start the next video's feeder shortly before ``current`` finishes.
+
+        Its output waits in its own pipe until the pipeline's relay reaches
+        it, so the handoff costs no encoder start-up time.
+        """
+        duration = self.media_index.duration(current['path'])
+        if duration is None:
+            loop = asyncio.get_running_loop()
+            duration = await loop.run_in_executor(None, mp4_duration, current['path'])
+        if duration is None:
+            return
+        await asyncio.sleep(max(0.0, duration - (time.time() - self.start_time)
+                                - self.handoff_lead))
+        # Re-plan for the actual start time in case a time slot begins.
+        self.plan_next_video(at=time.time() + self.handoff_lead)
+        upcoming = self.next_video
+        if upcoming is None:
+            return
+        started = time.time()
+        process = await self.feed_video(upcoming)
+        self._warm = (upcoming, process, started)
+        logger.info(f"Warm-started encoder for next video: {upcoming['name']}")
+
+    async def feed_video(self, video: Dict[str, str], **kwargs) -> asyncio.subprocess.Process:
+        """Start ``video``'s feeder, remuxing instead of encoding when possible.
+
+        Sources that already match the pipeline's output profile are copied
+        as they are; otherwise a cached rendition is copied if there is one,
+        and only then is the video transcoded live.
+        """
+        copy = self.pipeline.can_copy(self.media_index.get(video['path']))
+        rendition = None if copy else self.renditions.lookup(video['path'])
+        mode = 'copy' if copy else 'rendition' if rendition else 'transcode'
+        self.metrics.inc('livestream_feeders_total', mode=mode, channel=self.channel_id)
+        return await self.pipeline.feed(video['path'], rendition, copy=copy, **kwargs)
+
+    def get_ffmpeg_command(self, preset: str = PRESETS[0], start: float = 0.0,
+                           burst: float = 0.0) -> List[str]:
         """Generate the FFmpeg command."""
+        path = self.current_video['path']
+        rendition = self.renditions.lookup(path)
+        seek = ['-ss', f'{start:.3f}'] if start else []
+        if rendition is not None:
+            codec_args = [*seek, '-i', rendition, '-c', 'copy']
+        elif can_stream_copy(self.media_index.get(path), self.hls_time):
+            # H.264/AAC with keyframes at least every segment: just remux.
+            codec_args = [*seek, '-i', path, '-c', 'copy']
+        else:
+            codec_args = [
+                *seek,
+                '-i', self.current_video['path'],
+                '-c:v', 'libx264',
+                '-preset', preset,
+                '-tune', 'zerolatency',
+                '-c:a', 'aac',
+                '-ar', '44100',
+                '-b:a', '128k',
+                '-ac', '2',
+            ]
         return [
             'ffmpeg',
+            *PROGRESS_ARGS,
             '-re',
-            '-i', self.current_video['path'],
-            '-c:v', 'libx264',
-            '-preset', 'veryfast',
-            '-tune', 'zerolatency',
-            '-c:a', 'aac',
-            '-ar', '44100',
-            '-b:a', '128k',
-            '-ac', '2',
+            *(['-readrate_initial_burst', f'{burst:g}'] if burst else []),
+            *codec_args,
             '-f', 'hls',
-            '-hls_time', '4',
-            '-hls_list_size', '20',
+            '-hls_time', str(self.hls_time),
+            '-hls_list_size', str(self.hls_list_size),
             '-hls_flags', 'delete_segments+append_list+omit_endlist',
             '-hls_segment_filename', f'{self.output_dir}/segment%03d.ts',
             '-hls_playlist_type', 'event',
             f'{self.output_dir}/playlist.m3u8'
         ]
 
+    @property
+    def output_watchers(self) -> List[SegmentWatcher]:
+        """Watchers for every directory ffmpeg writes HLS output to.
+
+        With a ladder that is only the variants' directories; nothing is
+        written to the top-level one.
+        """
+        if self.variants:
+            return [variant.segment_watcher for variant in self.variants.values()]
+        return [self.segment_watcher]
+
+    def record_ffmpeg_progress(self, progress: FfmpegProgress) -> None:
+        for name, value in (('livestream_ffmpeg_speed', progress.speed),
+                            ('livestream_ffmpeg_fps', progress.fps)):
+            if value is not None:
+                self.metrics.set(name, value, channel=self.channel_id)
+        for key, name in (('drop_frames', 'livestream_ffmpeg_dropped_frames'),
+                          ('dup_frames', 'livestream_ffmpeg_duplicated_frames')):
+            if key in progress.values:
+                self.metrics.set(name, int(progress.values[key]), channel=self.channel_id)
+
     async def wait_for_hls_files(self, timeout: int = 30) -> None:
         """Wait for HLS files to be generated."""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if os.path.exists(f'{self.output_dir}/playlist.m3u8') and \
-               any(f.endswith('.ts') for f in os.listdir(self.output_dir)):
-                logger.info("HLS files generated successfully")
-                return
-            await asyncio.sleep(1)
-        logger.error("Timeout: HLS files were not generated")
-
-    async def monitor_ffmpeg_process(self) -> None:
-        """Monitor the FFmpeg process and log any errors."""
+        watcher = self.output_watchers[-1]
+        if await watcher.wait_for(PLAYLIST_UPDATED, timeout):
+            logger.info("HLS files generated successfully")
+        else:
+            logger.error("Timeout: HLS files were not generated")
+        self.ready.set()
+        self.publish(self.ready_message())
+        if self._woke_at is not None:
+            elapsed = time.monotonic() - self._woke_at
+            self._woke_at = None
+            self.metrics.observe('livestream_wake_seconds', elapsed, channel=self.channel_id)
+            logger.info(f"Channel {self.channel_id} back on air {elapsed:.2f}s after waking")
+
+    async def monitor_ffmpeg_process(self, offset: float = 0.0) -> None:
+        """Supervise the FFmpeg process until the video ends.
+
+        An encoder that stops reporting progress is restarted where it got
+        to; one that falls behind real time is restarted with a faster x264
+        preset, so viewers do not run out of buffer. ``offset`` is where in
+        the video the process started.
+        """
+        preset = PRESETS[0]
         try:
-            stdout, stderr = await self.ffmpeg_process.communicate()
+            while True:
+                progress = FfmpegProgress()
+                outcome = await self.supervisor.watch(
+                    self.ffmpeg_process, progress, self.record_ffmpeg_progress)
+                if outcome == EXITED:
+                    break
+                offset += progress.out_time or 0.0
+                if outcome == SLOW:
+                    preset = self.supervisor.faster_preset(preset) or preset
+                logger.warning(
+                    f"FFmpeg {outcome} at {offset:.1f}s of {self.current_video['name']}, "
+                    f"restarting with preset {preset}")
+                self.metrics.inc('livestream_ffmpeg_restarts_total', reason=outcome,
+                                 channel=self.channel_id)
+                await self.restart_ffmpeg(offset, preset)
+
             if self.ffmpeg_process.returncode != 0:
-                logger.error(f"FFmpeg error: {stderr.decode()}")
+                logger.error(f"FFmpeg error: {progress.errors()}")
             else:
                 logger.info(
                     f"FFmpeg process completed successfully for {self.current_video['name']}")
         except asyncio.CancelledError:
-            self.ffmpeg_process.terminate()
+            if self.ffmpeg_process.returncode is None:
+                self.ffmpeg_process.terminate()
             logger.info("FFmpeg process terminated")
+            raise
+
+    async def restart_ffmpeg(self, start: float, preset: str) -> None:
+        """Replace the current encoder with one resuming at ``start`` seconds."""
+        process = self.ffmpeg_process
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        if self.continuous_output:
+            self.ffmpeg_process = await self.feed_video(
+                self.current_video, preset=preset, start=start, front=True)
+        else:
+            self.ffmpeg_process = await asyncio.create_subprocess_exec(
+                *self.get_ffmpeg_command(preset, start),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+
+    def state_key(self) -> tuple:
+        """Everything the state frame depends on; a new key means re-encode."""
+        if not (self.current_video and self.start_time):
+            return (None,)
+        name = self.current_video['name']
+        return (name, self.start_time, self.analytics.play_counts.get(name, 0))
+
+    def state_frame(self) -> str:
+        """Return the encoded state_update frame, shared by every recipient."""
+        return self._state_frame.get(self.state_key())
 
     async def broadcast_state(self) -> None:
         """Broadcast the current state to all connected clients."""
-        state = self.get_current_state()
-        await self.broadcast(json.dumps({'type': 'state_update', 'state': state}))
+        await self.broadcast(self.state_frame())
+        self.publish(self.state_message())
         logger.debug("Broadcasted state update to all connected clients")
 
+    def state_message(self) -> Dict:
+        key = self.state_key()
+        name, start_time, play_count = key if len(key) == 3 else (None, None, None)
+        return {'op': 'state', 'channel': self.channel_id, 'video': name,
+                'start_time': start_time, 'play_count': play_count}
+
+    def ready_message(self) -> Dict:
+        return {'op': 'ready', 'channel': self.channel_id,
+                'ready': self.ready.is_set(), 'sleeping': self.sleeping}
+
+    def publish(self, message: Dict) -> None:
+        """Send a message to the worker processes, if there are any."""
+        if self.bus is not None:
+            self.bus.send(message)
+
     async def cleanup_old_files(self) -> None:
         """Clean up old HLS segment files."""
         max_age_days = 0.005  # Keep this value low for livestreaming
         now = time.time()
         cutoff_time = now - (max_age_days * 86400)
 
-        for file_name in os.listdir(self.output_dir):
-            if file_name.endswith('.ts'):
-                file_path = os.path.join(self.output_dir, file_name)
-                if os.path.getmtime(file_path) < cutoff_time:
-                    os.remove(file_path)
+        for watcher in self.output_watchers:
+            for file_name, completed_at in list(watcher.segments.items()):
+                if completed_at < cutoff_time:
+                    try:
+                        os.remove(os.path.join(watcher.directory, file_name))
+                    except FileNotFoundError:
+                        pass
+                    watcher.forget(file_name)
                     # logger.debug(f"Deleted old file: {file_name}")
 
+    async def prepare_renditions(self) -> None:
+        """Transcode library videos into the rendition cache in the background."""
+        while True:
+            self.library_changed.clear()
+            for video in list(self.video_list):
+                info = self.media_index.get(video['path'])
+                # Wait for the probe, and skip videos that can be copied as they are.
+                if info is None or info['probed_at'] is None or self.pipeline.can_copy(info):
+                    continue
+                try:
+                    await self.renditions.ensure(video['path'])
+                except Exception as e:
+                    logger.error(f"Error preparing rendition: {str(e)}")
+            try:
+                self.renditions.prune(video['path'] for video in self.video_list)
+            except Exception as e:
+                logger.error(f"Error pruning renditions: {str(e)}")
+            await self.library_changed.wait()
+
+    def analytics_frame(self) -> str:
+        return ('{"type": "analytics", "analytics": '
+                + self.analytics.encoded().data.decode() + '}')
+
+    async def push_analytics(self, interval: float = 1.0) -> None:
+        """Push analytics to subscribed WebSocket clients when they change.
+
+        Changes are coalesced to at most one frame per ``interval``.
+        """
+        pushed = None
+        while True:
+            await asyncio.sleep(interval)
+            if (self.analytics.version != pushed
+                    and self.broadcaster.subscribers('analytics')):
+                pushed = self.analytics.version
+                self.broadcaster.publish(self.analytics_frame(), topic='analytics')
+
     async def cleanup_periodically(self) -> None:
         """Periodically clean up old files."""
         while True:
@@ -178,14 +690,48 @@ class LivestreamServer:
         return {}
 
     async def get_analytics(self, request: web.Request) -> web.Response:
-        """Return analytics data."""
-        return web.json_response(self.analytics.get_analytics())
+        """Return analytics data.
+
+        With any of ``start``, ``end``, ``metrics`` or ``resolution`` in the
+        query, return time series instead. Times are Unix seconds; negative
+        values are relative to now, so ``start=-86400`` means the last day.
+        """
+        query = request.query
+        if not any(k in query for k in ('start', 'end', 'metrics', 'resolution')):
+            return cached_response(request, self.analytics.encoded(), 'no-cache')
+
+        series = self.analytics.series
+        now = time.time()
+        try:
+            start = float(query.get('start', -3600))
+            end = float(query.get('end', now))
+            resolution = query.get('resolution')
+            resolution = int(resolution) if resolution is not None else None
+        except ValueError:
+            return web.Response(status=400, text="Invalid start, end or resolution")
+        if not (math.isfinite(start) and math.isfinite(end)):
+            return web.Response(status=400, text="Invalid start, end or resolution")
+        # Nothing is recorded before the epoch or after now.
+        start = min(max(now + start if start < 0 else start, 0.0), now)
+        end = min(max(now + end if end < 0 else end, 0.0), now)
+        metrics = query.get('metrics')
+        metrics = metrics.split(',') if metrics else list(series.METRICS)
+        if resolution is not None and resolution not in series.rings:
+            return web.Response(status=400, text="Unknown resolution")
+        if any(m not in series.METRICS for m in metrics):
+            return web.Response(status=400, text="Unknown metric")
+        return web.json_response(await series.query(metrics, start, end, resolution))
 
     async def handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
         """Handle WebSocket connections."""
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        self.websockets.add(ws)
+        self.broadcaster.register(ws)
+        self.touch()
+        self.broadcaster.send_to(ws, self.state_frame())
+        replay = self.chat_history.replay_frame()
+        if replay is not None:
+            self.broadcaster.send_to(ws, replay)
         session = await get_session(request)
         session_id = session.identity
 
@@ -194,19 +740,20 @@ class LivestreamServer:
         try:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
-                    await self.handle_ws_message(msg.data, session_id)
+                    await self.handle_ws_message(ws, msg.data, session_id)
                 elif msg.type == WSMsgType.ERROR:
                     logger.error(
                         f'WebSocket connection closed with exception {ws.exception()}')
         finally:
-            self.websockets.remove(ws)
+            self.broadcaster.unregister(ws)
             self.analytics.end_session(session_id)
         return ws
 
-    async def handle_ws_message(self, message: str, session_id: str) -> None:
+    async def handle_ws_message(self, ws: web.WebSocketResponse, message: str,
+                                session_id: str) -> None:
         """Handle incoming WebSocket messages."""
         try:
-            data = json.loads(message)
+            data = codec.loads(message)
             if data['type'] == 'chat':
                 chat_message = {
                     'type': 'chat',
@@ -214,23 +761,27 @@ class LivestreamServer:
                     'message': data['message'],
                     'timestamp': time.time()
                 }
-                self.chat_history.append(chat_message)
-                if len(self.chat_history) > 100:
-                    self.chat_history.pop(0)
-                await self.broadcast(json.dumps(chat_message))
-        except json.JSONDecodeError:
+                await self.post_chat(chat_message)
+            elif data['type'] == 'subscribe' and data['topic'] == 'analytics':
+                self.broadcaster.subscribe(ws, 'analytics')
+                self.broadcaster.send_to(ws, self.analytics_frame())
+            elif data['type'] == 'unsubscribe':
+                self.broadcaster.unsubscribe(ws, data['topic'])
+        except codec.JSONDecodeError:
             logger.error(f"Invalid JSON received from session {session_id}")
-        except KeyError:
+        except (KeyError, TypeError):
             logger.error(
                 f"Malformed message received from session {session_id}")
 
+    async def post_chat(self, chat_message: Dict) -> None:
+        """Add a message to the chat and send it to every viewer."""
+        self.analytics.record_chat()
+        await self.broadcast(self.chat_history.append(chat_message))
+        self.publish({'op': 'chat', 'channel': self.channel_id, 'message': chat_message})
+
     async def broadcast(self, message: str) -> None:
         """Broadcast a message to all connected WebSocket clients."""
-        for ws in self.websockets:
-            try:
-                await ws.send_str(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting message: {str(e)}")
+        self.broadcaster.publish(message)
 
     @aiohttp_jinja2.template('index.html')
     async def index(self, request: web.Request) -> Dict:
@@ -239,44 +790,178 @@ class LivestreamServer:
 
     async def video_state(self, request: web.Request) -> web.Response:
         """Return the current video state."""
-        state = self.get_current_state()
-        return web.json_response(state)
+        return web.Response(text=self._state_json.get(self.state_key()),
+                            content_type='application/json')
+
+    async def get_chat_history(self, request: web.Request) -> web.Response:
+        """Page back through chat history: ?before=<timestamp>&skip=<n>&limit=<n>.
+
+        Pass the previous page's ``next_before`` and ``next_skip`` to get
+        the next older page.
+        """
+        try:
+            before = request.query.get('before')
+            before = float(before) if before is not None else None
+            skip = max(0, int(request.query.get('skip', 0)))
+            limit = int(request.query.get('limit', 50))
+        except ValueError:
+            return web.Response(text='Invalid before, skip or limit', status=400)
+        limit = max(1, min(limit, self.chat_history.capacity))
+        return web.Response(text=self.chat_history.page_body(before, limit, skip),
+                            content_type='application/json')
+
+    async def hls_master_playlist(self, request: web.Request) -> web.Response:
+        """Serve the HLS master playlist listing every variant."""
+        self.touch()  # start waking now; the media playlist is fetched next
+        return cached_response(request, self.master_playlist, 'no-cache')
 
     async def hls_playlist(self, request: web.Request) -> web.Response:
-        """Serve the HLS playlist."""
-        playlist_path = f'{self.output_dir}/playlist.m3u8'
-        if os.path.exists(playlist_path):
-            return web.FileResponse(playlist_path)
-        else:
-            logger.error(f"Playlist not found: {playlist_path}")
+        """Serve the HLS playlist.
+
+        With a ladder there is no single media playlist; players that
+        still ask for one are sent to the master playlist.
+        """
+        if self.variants:
+            raise web.HTTPFound(request.rel_url.with_name('master.m3u8'))
+        await self.wait_ready()
+        if self.ll_playlist is not None:
+            return await self.ll_hls_playlist(request)
+        return self.serve_playlist(request, self.segment_cache, self.segment_watcher)
+
+    async def ll_hls_playlist(self, request: web.Request) -> web.Response:
+        """Serve the LL-HLS playlist, holding blocking reloads until ready."""
+        ll = self.ll_playlist
+        try:
+            msn = request.query.get('_HLS_msn')
+            part = request.query.get('_HLS_part')
+            msn = int(msn) if msn is not None else None
+            part = int(part) if part is not None else None
+        except ValueError:
+            return web.Response(status=400, text="Invalid _HLS_msn or _HLS_part")
+        if part is not None and msn is None:
+            return web.Response(status=400, text="_HLS_part requires _HLS_msn")
+
+        if msn is not None:
+            if msn > ll.next_msn + 1:
+                return web.Response(status=400, text="_HLS_msn is too far ahead")
+            if not await ll.wait_for(msn, part, timeout=3 * self.hls_time):
+                return web.Response(status=503, text="Playlist update timed out")
+
+        if ll.playlist is None:
+            logger.error("LL-HLS playlist not ready yet")
             return web.Response(status=404, text="Playlist not found")
+        return cached_response(request, ll.playlist, 'no-cache')
 
     async def hls_segment(self, request: web.Request) -> web.Response:
         """Serve HLS segments."""
         segment = request.match_info['segment']
-        segment_path = f'{self.output_dir}/{segment}'
-        if os.path.exists(segment_path):
-            return web.FileResponse(segment_path)
+        ll = self.ll_playlist
+        if ll is not None:
+            cached = ll.get_segment(segment)
+            if cached is not None:
+                self.metrics.inc('livestream_segment_cache_requests_total', result='hit',
+                                 channel=self.channel_id)
+                max_age = self.hls_time * self.hls_list_size
+                response = await segment_response(request, cached, f'public, max-age={max_age}')
+                self.analytics.record_segment(response.content_length)
+                return response
+            if segment == ll.next_part_name:
+                # Preload hint: hold the request until ffmpeg finishes the part.
+                deadline = time.time() + 3 * self.ll_part_duration
+                while (self.segment_cache.get_segment(segment) is None
+                       and time.time() < deadline):
+                    await self.segment_watcher.wait_for(
+                        SEGMENT_COMPLETE, deadline - time.time())
+        return await self.serve_segment(request, self.segment_cache, segment)
+
+    async def hls_variant_playlist(self, request: web.Request) -> web.Response:
+        """Serve the playlist of one bitrate variant."""
+        variant = self.variants.get(request.match_info['variant'])
+        if variant is None:
+            return web.Response(status=404, text="Variant not found")
+        await self.wait_ready()
+        return self.serve_playlist(request, variant.segment_cache,
+                                   variant.segment_watcher)
+
+    async def hls_variant_segment(self, request: web.Request) -> web.Response:
+        """Serve a segment of one bitrate variant."""
+        variant = self.variants.get(request.match_info['variant'])
+        if variant is None:
+            return web.Response(status=404, text="Variant not found")
+        return await self.serve_segment(request, variant.segment_cache,
+                                        request.match_info['segment'])
+
+    def serve_playlist(self, request: web.Request, cache: SegmentCache,
+                       watcher: SegmentWatcher) -> web.Response:
+        if not watcher.running:
+            cache.refresh()
+        playlist = cache.playlist
+        if playlist is None:
+            logger.error(f"Playlist not found: {cache.playlist_path}")
+            return web.Response(status=404, text="Playlist not found")
+        return cached_response(request, playlist, 'no-cache')
+
+    async def serve_segment(self, request: web.Request, cache: SegmentCache,
+                            segment: str) -> web.StreamResponse:
+        cached = cache.get_segment(segment)
+        if cached is None and cache.refresh():
+            cached = cache.get_segment(segment)
+        if cached is not None:
+            self.metrics.inc('livestream_segment_cache_requests_total', result='hit',
+                             channel=self.channel_id)
         else:
-            logger.error(f"Segment not found: {segment_path}")
-            return web.Response(status=404, text="Segment not found")
+            self.metrics.inc('livestream_segment_cache_requests_total', result='miss',
+                             channel=self.channel_id)
+            # Segments that just left the live window are still on disk for a
+            # short while; let clients holding an older playlist finish.
+            cached = cache.open_segment(segment)
+            if cached is None:
+                logger.error(f"Segment not found: {os.path.join(cache.output_dir, segment)}")
+                return web.Response(status=404, text="Segment not found")
+        max_age = self.hls_time * self.hls_list_size
+        response = await segment_response(request, cached, f'public, max-age={max_age}')
+        self.analytics.record_segment(response.content_length)
+        return response
 
 
 async def start_background_tasks(app: web.Application) -> None:
     """Start background tasks."""
-    app['livestream_server'] = app['livestream_server']
-    app['livestream_task'] = asyncio.create_task(
-        app['livestream_server'].start_streaming())
-    app['cleanup_task'] = asyncio.create_task(
-        app['livestream_server'].cleanup_periodically())
+    livestream_server = app['livestream_server']
+    await livestream_server.media_index.open()
+    livestream_server.load_video_list()
+    app['media_index_task'] = asyncio.create_task(
+        livestream_server.media_index.run())
+    app['rendition_task'] = asyncio.create_task(
+        livestream_server.prepare_renditions())
+    app['analytics_task'] = asyncio.create_task(
+        livestream_server.analytics.run())
+    app['channel_tasks'] = []
+    for channel in livestream_server.channels.values():
+        app['channel_tasks'] += [
+            asyncio.create_task(channel.start_streaming()),
+            asyncio.create_task(channel.cleanup_periodically()),
+            asyncio.create_task(channel.push_analytics()),
+        ]
 
 
 async def cleanup_background_tasks(app: web.Application) -> None:
     """Clean up background tasks."""
-    app['livestream_task'].cancel()
-    await app['livestream_task']
-    app['cleanup_task'].cancel()
-    await app['cleanup_task']
+    livestream_server = app['livestream_server']
+    tasks = (app['rendition_task'], app['analytics_task'], app['media_index_task'],
+             *app['channel_tasks'])
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    for channel in livestream_server.channels.values():
+        for watcher in channel.output_watchers:
+            await watcher.stop()
+        await channel.broadcaster.close()
+    await livestream_server.analytics.series.close()
+    await livestream_server.media_index.close()
 
 
 def check_ffmpeg() -> None:
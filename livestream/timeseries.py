@@ -0,0 +1,210 @@
+import logging
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .db import Database
+
+logger = logging.getLogger(__name__)
+
+SUM = 'sum'
+MAX = 'max'
+
+# (bucket width in seconds, buckets kept in memory): an hour of seconds,
+# a day of minutes and a month of hours, each with a little headroom so a
+# range of exactly that length still fits.
+ROLLUPS: Tuple[Tuple[int, int], ...] = ((1, 3660), (60, 1500), (3600, 750))
+
+# Only the coarser rollups are written to SQLite, with this retention.
+PERSISTED: Dict[int, int] = {60: 7 * 86400, 3600: 365 * 86400}
+
+
+class TimeSeriesRing:
+    """Fixed-size ring of time buckets for a set of metrics.
+
+    Each metric is one ``array('d')`` indexed by ``bucket % slots``. A
+    parallel array remembers which bucket currently owns each slot, so a
+    slot that was last written a full lap ago reads as empty and is reset
+    on its next write. Memory does not depend on uptime.
+    """
+
+    def __init__(self, resolution: int, slots: int, metrics: Dict[str, str]):
+        self.resolution = resolution
+        self.slots = slots
+        self.metrics = metrics
+        self.owner = array('q', [-1]) * slots
+        self.values = {name: array('d', [0.0]) * slots for name in metrics}
+
+    def bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.resolution)
+
+    def _slot(self, bucket: int) -> int:
+        slot = bucket % self.slots
+        if self.owner[slot] != bucket:
+            self.owner[slot] = bucket
+            for values in self.values.values():
+                values[slot] = 0.0
+        return slot
+
+    def record(self, metric: str, value: float, timestamp: float) -> None:
+        slot = self._slot(self.bucket(timestamp))
+        values = self.values[metric]
+        if self.metrics[metric] == MAX:
+            values[slot] = max(values[slot], value)
+        else:
+            values[slot] += value
+
+    def get(self, metric: str, bucket: int) -> Optional[float]:
+        slot = bucket % self.slots
+        if self.owner[slot] != bucket:
+            return None
+        return self.values[metric][slot]
+
+    def covers(self, bucket: int, now: float) -> bool:
+        return self.bucket(now) - bucket < self.slots
+
+    def range(self, metric: str, first: int, last: int) -> List[Tuple[int, float]]:
+        """(bucket, value) for every written bucket in ``[first, last]``."""
+        points = []
+        for bucket in range(first, last + 1):
+            value = self.get(metric, bucket)
+            if value is not None:
+                points.append((bucket, value))
+        return points
+
+
+class TimeSeriesStore:
+    """Viewer, delivery and chat time series at 1 s, 1 min and 1 h resolution.
+
+    Counters are summed per bucket and gauges keep the bucket's maximum.
+    Gauges are also re-recorded on ``tick`` so quiet periods still show the
+    current value. Finished minute and hour buckets are flushed to SQLite
+    so ranges older than the rings (or from before a restart) stay
+    queryable.
+    """
+
+    METRICS: Dict[str, str] = {
+        'viewers': MAX,
+        'segment_requests': SUM,
+        'bytes_served': SUM,
+        'chat_messages': SUM,
+    }
+
+    def __init__(self, database: Optional[Database] = None):
+        self.database = database
+        self.rings = {resolution: TimeSeriesRing(resolution, slots, self.METRICS)
+                      for resolution, slots in ROLLUPS}
+        self.gauges: Dict[str, float] = {}
+        self.started = time.time()
+        # Last bucket flushed per persisted resolution.
+        self._flushed: Dict[int, int] = {}
+
+    def add(self, metric: str, value: float = 1, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        for ring in self.rings.values():
+            ring.record(metric, value, now)
+
+    def set_gauge(self, metric: str, value: float, now: Optional[float] = None) -> None:
+        self.gauges[metric] = value
+        self.add(metric, value, now)
+
+    def tick(self, now: Optional[float] = None) -> None:
+        for metric, value in self.gauges.items():
+            self.add(metric, value, now)
+
+    def pick_resolution(self, start: float, now: float, max_points: int = 3660) -> int:
+        """Finest resolution that still holds ``start`` without too many points."""
+        for resolution, slots in ROLLUPS:
+            ring = self.rings[resolution]
+            if ring.covers(ring.bucket(start), now) and \
+                    (now - start) / resolution <= max_points:
+                return resolution
+        return ROLLUPS[-1][0]
+
+    async def query(self, metrics: Iterable[str], start: float, end: float,
+                    resolution: Optional[int] = None) -> Dict:
+        now = time.time()
+        if resolution is None:
+            resolution = self.pick_resolution(start, now)
+        ring = self.rings[resolution]
+        first, last = ring.bucket(start), min(ring.bucket(end), ring.bucket(now))
+        series = {}
+        for metric in metrics:
+            points = {}
+            # Buckets from before the rings' lap or before this process.
+            if resolution in PERSISTED and (
+                    not ring.covers(first, now) or first <= ring.bucket(self.started)):
+                points.update(await self._load(metric, resolution, first, last))
+            points.update(ring.range(metric, max(first, ring.bucket(now) - ring.slots + 1),
+                                     last))
+            series[metric] = [[bucket * resolution, value]
+                              for bucket, value in sorted(points.items())]
+        return {'resolution': resolution, 'start': start, 'end': end, 'series': series}
+
+    # SQLite persistence
+
+    async def open(self) -> None:
+        if self.database is None:
+            return
+        await self.database.open()
+        async with self.database.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS analytics_series (
+                    metric TEXT NOT NULL,
+                    resolution INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (metric, resolution, bucket)
+                )
+            ''')
+            await conn.commit()
+
+    async def flush(self, now: Optional[float] = None, final: bool = False) -> None:
+        """Write buckets that finished since the last flush.
+
+        With ``final`` the current, unfinished buckets are written as well;
+        a later flush simply replaces them.
+        """
+        if self.database is None or not self.database.is_open:
+            return
+        now = time.time() if now is None else now
+        rows = []
+        for resolution in PERSISTED:
+            ring = self.rings[resolution]
+            current = ring.bucket(now)
+            last = current if final else current - 1
+            first = max(self._flushed.get(resolution, last - ring.slots) + 1,
+                        current - ring.slots + 1)
+            for metric in self.METRICS:
+                for bucket, value in ring.range(metric, first, last):
+                    rows.append((metric, resolution, bucket, value))
+            # An unfinished bucket flushed on shutdown is rewritten next time.
+            self._flushed[resolution] = current - 1
+        if not rows:
+            return
+        async with self.database.acquire() as conn:
+            await conn.executemany(
+                'INSERT OR REPLACE INTO analytics_series '
+                '(metric, resolution, bucket, value) VALUES (?, ?, ?, ?)', rows)
+            for resolution, retention in PERSISTED.items():
+                await conn.execute(
+                    'DELETE FROM analytics_series WHERE resolution = ? AND bucket < ?',
+                    (resolution, int((now - retention) // resolution)))
+            await conn.commit()
+        logger.debug(f"Flushed {len(rows)} analytics buckets")
+
+    async def _load(self, metric: str, resolution: int, first: int,
+                    last: int) -> List[Tuple[int, float]]:
+        if self.database is None or not self.database.is_open:
+            return []
+        async with self.database.acquire() as conn:
+            async with conn.execute(
+                    'SELECT bucket, value FROM analytics_series WHERE metric = ? '
+                    'AND resolution = ? AND bucket BETWEEN ? AND ? ORDER BY bucket',
+                    (metric, resolution, first, last)) as cursor:
+                return list(await cursor.fetchall())
+
+    async def close(self) -> None:
+        if self.database is not None and self.database.is_open:
+            await self.flush(final=True)
+            await self.database.close()
@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class UserCache:
+    """Small LRU of user profiles with a time-to-live.
+
+    Entries are evicted least recently used first once ``max_entries`` is
+    reached, and dropped on read once older than ``ttl`` seconds. Anything
+    that changes a user must call ``invalidate``.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[int, Tuple[float, Dict]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: Dict) -> None:
+        self._entries[user['id']] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user['id'])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
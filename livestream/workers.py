@@ -0,0 +1,381 @@
+"""Serving one site from several processes.
+
+The owner process runs everything as before: encoders, the media library,
+analytics, admin. Worker processes bind the same port with SO_REUSEPORT
+and serve the hot paths themselves: HLS playlists and segments (read from
+the owner's output directories, which inotify tells every process about),
+WebSockets, pages and login. Anything else is forwarded to the owner over
+its Unix socket.
+
+Owner and workers talk over a ``livestream.bus``: the owner publishes
+channel state, readiness, chat and analytics; workers send chat, viewer
+demand, session starts and ends, segment counts and their metrics, which
+the owner's /metrics adds to its own.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
+
+from . import codec
+from .bus import BusClient, BusPeer, BusServer
+from .chat import ChatHistory
+from .metrics import Metrics
+from .server import LivestreamServer
+
+logger = logging.getLogger(__name__)
+
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'te', 'trailer', 'trailers',
+                        'transfer-encoding', 'upgrade'))
+# Catch-all route forwarding to the owner, which records those requests itself.
+PROXY_ROUTE = '/{tail:.*}'
+
+
+class OwnerBridge:
+    """The owner's end of the bus: applies worker events to the channels
+    and brings newly connected workers up to date."""
+
+    def __init__(self, app: web.Application, livestream_server: LivestreamServer,
+                 bus: BusServer):
+        self.app = app
+        self.livestream_server = livestream_server
+        self.analytics = livestream_server.analytics
+        self.metrics = livestream_server.metrics
+        self.bus = bus
+        for channel in livestream_server.channels.values():
+            channel.bus = bus
+        bus.on('hello', self.hello)
+        bus.on('chat', self.chat)
+        bus.on('demand', self.demand)
+        bus.on('session', self.session)
+        bus.on('segments', self.segments)
+        bus.on('user', self.user)
+        bus.on('metrics', self.worker_metrics)
+        bus.on_disconnect = self.peer_lost
+
+    def _channel(self, message: Dict) -> Optional[LivestreamServer]:
+        return self.livestream_server.channels.get(message.get('channel'))
+
+    def analytics_message(self) -> Dict:
+        return {'op': 'analytics', 'frame': self.livestream_server.analytics_frame(),
+                'viewers': self.analytics.current_viewers}
+
+    def hello(self, message: Dict, peer: BusPeer) -> None:
+        for channel in self.livestream_server.channels.values():
+            self.bus.send_to(peer, channel.state_message())
+            self.bus.send_to(peer, channel.ready_message())
+            self.bus.send_to(peer, {
+                'op': 'history', 'channel': channel.channel_id,
+                'messages': [codec.loads(frame) for _, frame in channel.chat_history.messages]})
+        self.bus.send_to(peer, self.analytics_message())
+        logger.info(f"Worker connected; {len(self.bus.peers)} on the bus")
+
+    async def chat(self, message: Dict, peer: BusPeer) -> None:
+        channel = self._channel(message)
+        if channel is not None:
+            chat = message['message']
+            await channel.post_chat({'type': 'chat', 'username': chat['username'],
+                                     'message': chat['message'],
+                                     'timestamp': float(chat['timestamp'])})
+
+    def demand(self, message: Dict, peer: BusPeer) -> None:
+        channel = self._channel(message)
+        if channel is not None:
+            channel.touch()
+
+    def session(self, message: Dict, peer: BusPeer) -> None:
+        session_id = message['id']
+        if message['started']:
+            peer.sessions.append(session_id)
+            self.analytics.start_session(session_id)
+        elif session_id in peer.sessions:
+            peer.sessions.remove(session_id)
+            self.analytics.end_session(session_id)
+
+    def peer_lost(self, peer: BusPeer) -> None:
+        for session_id in peer.sessions:
+            self.analytics.end_session(session_id)
+        peer.sessions.clear()
+        self.metrics.remote_gauges.pop(peer, None)
+        logger.warning(f"Worker disconnected; {len(self.bus.peers)} on the bus")
+
+    def segments(self, message: Dict, peer: BusPeer) -> None:
+        self.analytics.series.add('segment_requests', message['count'])
+        if message['bytes']:
+            self.analytics.series.add('bytes_served', message['bytes'])
+
+    def user(self, message: Dict, peer: BusPeer) -> None:
+        self.app['user_cache'].invalidate(message['id'])
+        self.bus.send(message)
+
+    def worker_metrics(self, message: Dict, peer: BusPeer) -> None:
+        snapshot = message['snapshot']
+        self.metrics.add(snapshot)
+        self.metrics.remote_gauges[peer] = snapshot['gauges']
+
+    async def run(self, interval: float = 1.0) -> None:
+        """Send analytics to the workers when they change, at most once per interval."""
+        sent = None
+        while True:
+            await asyncio.sleep(interval)
+            if self.bus.peers and self.analytics.version != sent:
+                sent = self.analytics.version
+                self.bus.send(self.analytics_message())
+
+
+class BusAnalytics:
+    """Analytics as a worker sees them.
+
+    Events are sent to the owner, which keeps the real numbers; segment
+    counts are batched and sent once a second. The snapshot for
+    WebSocket subscribers comes back from the owner ready encoded.
+    """
+
+    def __init__(self, owner: Optional[BusClient] = None):
+        self.owner = owner
+        self.play_counts: Dict[str, int] = {}
+        self.current_viewers = 0
+        self.frame: Optional[str] = None
+        self._segments = 0
+        self._bytes = 0
+
+    def start_session(self, session_id):
+        self.owner.send({'op': 'session', 'id': session_id, 'started': True})
+
+    def end_session(self, session_id):
+        self.owner.send({'op': 'session', 'id': session_id, 'started': False})
+
+    def record_segment(self, nbytes):
+        self._segments += 1
+        self._bytes += nbytes or 0
+
+    def record_chat(self):
+        pass  # counted by the owner when it posts the message
+
+    def flush(self) -> None:
+        if self._segments and self.owner.send(
+                {'op': 'segments', 'count': self._segments, 'bytes': self._bytes}):
+            self._segments = self._bytes = 0
+
+
+class WorkerChannel(LivestreamServer):
+    """A channel served by a worker process.
+
+    The owner encodes; the worker serves the HLS output it writes and its
+    own WebSocket clients, and learns the channel's state and chat from
+    the owner. Demand is passed on so the owner wakes or keeps encoding.
+    Nothing the owner keeps for encoding (media index, renditions, the
+    analytics database) is built here.
+    """
+
+    # Demand is sent at most this often per channel.
+    demand_interval: float = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner: Optional[BusClient] = None
+        self._demand_sent = 0.0
+
+    def init_services(self) -> None:
+        self.encoder_slots = None
+        self.renditions = None
+        self.media_index = None
+        self.analytics = BusAnalytics()
+        self.metrics = Metrics()
+
+    def register_metrics(self) -> None:
+        # Whether the channel sleeps is the owner's to report.
+        self.metrics.gauge_callback('livestream_websocket_clients',
+                                    lambda: len(self.broadcaster), channel=self.channel_id)
+
+    def touch(self) -> None:
+        self.last_demand = time.monotonic()
+        if self.last_demand - self._demand_sent >= self.demand_interval:
+            self.send_demand()
+
+    def send_demand(self) -> None:
+        if self.owner.send({'op': 'demand', 'channel': self.channel_id}):
+            self._demand_sent = time.monotonic()
+
+    def keep_awake(self) -> None:
+        """Renew demand while viewers here are watching or waiting."""
+        if len(self.broadcaster) or self._ready_waiters:
+            self.send_demand()
+
+    async def post_chat(self, chat_message: Dict) -> None:
+        # The owner posts it and sends it back to every worker, this one included.
+        self.owner.send({'op': 'chat', 'channel': self.channel_id, 'message': chat_message})
+
+    def analytics_frame(self) -> str:
+        return self.analytics.frame or '{"type": "analytics", "analytics": {}}'
+
+
+class WorkerBridge:
+    """A worker's end of the bus: follows the owner's channels."""
+
+    def __init__(self, app: web.Application, livestream_server: WorkerChannel,
+                 owner: BusClient):
+        self.app = app
+        self.livestream_server = livestream_server
+        self.owner = owner
+        self.analytics = livestream_server.analytics
+        self.analytics.owner = owner
+        for channel in livestream_server.channels.values():
+            channel.owner = owner
+        owner.on_connect = lambda: owner.send({'op': 'hello'})
+        owner.on('state', self.state)
+        owner.on('ready', self.ready)
+        owner.on('history', self.history)
+        owner.on('chat', self.chat)
+        owner.on('analytics', self.analytics_update)
+        owner.on('user', self.user)
+
+    def _channel(self, message: Dict) -> Optional[WorkerChannel]:
+        return self.livestream_server.channels.get(message.get('channel'))
+
+    async def state(self, message: Dict) -> None:
+        channel = self._channel(message)
+        if channel is None:
+            return
+        video = message['video']
+        channel.current_video = {'name': video} if video else None
+        channel.start_time = message['start_time']
+        if video:
+            self.analytics.play_counts[video] = message['play_count']
+        await channel.broadcast_state()
+
+    def ready(self, message: Dict) -> None:
+        channel = self._channel(message)
+        if channel is None:
+            return
+        channel.sleeping = message['sleeping']
+        if message['ready']:
+            # Don't wait for inotify to catch up with the owner's news.
+            channel.segment_cache.refresh()
+            for variant in channel.variants.values():
+                variant.segment_cache.refresh()
+            channel.ready.set()
+        else:
+            channel.ready.clear()
+
+    def history(self, message: Dict) -> None:
+        channel = self._channel(message)
+        if channel is not None:
+            channel.chat_history = ChatHistory(channel.chat_history.capacity)
+            for chat_message in message['messages']:
+                channel.chat_history.append(chat_message)
+
+    async def chat(self, message: Dict) -> None:
+        channel = self._channel(message)
+        if channel is not None:
+            await channel.broadcast(channel.chat_history.append(message['message']))
+
+    def analytics_update(self, message: Dict) -> None:
+        self.analytics.frame = message['frame']
+        self.analytics.current_viewers = message['viewers']
+        for channel in self.livestream_server.channels.values():
+            if channel.broadcaster.subscribers('analytics'):
+                channel.broadcaster.publish(message['frame'], topic='analytics')
+
+    def user(self, message: Dict) -> None:
+        self.app['user_cache'].invalidate(message['id'])
+
+    async def heartbeat(self, interval: float = 1.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for channel in self.livestream_server.channels.values():
+                channel.keep_awake()
+            self.analytics.flush()
+
+    async def report_metrics(self, interval: float = 5.0) -> None:
+        """Send the owner what this worker measured since its last report."""
+        metrics = self.livestream_server.metrics
+        while True:
+            await asyncio.sleep(interval)
+            if self.owner.send({'op': 'metrics', 'snapshot': metrics.snapshot()}):
+                metrics.reset()
+
+
+async def proxy_to_owner(request: web.Request) -> web.StreamResponse:
+    """Forward a request workers don't serve (admin, analytics, metrics) to the owner."""
+    headers = CIMultiDict((key, value) for key, value in request.headers.items()
+                          if key.lower() not in HOP_BY_HOP)
+    headers['X-Forwarded-For'] = request.remote or ''
+    try:
+        async with request.app['owner_session'].request(
+                request.method, URL('http://owner' + request.raw_path, encoded=True),
+                headers=headers, data=request.content if request.body_exists else None,
+                allow_redirects=False) as upstream:
+            response = web.StreamResponse(
+                status=upstream.status, reason=upstream.reason,
+                headers=CIMultiDict((key, value) for key, value in upstream.headers.items()
+                                    if key.lower() not in HOP_BY_HOP))
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(64 * 1024):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+    except aiohttp.ClientError as e:
+        logger.error(f"Error forwarding {request.path} to the owner: {str(e)}")
+        return web.Response(status=502, text="Server unavailable")
+
+
+def setup_owner(app: web.Application, livestream_server: LivestreamServer,
+                bus_path: str) -> None:
+    """Make this process the owner that worker processes connect to."""
+    bus = BusServer(bus_path)
+    bridge = OwnerBridge(app, livestream_server, bus)
+    app['bus'] = bus
+
+    async def start(app):
+        await bus.start()
+        app['bus_task'] = asyncio.create_task(bridge.run())
+
+    async def stop(app):
+        app['bus_task'].cancel()
+        await bus.stop()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+
+
+def setup_worker(app: web.Application, livestream_server: WorkerChannel,
+                 bus_path: str, owner_path: str) -> None:
+    """Serve ``livestream_server``'s channels from this worker process.
+
+    Call after every other route is added: it adds a catch-all route that
+    forwards to the owner listening on ``owner_path``.
+    """
+    owner = BusClient(bus_path)
+    bridge = WorkerBridge(app, livestream_server, owner)
+    app['bus'] = owner
+    app.router.add_route('*', PROXY_ROUTE, proxy_to_owner)
+
+    async def start(app):
+        app['owner_session'] = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=owner_path),
+            cookie_jar=aiohttp.DummyCookieJar(), auto_decompress=False)
+        for channel in livestream_server.channels.values():
+            for watcher in channel.output_watchers:
+                await watcher.start()
+        app['worker_tasks'] = [asyncio.create_task(owner.run()),
+                               asyncio.create_task(bridge.heartbeat()),
+                               asyncio.create_task(bridge.report_metrics())]
+
+    async def stop(app):
+        for task in app['worker_tasks']:
+            task.cancel()
+        for channel in livestream_server.channels.values():
+            for watcher in channel.output_watchers:
+                await watcher.stop()
+            await channel.broadcaster.close()
+        await app['owner_session'].close()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
@@ -6,12 +6,51 @@ from aiohttp_session import setup as setup_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 import base64
 from cryptography import fernet
+import logging
+import multiprocessing
 import os
 
 from livestream.server import LivestreamServer, start_background_tasks, cleanup_background_tasks
 from livestream.dns_resolver import start_dns_server
 from livestream.auth import setup_auth, init_db
 from livestream.admin import setup_admin_routes
+from livestream.channels import setup_channel_routes
+from livestream.ladder import DEFAULT_LADDER
+from livestream.pages import channel_page_response, setup_pages
+from livestream.metrics import handle_metrics, metrics_middleware
+from livestream.workers import PROXY_ROUTE, WorkerChannel, setup_owner, setup_worker
+
+# Channels besides the main one, each served under /channels/<id>/.
+EXTRA_CHANNELS = []
+
+# Output settings for every channel; see LivestreamServer. The default
+# ladder only copies the source: 720p plus audio, so viewers on a weak
+# connection have no lower video rung to fall back to. Set abr_ladder to
+# FULL_LADDER for real adaptive bitrate (480p and 360p, encoded live for
+# every channel), to None for a single rendition, or low_latency for LL-HLS.
+STREAM_OPTIONS = {
+    'hls_time': 4,
+    'continuous_output': True,
+    'abr_ladder': DEFAULT_LADDER,
+    'low_latency': False,
+    'll_part_duration': 1.0,
+}
+
+# Processes serving port 2020. One owns the encoders; with more than one,
+# the rest serve HLS, WebSockets and pages and hand everything else to it.
+WORKERS = 1
+BUS_PATH = os.path.join('run', 'bus.sock')
+OWNER_PATH = os.path.join('run', 'owner.sock')
+HOST = "0.0.0.0"
+PORT = 2020
+# Players poll the playlist every segment (4 s), so this keeps their
+# connections open between polls while letting go of departed ones sooner
+# than aiohttp's 75 s; the backlog absorbs many players joining at once.
+KEEPALIVE_TIMEOUT = 30.0
+BACKLOG = 1024
+# Served under /static/; ``python -m scripts.fetch_hls_js`` vendors the
+# pinned hls.js here so players load it from this server, not the CDN.
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
 
 
 def get_ip():
@@ -28,16 +67,32 @@ def get_ip():
 
 
 async def index(request):
-    return aiohttp_jinja2.render_template('index.html', request, {})
+    return channel_page_response(request, request.app['livestream_server'])
 
 
-async def init_app():
+def new_secret_key():
+    return base64.urlsafe_b64decode(fernet.Fernet.generate_key())
+
+
+def add_stream_routes(app, livestream_server):
+    app.router.add_get("/", index)
+    app.router.add_get("/video-state", livestream_server.video_state)
+    app.router.add_get("/chat/history", livestream_server.get_chat_history)
+    app.router.add_get("/hls/master.m3u8", livestream_server.hls_master_playlist)
+    app.router.add_get("/hls/playlist.m3u8", livestream_server.hls_playlist)
+    app.router.add_get("/hls/{segment}", livestream_server.hls_segment)
+    app.router.add_get("/hls/{variant}/playlist.m3u8",
+                       livestream_server.hls_variant_playlist)
+    app.router.add_get("/hls/{variant}/{segment}",
+                       livestream_server.hls_variant_segment)
+    app.router.add_get("/ws", livestream_server.handle_websocket)
+
+
+async def init_app(secret_key=None, workers=1):
     app = web.Application()
 
-    # Setup encrypted session
-    fernet_key = fernet.Fernet.generate_key()
-    secret_key = base64.urlsafe_b64decode(fernet_key)
-    setup_session(app, EncryptedCookieStorage(secret_key))
+    # Setup encrypted session; every worker process must use the same key
+    setup_session(app, EncryptedCookieStorage(secret_key or new_secret_key()))
 
     # Initialize database
     await init_db(app)
@@ -46,16 +101,23 @@ async def init_app():
     template_dir = os.path.join(os.path.dirname(__file__), 'templates')
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(template_dir))
 
+    # Pre-rendered pages and static assets, e.g. a vendored hls.min.js
+    setup_pages(app, STATIC_DIR)
+
     # Initialize LivestreamServer
-    livestream_server = LivestreamServer()
+    livestream_server = LivestreamServer(**STREAM_OPTIONS)
+    for channel_id in EXTRA_CHANNELS:
+        livestream_server.add_channel(channel_id)
+    app['metrics'] = livestream_server.metrics
+    app.middlewares.append(metrics_middleware(livestream_server.metrics))
 
     # Setup routes
-    app.router.add_get("/", index)
-    app.router.add_get("/video-state", livestream_server.video_state)
+    add_stream_routes(app, livestream_server)
     app.router.add_get("/analytics", livestream_server.get_analytics)
-    app.router.add_get("/hls/playlist.m3u8", livestream_server.hls_playlist)
-    app.router.add_get("/hls/{segment}", livestream_server.hls_segment)
-    app.router.add_get("/ws", livestream_server.handle_websocket)
+    app.router.add_get("/metrics", handle_metrics)
+
+    # Setup per-channel routes
+    setup_channel_routes(app, livestream_server)
 
     # Setup authentication
     setup_auth(app)
@@ -67,9 +129,52 @@ async def init_app():
     app.on_startup.append(start_background_tasks)
     app.on_cleanup.append(cleanup_background_tasks)
 
+    if workers > 1:
+        setup_owner(app, livestream_server, BUS_PATH)
+
+    return app
+
+
+async def init_worker_app(secret_key):
+    """App for a worker process; it encodes nothing itself."""
+    app = web.Application()
+    setup_session(app, EncryptedCookieStorage(secret_key))
+    await init_db(app)
+    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(template_dir))
+    setup_pages(app, STATIC_DIR)
+
+    livestream_server = WorkerChannel(**STREAM_OPTIONS)
+    for channel_id in EXTRA_CHANNELS:
+        livestream_server.add_channel(channel_id)
+    # Reported to the owner, whose /metrics covers every process
+    app.middlewares.append(metrics_middleware(livestream_server.metrics,
+                                              exclude={PROXY_ROUTE}))
+
+    add_stream_routes(app, livestream_server)
+    setup_channel_routes(app, livestream_server)
+    setup_auth(app)
+    # Last: forwards admin, analytics and metrics to the owner
+    setup_worker(app, livestream_server, BUS_PATH, OWNER_PATH)
     return app
 
 
+def run_worker(secret_key):
+    web.run_app(init_worker_app(secret_key), host=HOST, port=PORT, reuse_port=True,
+                keepalive_timeout=KEEPALIVE_TIMEOUT, backlog=BACKLOG, print=None)
+
+
+def start_workers(secret_key, count):
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for _ in range(count):
+        process = context.Process(target=run_worker, args=(secret_key,), daemon=True)
+        process.start()
+        processes.append(process)
+    logging.getLogger(__name__).info(f"Started {count} worker processes")
+    return processes
+
+
 def main():
     # Start DNS server
     start_dns_server()
@@ -77,14 +182,23 @@ def main():
     # Run the server
     hostname = "HoganLiveStream"
     ip = get_ip()
-    port = 2020
+    port = PORT
 
     print(f"Starting server on http://{ip}:{port}")
     print(f"You can access the stream at http://{hostname}:{port}")
     print("Make sure to add the following line to your hosts file:")
     print(f"{ip} {hostname}")
 
-    web.run_app(init_app(), host="0.0.0.0", port=port)
+    if WORKERS > 1:
+        secret_key = new_secret_key()
+        os.makedirs(os.path.dirname(OWNER_PATH), exist_ok=True)
+        start_workers(secret_key, WORKERS - 1)
+        web.run_app(init_app(secret_key, WORKERS), host=HOST, port=port,
+                    reuse_port=True, path=OWNER_PATH,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT, backlog=BACKLOG)
+    else:
+        web.run_app(init_app(), host=HOST, port=port,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT, backlog=BACKLOG)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+"""Vendor the pinned hls.js build into static/ so players load it from here.
+
+Run from the repository root: ``python -m scripts.fetch_hls_js``.
+The download is checked against ``HLS_JS_INTEGRITY`` in livestream/pages.py,
+the Subresource Integrity hash published for the release, and only written
+to static/ when it matches. When bumping ``HLS_JS_VERSION``, copy the new
+build's published SRI hash into ``HLS_JS_INTEGRITY`` first, then fetch and
+commit static/hls.min.js with it.
+"""
+import base64
+import hashlib
+import os
+import sys
+import urllib.request
+
+from livestream.pages import HLS_JS, HLS_JS_CDN, HLS_JS_INTEGRITY, HLS_JS_VERSION
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET = os.path.join(ROOT, 'static', HLS_JS)
+
+
+def integrity(data: bytes, algorithm: str) -> str:
+    """The Subresource Integrity value of ``data`` with ``algorithm``."""
+    digest = hashlib.new(algorithm, data).digest()
+    return f'{algorithm}-{base64.b64encode(digest).decode()}'
+
+
+def main() -> int:
+    algorithm, _, _ = HLS_JS_INTEGRITY.partition('-')
+    if algorithm not in ('sha256', 'sha384', 'sha512'):
+        print(f"HLS_JS_INTEGRITY in livestream/pages.py is not set to the published "
+              f"SRI hash of hls.js {HLS_JS_VERSION}", file=sys.stderr)
+        return 1
+
+    with urllib.request.urlopen(HLS_JS_CDN, timeout=30) as response:
+        data = response.read()
+    actual = integrity(data, algorithm)
+    if actual != HLS_JS_INTEGRITY:
+        print(f"Integrity mismatch for {HLS_JS_CDN}: got {actual}, "
+              f"expected {HLS_JS_INTEGRITY}", file=sys.stderr)
+        return 1
+
+    os.makedirs(os.path.dirname(TARGET), exist_ok=True)
+    with open(TARGET, 'wb') as f:
+        f.write(data)
+    print(f"Wrote {TARGET} ({len(data)} bytes)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from livestream.broadcaster import DISCONNECT, Broadcaster, ClientChannel, batch_frame
+
+
+def coalesced(*frames, max_batch=64):
+    async def run():
+        client = ClientChannel(None, Broadcaster(max_batch=max_batch))
+        client.queue.extend(frames)
+        sent = []
+        while client.queue:
+            sent.append(client._coalesce())
+        return sent
+    return asyncio.run(run())
+
+
+def test_single_frame_is_sent_as_is():
+    assert coalesced('{"type": "state"}') == ['{"type": "state"}']
+
+
+def test_queued_frames_are_batched():
+    [frame] = coalesced('{"n": 1}', '{"n": 2}', '{"n": 3}')
+    assert json.loads(frame) == {'type': 'batch',
+                                 'messages': [{'n': 1}, {'n': 2}, {'n': 3}]}
+
+
+def test_batches_are_capped_at_max_batch():
+    sent = coalesced(*(f'{{"n": {i}}}' for i in range(5)), max_batch=2)
+    assert [len(json.loads(frame)['messages']) for frame in sent[:2]] == [2, 2]
+    assert json.loads(sent[2]) == {'n': 4}
+
+
+def test_queued_batch_is_spliced_not_nested():
+    replay = batch_frame(['{"n": 2}', '{"n": 3}'])
+    [frame] = coalesced('{"n": 1}', replay, '{"n": 4}')
+    assert json.loads(frame) == {'type': 'batch', 'messages': [
+        {'n': 1}, {'n': 2}, {'n': 3}, {'n': 4}]}
+
+
+def test_empty_queued_batch_adds_nothing():
+    [frame] = coalesced('{"n": 1}', batch_frame([]))
+    assert json.loads(frame) == {'type': 'batch', 'messages': [{'n': 1}]}
+
+
+class SlowSocket:
+    def __init__(self):
+        self.closed_with = None
+
+    async def send_str(self, data):
+        await asyncio.sleep(3600)
+
+    async def close(self, code=None, message=b''):
+        self.closed_with = code
+
+
+def test_disconnect_policy_closes_the_slow_client():
+    async def run():
+        broadcaster = Broadcaster(max_queue=2, policy=DISCONNECT)
+        ws = SlowSocket()
+        client = broadcaster.register(ws)
+        results = [client.enqueue(f'{{"n": {i}}}') for i in range(3)]
+        assert broadcaster.closing
+        await asyncio.gather(*broadcaster.closing)
+        await asyncio.sleep(0)
+        return results, ws.closed_with, len(broadcaster), broadcaster.closing
+    results, code, clients, closing = asyncio.run(run())
+    assert results == [True, True, False]
+    assert code == 1013
+    assert clients == 0 and not closing
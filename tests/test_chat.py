@@ -0,0 +1,77 @@
+import json
+
+from livestream.chat import ChatHistory
+
+
+def history_of(count, capacity=100):
+    history = ChatHistory(capacity)
+    for i in range(count):
+        history.append({'type': 'chat', 'message': str(i), 'timestamp': float(i)})
+    return history
+
+
+def messages(frames):
+    return [json.loads(frame)['message'] for frame in frames]
+
+
+def test_page_returns_the_newest_messages_oldest_first():
+    frames, cursor = history_of(10).page(limit=3)
+    assert messages(frames) == ['7', '8', '9']
+    assert cursor == (7.0, 1)
+
+
+def test_page_follows_the_cursor_to_older_messages():
+    history = history_of(10)
+    frames, cursor = history.page(before=7.0, limit=3, skip=1)
+    assert messages(frames) == ['4', '5', '6']
+    frames, cursor = history.page(cursor[0], limit=5, skip=cursor[1])
+    assert messages(frames) == ['0', '1', '2', '3']
+    assert cursor is None
+
+
+def test_messages_sharing_a_timestamp_span_pages_without_loss():
+    history = ChatHistory()
+    for i, timestamp in enumerate([1.0, 2.0, 2.0, 2.0, 2.0, 3.0]):
+        history.append({'type': 'chat', 'message': str(i), 'timestamp': timestamp})
+    seen = []
+    before, skip = None, 0
+    while True:
+        frames, cursor = history.page(before, limit=2, skip=skip)
+        seen = messages(frames) + seen
+        if cursor is None:
+            break
+        before, skip = cursor
+    assert seen == ['0', '1', '2', '3', '4', '5']
+
+
+def test_page_without_more_history_has_no_cursor():
+    frames, cursor = history_of(3).page(limit=3)
+    assert messages(frames) == ['0', '1', '2']
+    assert cursor is None
+    assert history_of(0).page() == ([], None)
+
+
+def test_history_keeps_only_the_newest_messages():
+    history = history_of(10, capacity=4)
+    assert len(history) == 4
+    assert messages(history.page()[0]) == ['6', '7', '8', '9']
+
+
+def test_page_body_is_json():
+    body = json.loads(history_of(5).page_body(before=3.0, limit=2, skip=1))
+    assert [m['message'] for m in body['messages']] == ['1', '2']
+    assert (body['next_before'], body['next_skip']) == (1.0, 1)
+    body = json.loads(history_of(2).page_body())
+    assert (body['next_before'], body['next_skip']) == (None, 0)
+
+
+def test_replay_frame_is_rebuilt_only_after_changes():
+    history = history_of(0)
+    assert history.replay_frame() is None
+    history.append({'type': 'chat', 'message': 'hi', 'timestamp': 1.0})
+    frame = history.replay_frame()
+    assert history.replay_frame() is frame
+    assert json.loads(frame) == {'type': 'batch', 'messages': [
+        {'type': 'chat', 'message': 'hi', 'timestamp': 1.0}]}
+    history.append({'type': 'chat', 'message': 'again', 'timestamp': 2.0})
+    assert len(json.loads(history.replay_frame())['messages']) == 2
@@ -0,0 +1,115 @@
+import struct
+
+from livestream.llhls import LowLatencyPlaylist, fragment_is_independent
+from livestream.segment_cache import SegmentCache
+
+
+def box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def fragment(independent):
+    """A moof whose only trun gives the first sample's flags."""
+    flags = 0 if independent else 0x00010000
+    trun = box(b'trun', struct.pack('>III', 0x000004, 1, flags))
+    return box(b'moof', box(b'traf', trun)) + box(b'mdat', b'\0' * 16)
+
+
+def write_parts(directory, keyframes, count):
+    for i in range(count):
+        (directory / f'part{i}.m4s').write_bytes(fragment(i in keyframes))
+
+
+def media_playlist(count, discontinuity_at=None, duration=1.0):
+    lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:1']
+    for i in range(count):
+        if i == discontinuity_at:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines += [f'#EXTINF:{duration:.3f},', f'part{i}.m4s']
+    return '\n'.join(lines) + '\n'
+
+
+def make_playlist(tmp_path):
+    return LowLatencyPlaylist(SegmentCache(str(tmp_path)), segment_target=4,
+                              part_target=1)
+
+
+def test_fragment_independence():
+    assert fragment_is_independent(fragment(True))
+    assert not fragment_is_independent(fragment(False))
+    assert not fragment_is_independent(b'not a fragment')
+
+
+def test_parts_are_grouped_into_segments_starting_on_keyframes(tmp_path):
+    write_parts(tmp_path, {0, 4, 8}, 10)
+    playlist = make_playlist(tmp_path)
+    assert playlist.ingest(media_playlist(10))
+
+    assert [s.msn for s in playlist.segments] == [0, 1]
+    assert [p.name for p in playlist.segments[1].parts] == \
+        ['part4.m4s', 'part5.m4s', 'part6.m4s', 'part7.m4s']
+    assert [p.name for p in playlist.open.parts] == ['part8.m4s', 'part9.m4s']
+    segment = playlist.get_segment('segment0.m4s')
+    assert segment.data == b''.join(
+        (tmp_path / f'part{i}.m4s').read_bytes() for i in range(4))
+
+
+def test_rendered_playlist_advertises_parts_and_preload_hint(tmp_path):
+    write_parts(tmp_path, {0, 4, 8}, 10)
+    playlist = make_playlist(tmp_path)
+    playlist.ingest(media_playlist(10))
+    text = playlist.playlist.data.decode()
+
+    assert '#EXT-X-MEDIA-SEQUENCE:0' in text
+    assert '#EXT-X-PART-INF:PART-TARGET=1.000' in text
+    assert '#EXTINF:4.000,\nsegment1.m4s' in text
+    assert '#EXT-X-PART:DURATION=1.000,URI="part8.m4s",INDEPENDENT=YES' in text
+    assert '#EXT-X-PART:DURATION=1.000,URI="part9.m4s"\n' in text
+    assert text.endswith('#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part10.m4s"\n')
+
+
+def test_ingest_only_adds_new_parts(tmp_path):
+    write_parts(tmp_path, {0}, 3)
+    playlist = make_playlist(tmp_path)
+    assert playlist.ingest(media_playlist(2))
+    assert not playlist.ingest(media_playlist(2))
+    assert playlist.ingest(media_playlist(3))
+    assert [p.name for p in playlist.open.parts] == \
+        ['part0.m4s', 'part1.m4s', 'part2.m4s']
+
+
+def test_has_tracks_segments_and_parts(tmp_path):
+    write_parts(tmp_path, {0, 4}, 6)
+    playlist = make_playlist(tmp_path)
+    playlist.ingest(media_playlist(6))
+    assert playlist.has(0)
+    assert not playlist.has(1)
+    assert playlist.has(1, 1)
+    assert not playlist.has(1, 2)
+    assert not playlist.has(2, 0)
+
+
+def test_discontinuity_starts_a_new_segment(tmp_path):
+    write_parts(tmp_path, {0}, 4)
+    playlist = make_playlist(tmp_path)
+    playlist.ingest(media_playlist(4, discontinuity_at=2))
+    assert [p.name for p in playlist.segments[0].parts] == ['part0.m4s', 'part1.m4s']
+    assert playlist.open.discontinuity
+    assert '#EXT-X-DISCONTINUITY\n#EXT-X-PART' in playlist.playlist.data.decode()
+
+
+def test_segment_without_keyframes_is_closed_when_overdue(tmp_path):
+    write_parts(tmp_path, {0}, 9)
+    playlist = make_playlist(tmp_path)
+    playlist.ingest(media_playlist(9))
+    assert len(playlist.segments[0].parts) == 8
+    assert [p.name for p in playlist.open.parts] == ['part8.m4s']
+
+
+def test_window_drops_old_segments(tmp_path):
+    write_parts(tmp_path, set(range(0, 40, 4)), 40)
+    playlist = LowLatencyPlaylist(SegmentCache(str(tmp_path), max_segments=40),
+                                  segment_target=4, part_target=1, window=3)
+    playlist.ingest(media_playlist(40))
+    assert [s.msn for s in playlist.segments] == [6, 7, 8]
+    assert '#EXT-X-MEDIA-SEQUENCE:6' in playlist.playlist.data.decode()
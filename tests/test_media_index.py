@@ -0,0 +1,31 @@
+import json
+
+from livestream.media_index import parse_ffprobe, parse_keyframes
+
+FFPROBE = {
+    'format': {'duration': '12.000000', 'bit_rate': '2900000'},
+    'streams': [
+        {'codec_type': 'video', 'codec_name': 'h264', 'profile': 'High', 'level': 31,
+         'pix_fmt': 'yuv420p', 'width': 1280, 'height': 720,
+         'avg_frame_rate': '30000/1001'},
+        {'codec_type': 'audio', 'codec_name': 'aac', 'profile': 'LC',
+         'sample_rate': '44100', 'channels': 2},
+    ],
+}
+
+
+def test_parse_ffprobe_keeps_codec_profiles_and_level():
+    info = parse_ffprobe(json.dumps(FFPROBE).encode())
+    assert info['duration'] == 12.0
+    assert info['bitrate'] == 2900000
+    assert (info['video_codec'], info['video_profile'], info['video_level']) == \
+        ('h264', 'High', 31)
+    assert round(info['frame_rate'], 2) == 29.97
+    assert (info['audio_codec'], info['audio_profile'], info['sample_rate']) == \
+        ('aac', 'LC', 44100)
+
+
+def test_parse_keyframes_reports_the_longest_gap():
+    output = b'0.000000,K_\n0.033333,__\n2.000000,K_\n6.000000,K_\n'
+    assert parse_keyframes(output) == 4.0
+    assert parse_keyframes(b'0.0,__\n') is None
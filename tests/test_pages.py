@@ -0,0 +1,41 @@
+from aiohttp.test_utils import make_mocked_request
+
+from livestream.pages import CompressedFile, _accepted, _encoding
+
+TEXT = '<html>' + 'compressible ' * 200 + '</html>'
+
+
+def encoding(header, entry=None):
+    entry = entry or CompressedFile.render('index.html', TEXT)
+    headers = {} if header is None else {'Accept-Encoding': header}
+    return _encoding(make_mocked_request('GET', '/', headers=headers), entry)
+
+
+def test_accepted_parses_codings_and_q_values():
+    assert _accepted('gzip, deflate;q=0.5, BR;q=0') == \
+        {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0}
+
+
+def test_accepted_treats_a_malformed_q_value_as_refused():
+    assert _accepted('gzip;q=high') == {'gzip': 0.0}
+
+
+def test_encoding_picks_an_accepted_stored_encoding():
+    entry = CompressedFile.render('index.html', TEXT)
+    expected = 'br' if 'br' in entry.encoded else 'gzip'
+    assert encoding('gzip, br', entry) == expected
+    assert encoding('gzip') == 'gzip'
+    assert encoding('*') == expected
+
+
+def test_encoding_respects_refusals():
+    assert encoding(None) is None
+    assert encoding('identity') is None
+    assert encoding('gzip;q=0') is None
+    assert encoding('*, gzip;q=0, br;q=0') is None
+
+
+def test_incompressible_files_are_sent_as_is():
+    entry = CompressedFile.render('tiny.js', 'x')
+    assert entry.encoded == {}
+    assert encoding('gzip, br', entry) is None
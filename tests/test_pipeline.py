@@ -0,0 +1,61 @@
+import pytest
+
+from livestream.pipeline import can_stream_copy
+
+INFO = {
+    'video_codec': 'h264',
+    'audio_codec': 'aac',
+    'pix_fmt': 'yuv420p',
+    'video_profile': 'High',
+    'video_level': 31,
+    'audio_profile': 'LC',
+    'keyframe_interval': 2.0,
+    'width': 1280,
+    'height': 720,
+    'frame_rate': 29.97,
+    'sample_rate': 48000,
+    'channels': 2,
+}
+
+PROFILE = {'width': 1280, 'height': 720, 'fps': 29.97, 'sample_rate': 48000,
+           'channels': 2}
+
+
+def with_(**changes):
+    return {**INFO, **changes}
+
+
+def test_matching_source_can_be_copied():
+    assert can_stream_copy(INFO, 4.0, **PROFILE)
+    assert can_stream_copy(INFO, 2.0, **PROFILE)
+
+
+def test_lower_profiles_and_levels_can_be_copied():
+    assert can_stream_copy(with_(video_profile='Main', video_level=30), 4.0, **PROFILE)
+    assert can_stream_copy(with_(video_profile='Constrained Baseline'), 4.0, **PROFILE)
+
+
+def test_unspecified_profile_fields_are_not_checked():
+    assert can_stream_copy(with_(width=640, height=360, channels=6), 4.0)
+
+
+@pytest.mark.parametrize('info', [
+    None,
+    {},
+    with_(video_codec='hevc'),
+    with_(audio_codec='mp3'),
+    with_(pix_fmt='yuv422p'),
+    with_(video_profile='High 10'),
+    with_(video_profile=None),
+    with_(video_level=32),
+    with_(video_level=None),
+    with_(audio_profile='HE-AAC'),
+    with_(keyframe_interval=None),
+    with_(keyframe_interval=4.5),
+    with_(width=1920, height=1080),
+    with_(frame_rate=25.0),
+    with_(sample_rate=44100),
+    with_(channels=1),
+])
+def test_sources_that_need_a_transcode(info):
+    assert not can_stream_copy(info, 4.0, **PROFILE)
@@ -0,0 +1,22 @@
+import os
+
+from livestream.pipeline import ContinuousPipeline
+from livestream.renditions import RenditionCache
+
+
+def test_prune_removes_stale_and_interrupted_renditions(tmp_path):
+    video = tmp_path / 'a.mp4'
+    video.write_bytes(b'video')
+    cache = RenditionCache(str(tmp_path / 'cache'), ContinuousPipeline(str(tmp_path)))
+    st = os.stat(video)
+    cache.index[str(video)] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                               'sha256': 'abc'}
+    kept = cache.rendition_path('abc')
+    os.makedirs(cache.cache_dir)
+    for path in (kept, cache.rendition_path('old'), kept + '.part'):
+        with open(path, 'wb') as f:
+            f.write(b'ts')
+
+    cache.prune([str(video)])
+    assert sorted(os.listdir(cache.cache_dir)) == sorted(['index.json', os.path.basename(kept)])
+    assert cache.lookup(str(video)) == kept
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+
+from livestream.scheduler import SHUFFLE, WEIGHTED, Scheduler, TimeSlot
+
+
+def at(hour, minute=0):
+    """A timestamp at the given local time of day."""
+    return time.mktime((2026, 1, 15, hour, minute, 0, 0, 0, -1))
+
+
+def library(*names):
+    return [{'name': name, 'path': f'/videos/{name}'} for name in names]
+
+
+def make_scheduler(*names, mode=SHUFFLE, play_counts=None):
+    scheduler = Scheduler(play_counts if play_counts is not None else {}, mode=mode)
+    scheduler.set_library(library(*names))
+    return scheduler
+
+
+def test_time_slot_active_window():
+    slot = TimeSlot('09:00', '17:30', [])
+    assert slot.active(at(9))
+    assert slot.active(at(17, 29))
+    assert not slot.active(at(17, 30))
+    assert not slot.active(at(8, 59))
+
+
+def test_time_slot_runs_past_midnight():
+    slot = TimeSlot('22:00', '02:00', [])
+    assert slot.active(at(23))
+    assert slot.active(at(1, 59))
+    assert not slot.active(at(12))
+
+
+def test_time_slot_rejects_invalid_times():
+    with pytest.raises(ValueError):
+        TimeSlot('24:00', '01:00', [])
+
+
+def test_every_video_plays_once_per_pass():
+    scheduler = make_scheduler('a', 'b', 'c')
+    played = [scheduler.take()['name'] for _ in range(3)]
+    assert sorted(played) == ['a', 'b', 'c']
+
+
+def test_new_pass_does_not_repeat_the_last_video():
+    for _ in range(20):
+        scheduler = make_scheduler('a', 'b')
+        first = [scheduler.take()['name'] for _ in range(2)]
+        assert scheduler.take()['name'] != first[-1]
+
+
+def test_peek_is_stable_until_taken():
+    scheduler = make_scheduler('a', 'b', 'c', 'd')
+    planned = scheduler.peek()
+    assert all(scheduler.peek() is planned for _ in range(10))
+    assert scheduler.take() is planned
+    assert scheduler.to_dict()['history'] == [planned['name']]
+
+
+def test_queue_takes_precedence_in_order():
+    scheduler = make_scheduler('a', 'b', 'c')
+    scheduler.enqueue('c')
+    scheduler.enqueue('b', front=True)
+    assert [scheduler.take()['name'] for _ in range(2)] == ['b', 'c']
+    assert not scheduler.queue
+
+
+def test_enqueue_unknown_video_raises():
+    with pytest.raises(KeyError):
+        make_scheduler('a').enqueue('missing')
+
+
+def test_queued_video_removed_from_library_is_skipped():
+    scheduler = make_scheduler('a', 'b')
+    scheduler.enqueue('a')
+    scheduler.set_library(library('b'))
+    assert scheduler.take()['name'] == 'b'
+
+
+def test_active_slot_restricts_candidates():
+    scheduler = make_scheduler('a', 'b', 'c')
+    scheduler.set_slots([TimeSlot('08:00', '12:00', ['b'], name='morning')])
+    assert {scheduler.take(at=at(9))['name'] for _ in range(5)} == {'b'}
+    assert scheduler.active_slot(at(13)) is None
+
+
+def test_plan_is_redrawn_for_a_different_slot():
+    scheduler = make_scheduler('a', 'b')
+    scheduler.set_slots([TimeSlot('08:00', '12:00', ['a']),
+                         TimeSlot('12:00', '16:00', ['b'])])
+    assert scheduler.peek(at(11, 59))['name'] == 'a'
+    assert scheduler.peek(at(12))['name'] == 'b'
+
+
+def test_weighted_mode_favours_less_played_videos():
+    counts = {'popular': 1000, 'rare': 0}
+    picks = []
+    for _ in range(50):
+        scheduler = make_scheduler('popular', 'rare', mode=WEIGHTED, play_counts=counts)
+        picks.append(scheduler.peek()['name'])
+    assert picks.count('rare') > picks.count('popular')
+
+
+def test_set_mode_rejects_unknown_modes():
+    with pytest.raises(ValueError):
+        make_scheduler('a').set_mode('random')
+
+
+def test_empty_library_has_nothing_to_play():
+    scheduler = make_scheduler()
+    assert scheduler.peek() is None
+    assert scheduler.take() is None
@@ -0,0 +1,42 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from livestream.segment_cache import CachedFile, _byte_range
+
+ENTRY = CachedFile('segment0.ts', bytes(range(100)), 1_000_000)
+
+
+def byte_range(headers):
+    return _byte_range(make_mocked_request('GET', '/hls/segment0.ts', headers=headers), ENTRY)
+
+
+def test_no_range_header_means_the_whole_file():
+    assert byte_range({}) is None
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', slice(0, 10)),
+    ('bytes=90-', slice(90, 100)),
+    ('bytes=-10', slice(90, 100)),
+    ('bytes=-500', slice(0, 100)),
+    ('bytes=95-200', slice(95, 100)),
+])
+def test_single_range_is_clamped_to_the_file(header, expected):
+    assert byte_range({'Range': header}) == expected
+
+
+def test_range_past_the_end_is_not_satisfiable():
+    with pytest.raises(web.HTTPRequestRangeNotSatisfiable) as excinfo:
+        byte_range({'Range': 'bytes=100-'})
+    assert excinfo.value.headers['Content-Range'] == 'bytes */100'
+
+
+@pytest.mark.parametrize('header', ['bytes=a-b', 'bytes=0-1,5-6', 'items=0-1'])
+def test_unusable_ranges_are_ignored(header):
+    assert byte_range({'Range': header}) is None
+
+
+def test_if_range_must_match_the_current_etag():
+    assert byte_range({'Range': 'bytes=0-9', 'If-Range': ENTRY.etag}) == slice(0, 10)
+    assert byte_range({'Range': 'bytes=0-9', 'If-Range': '"stale"'}) is None
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+from livestream.db import Database
+from livestream.timeseries import MAX, SUM, TimeSeriesRing, TimeSeriesStore
+
+
+def make_ring(slots=4):
+    return TimeSeriesRing(10, slots, {'hits': SUM, 'peak': MAX})
+
+
+def test_ring_sums_counters_and_keeps_gauge_maximum():
+    ring = make_ring()
+    ring.record('hits', 1, 100)
+    ring.record('hits', 2, 109)
+    ring.record('peak', 5, 101)
+    ring.record('peak', 3, 102)
+    assert ring.get('hits', 10) == 3
+    assert ring.get('peak', 10) == 5
+
+
+def test_ring_forgets_a_bucket_once_its_slot_is_reused():
+    ring = make_ring(slots=4)
+    ring.record('hits', 1, 100)
+    # Bucket 14 lands in the same slot as bucket 10, a full lap later.
+    ring.record('hits', 7, 140)
+    assert ring.get('hits', 10) is None
+    assert ring.get('hits', 14) == 7
+    assert ring.covers(14, 140) and not ring.covers(10, 140)
+
+
+def test_ring_range_skips_unwritten_buckets():
+    ring = make_ring(slots=8)
+    ring.record('hits', 1, 100)
+    ring.record('hits', 4, 130)
+    assert ring.range('hits', 10, 13) == [(10, 1.0), (13, 4.0)]
+
+
+def test_store_records_every_resolution():
+    store = TimeSeriesStore()
+    store.add('segment_requests', 2, now=7200.5)
+    store.add('segment_requests', 3, now=7210.0)
+    assert store.rings[1].get('segment_requests', 7200) == 2
+    assert store.rings[60].get('segment_requests', 120) == 5
+    assert store.rings[3600].get('segment_requests', 2) == 5
+
+
+def test_store_tick_rerecords_gauges():
+    store = TimeSeriesStore()
+    store.set_gauge('viewers', 4, now=1000.0)
+    store.tick(now=1001.0)
+    assert store.rings[1].get('viewers', 1001) == 4
+
+
+def test_pick_resolution_prefers_the_finest_ring_that_covers_the_range():
+    store = TimeSeriesStore()
+    now = 1_000_000.0
+    assert store.pick_resolution(now - 600, now) == 1
+    assert store.pick_resolution(now - 7200, now) == 60
+    assert store.pick_resolution(now - 7 * 86400, now) == 3600
+
+
+def test_query_returns_timestamped_points():
+    store = TimeSeriesStore()
+    now = time.time()
+    store.add('chat_messages', 1, now=now - 5)
+    store.add('chat_messages', 1, now=now - 5)
+    result = asyncio.run(store.query(['chat_messages'], now - 60, now, resolution=1))
+    assert result['resolution'] == 1
+    assert result['series']['chat_messages'] == [[int(now - 5), 2.0]]
+
+
+def test_flushed_buckets_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'series.db')
+    now = time.time()
+
+    async def write():
+        store = TimeSeriesStore(Database(path))
+        await store.open()
+        store.add('bytes_served', 1000, now=now - 180)
+        await store.close()
+
+    async def read():
+        store = TimeSeriesStore(Database(path))
+        await store.open()
+        try:
+            return await store.query(['bytes_served'], now - 600, now, resolution=60)
+        finally:
+            await store.close()
+
+    asyncio.run(write())
+    result = asyncio.run(read())
+    bucket = int((now - 180) // 60) * 60
+    assert [bucket, 1000.0] in result['series']['bytes_served']